@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import os.path
 import re
 
 from . import hboot_image
+from . import image_template
+from . import signer
+from . import source_cache
+from .hwconfig import hwconfig
 
 
 tParser = argparse.ArgumentParser(usage='usage: hboot_image [options]')
 tParser.add_argument('-n', '--netx-type',
-                     dest='strNetxType',
+                     dest='astrNetxTypes',
                      required=True,
+                     action='append',
                      choices=[
                          'NETX56',
                          'NETX90',
@@ -21,7 +27,11 @@ tParser.add_argument('-n', '--netx-type',
                          'NETX4100'
                      ],
                      metavar='NETX',
-                     help='Build the image for netx type NETX.')
+                     help='Build the image for netx type NETX. Repeat the '
+                          'option to build the same definition for several '
+                          'netx types in one pass. Then the names of the '
+                          'output file and the layout map must contain '
+                          '"{netx}".')
 tParser.add_argument('-c', '--objcopy',
                      dest='strObjCopy',
                      required=False,
@@ -88,13 +98,153 @@ tParser.add_argument('--openssl-options',
                      action='append',
                      metavar='SSLOPT',
                      help='Add SSLOPT to the arguments for OpenSSL.')
+tParser.add_argument('--key-cache',
+                     dest='strKeyCachePath',
+                     required=False,
+                     default=None,
+                     metavar='PATH',
+                     help='Keep the public parts of all decoded keys in PATH.')
+tParser.add_argument('--signer',
+                     dest='strSignerAddress',
+                     required=False,
+                     default=None,
+                     metavar='PATH',
+                     help='Send all signing requests to the signing daemon at '
+                          'the Unix domain socket PATH.')
+tParser.add_argument('--hash-threads',
+                     dest='uiHashThreads',
+                     required=False,
+                     default=0,
+                     type=int,
+                     metavar='N',
+                     help='Hash large chunks in parallel on N threads.')
+tParser.add_argument('--compress-threads',
+                     dest='uiCompressThreads',
+                     required=False,
+                     default=None,
+                     type=int,
+                     metavar='N',
+                     help='Compress the blocks of DaXZ payloads on N threads. '
+                          'The default is the number of CPUs.')
+tParser.add_argument('--compress-cache',
+                     dest='strCompressCachePath',
+                     required=False,
+                     default=None,
+                     metavar='PATH',
+                     help='Keep the compressed DaXZ payloads in PATH.')
+tParser.add_argument('--memory-budget',
+                     dest='sizMemoryBudget',
+                     required=False,
+                     default=None,
+                     type=int,
+                     metavar='BYTES',
+                     help='Stream the contents of ELF files which are larger '
+                          'than BYTES. The files shared by several images '
+                          'are only kept in memory up to BYTES in total. The '
+                          'default is 512MB.')
+tParser.add_argument('--sparse',
+                     dest='strSparseMode',
+                     required=False,
+                     default=None,
+                     choices=['holes', 'extents'],
+                     metavar='MODE',
+                     help='Do not write the fill areas of "Skip" chunks and '
+                          'the padding. MODE "holes" writes areas filled '
+                          'with 0x00 as holes in the file. MODE "extents" '
+                          'writes an extent list without any fill areas.')
+tParser.add_argument('--optimize-registers',
+                     dest='fOptimizeRegisters',
+                     required=False,
+                     default=False,
+                     action='store_const', const=True,
+                     help='Merge adjacent writes to the same register in '
+                          'all Register chunks and print the number of '
+                          'saved words for each chunk. Only the registers '
+                          'from "--register-model" are optimized.')
+tParser.add_argument('--register-model',
+                     dest='strRegisterModelFile',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Read the registers for "--optimize-registers" '
+                          'from the hwconfig peripheral definition FILE.')
+tParser.add_argument('--drop-register-defaults',
+                     dest='fDropRegisterDefaults',
+                     required=False,
+                     default=False,
+                     action='store_const', const=True,
+                     help='Also remove writes of the default values from '
+                          'the register model. Only use this if the '
+                          'defaults are the reset values. They are only '
+                          'used if no chunk runs before the first Register '
+                          'chunk.')
+tParser.add_argument('--layout-map',
+                     dest='strLayoutMapFile',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Write the position of all chunks to FILE. The '
+                          'format is CSV if FILE ends in ".csv", JSON '
+                          'otherwise.')
+tParser.add_argument('--devices',
+                     dest='strDeviceList',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Compile the image once as a template and write '
+                          'one image for each device in FILE. FILE is a CSV '
+                          'or JSON list with the values for the slots. The '
+                          'output file name is formatted with the values of '
+                          'each device, e.g. "unit_{serial}.bin".')
+tParser.add_argument('--define-matrix',
+                     dest='strDefineMatrix',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Build one variant of the image for each define '
+                          'set in FILE. FILE is a CSV or JSON list. The '
+                          'defines of a set are added to the defines from '
+                          '"-D". The names of the output file and the '
+                          'layout map are formatted with the defines of '
+                          'each variant and "index", e.g. '
+                          '"image_{BOARD}.bin".')
+tParser.add_argument('--dry-run',
+                     dest='fDryRun',
+                     required=False,
+                     default=False,
+                     action='store_const', const=True,
+                     help='Only compute the layout of the image. Do not '
+                          'read the payload, compute hashes or sign. The '
+                          'layout map is written to the file from '
+                          '"--layout-map" or printed as JSON. No image is '
+                          'written.')
 tParser.add_argument('strInputFile',
                      metavar='FILE',
                      help='Read the HBoot definition from FILE.')
 tParser.add_argument('strOutputFile',
+                     nargs='?',
+                     default=None,
                      metavar='FILE',
                      help='Write the HBoot image to FILE.')
 tArgs = tParser.parse_args()
+if (tArgs.strOutputFile is None) and (tArgs.fDryRun is not True):
+    tParser.error('An output file is required without "--dry-run".')
+if (tArgs.strDefineMatrix is not None) and (tArgs.strDeviceList is not None):
+    tParser.error('"--define-matrix" can not be combined with "--devices".')
+
+# Build each netx type only once.
+astrNetxTypes = []
+for strNetxType in tArgs.astrNetxTypes:
+    if strNetxType not in astrNetxTypes:
+        astrNetxTypes.append(strNetxType)
+fMultipleTargets = (len(astrNetxTypes) > 1)
+if fMultipleTargets is True:
+    for strFile in [tArgs.strOutputFile, tArgs.strLayoutMapFile]:
+        if (strFile is not None) and ('{netx}' not in strFile):
+            tParser.error(
+                'The file name "%s" must contain "{netx}" for several netx '
+                'types.' % strFile
+            )
 
 # Set the default for the patch table here.
 atDefaultPatchTables = {
@@ -106,11 +256,6 @@ atDefaultPatchTables = {
     'NETX4000': 'hboot_netx4000_patch_table.xml',
     'NETX4100': 'hboot_netx4000_patch_table.xml'
 }
-if tArgs.strPatchTablePath is None:
-    tArgs.strPatchTablePath = os.path.join(
-        os.path.dirname(os.path.realpath(__file__)),
-        atDefaultPatchTables[tArgs.strNetxType]
-    )
 
 # Parse all alias definitions.
 atKnownFiles = {}
@@ -171,17 +316,137 @@ tEnv = {'OBJCOPY': tArgs.strObjCopy,
         'READELF': tArgs.strReadElf,
         'HBOOT_INCLUDE': tArgs.astrIncludePaths}
 
-tCompiler = hboot_image.HbootImage(
-    tEnv,
-    tArgs.strNetxType,
-    defines=atDefinitions,
-    includes=tArgs.astrIncludePaths,
-    known_files=atKnownFiles,
-    patch_definition=tArgs.strPatchTablePath,
-    verbose=tArgs.fVerbose,
-    sniplibs=tArgs.astrSnipLib,
-    keyrom=tArgs.strKeyRomPath,
-    openssloptions=tArgs.astrOpensslOptions
-)
-tCompiler.parse_image(tArgs.strInputFile)
-tCompiler.write(tArgs.strOutputFile)
+# Use a signing daemon if requested.
+cSigner = None
+if tArgs.strSignerAddress is not None:
+    cSigner = signer.SocketSigner(
+        tArgs.strSignerAddress,
+        strKeyCacheFolder=tArgs.strKeyCachePath
+    )
+
+# Read the registers for the optimization from a peripheral definition.
+atRegisterDefaults = None
+if tArgs.strRegisterModelFile is not None:
+    tPeripheral = hwconfig.Peripherals()
+    tPeripheral.read(tArgs.strRegisterModelFile)
+    atRegisterDefaults = tPeripheral.get_register_defaults()
+
+# Get all define sets. Without a matrix this is only the set from the
+# command line.
+atDefineSets = [atDefinitions]
+if tArgs.strDefineMatrix is not None:
+    atDefineSets = []
+    for atVariant in image_template.read_device_list(tArgs.strDefineMatrix):
+        atDefines = dict(atDefinitions)
+        for strName, tValue in atVariant.items():
+            # The values are strings like the ones from "-D".
+            atDefines[strName] = str(tValue)
+        atDefineSets.append(atDefines)
+
+# All variants and netx types share the preprocessed fragments of the
+# definition, the data files and the ELF segments. All signatures are sent
+# to one signer.
+cSourceCache = None
+if (fMultipleTargets is True) or (len(atDefineSets) > 1):
+    cSourceCache = source_cache.SourceCache(tArgs.sizMemoryBudget)
+    if cSigner is None:
+        cSigner = signer.OpenSslSigner('openssl', tArgs.astrOpensslOptions)
+
+# Get the file names for all variants and netx types.
+atVariantBuilds = []
+astrOutputFiles = []
+for uiIndex, atDefines in enumerate(atDefineSets):
+    atBuilds = []
+    for strNetxType in astrNetxTypes:
+        astrFiles = []
+        for strFile in [tArgs.strOutputFile, tArgs.strLayoutMapFile]:
+            if strFile is not None:
+                strFile = strFile.replace('{netx}', strNetxType)
+                if tArgs.strDefineMatrix is not None:
+                    strFile = strFile.format(index=uiIndex, **atDefines)
+                if strFile in astrOutputFiles:
+                    tParser.error(
+                        'More than one image writes to "%s". Add "{index}" '
+                        'or a define to the file name.' % strFile
+                    )
+                astrOutputFiles.append(strFile)
+            astrFiles.append(strFile)
+        atBuilds.append((strNetxType, astrFiles[0], astrFiles[1]))
+    atVariantBuilds.append(atBuilds)
+
+atLayouts = {}
+for atDefines, atBuilds in zip(atDefineSets, atVariantBuilds):
+    # Parse all netx types of a variant before the first one is written.
+    # Then their signatures are created in one batch.
+    atCompilers = []
+    for strNetxType, strOutputFile, strLayoutMapFile in atBuilds:
+        # Each netx type has its own default patch table.
+        strPatchTablePath = tArgs.strPatchTablePath
+        if strPatchTablePath is None:
+            strPatchTablePath = os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                atDefaultPatchTables[strNetxType]
+            )
+
+        tCompiler = hboot_image.HbootImage(
+            tEnv,
+            strNetxType,
+            defines=atDefines,
+            includes=tArgs.astrIncludePaths,
+            known_files=atKnownFiles,
+            patch_definition=strPatchTablePath,
+            verbose=tArgs.fVerbose,
+            sniplibs=tArgs.astrSnipLib,
+            keyrom=tArgs.strKeyRomPath,
+            keycache=tArgs.strKeyCachePath,
+            signer=cSigner,
+            hash_threads=tArgs.uiHashThreads,
+            sparse=tArgs.strSparseMode,
+            source_cache=cSourceCache,
+            compress_cache=tArgs.strCompressCachePath,
+            compress_threads=tArgs.uiCompressThreads,
+            memory_budget=tArgs.sizMemoryBudget,
+            optimize_registers=tArgs.fOptimizeRegisters,
+            register_defaults=atRegisterDefaults,
+            drop_register_defaults=tArgs.fDropRegisterDefaults,
+            openssloptions=tArgs.astrOpensslOptions
+        )
+
+        if tArgs.fDryRun is True:
+            atLayout = tCompiler.dry_run(tArgs.strInputFile)
+            atLayouts.setdefault(strNetxType, []).append(atLayout)
+            if strLayoutMapFile is not None:
+                tCompiler.write_layout_map(strLayoutMapFile)
+            tCompiler.close()
+        else:
+            tCompiler.parse_image(tArgs.strInputFile)
+            atCompilers.append((tCompiler, strOutputFile, strLayoutMapFile))
+
+    for tCompiler, strOutputFile, strLayoutMapFile in atCompilers:
+        if tArgs.strDeviceList is None:
+            tCompiler.write(strOutputFile)
+        else:
+            tTemplate = tCompiler.get_template()
+            tTemplate.generate(
+                image_template.read_device_list(tArgs.strDeviceList),
+                strOutputFile
+            )
+        if strLayoutMapFile is not None:
+            tCompiler.write_layout_map(strLayoutMapFile)
+        tCompiler.close()
+
+# Stop the shared signer after the last image.
+if cSigner is not None:
+    cSigner.close()
+
+# Print the layout maps of a dry run if they were not written to a file.
+if (tArgs.fDryRun is True) and (tArgs.strLayoutMapFile is None):
+    # Show a single map without the netx type and the variant list.
+    tLayouts = atLayouts
+    if tArgs.strDefineMatrix is None:
+        tLayouts = dict(
+            (strNetxType, atMaps[0]) for strNetxType, atMaps in atLayouts.items()
+        )
+        if fMultipleTargets is not True:
+            tLayouts = tLayouts[astrNetxTypes[0]]
+    print(json.dumps(tLayouts, indent=2))
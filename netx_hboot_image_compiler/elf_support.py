@@ -22,7 +22,9 @@
 
 import os
 import re
+import struct
 import subprocess
+import tempfile
 
 # NOTE: this is only for debug.
 import datetime
@@ -289,6 +291,180 @@ def get_estimated_bin_size(atSegments):
     return ulBiggestOffset
 
 
+def get_binary(env, strFileName, astrSegmentsToDump=None):
+    # Extract the segments with objcopy to a temporary file.
+    tBinFile, strBinFileName = tempfile.mkstemp()
+    os.close(tBinFile)
+
+    aCmd = [env['OBJCOPY'], '--output-target=binary']
+    if astrSegmentsToDump is not None:
+        for strSegment in astrSegmentsToDump:
+            aCmd.append('--only-section=%s' % strSegment)
+    aCmd.append(strFileName)
+    aCmd.append(strBinFileName)
+
+    try:
+        subprocess.check_call(aCmd)
+    except Exception as e:
+        print("Failed to call external program:")
+        print(aCmd)
+        print(e)
+        os.remove(strBinFileName)
+        raise
+
+    # Get the application data.
+    tBinFile = open(strBinFileName, 'rb')
+    strData = tBinFile.read()
+    tBinFile.close()
+
+    # Remove the temp file.
+    os.remove(strBinFileName)
+
+    return strData
+
+
+def read_section_table(strFileName, astrSectionsToConsider=None):
+    # Read the section headers directly from the ELF file. The result has
+    # the same format as "get_segment_table", but no external tool is
+    # needed and the contents of the sections are not read.
+    tFile = open(strFileName, 'rb')
+    strIdent = tFile.read(16)
+    if (len(strIdent) != 16) or (strIdent[0:4] != b'\x7fELF'):
+        tFile.close()
+        raise Exception('The file "%s" is no ELF file.' % strFileName)
+
+    if strIdent[5] == 1:
+        strEndian = '<'
+    elif strIdent[5] == 2:
+        strEndian = '>'
+    else:
+        tFile.close()
+        raise Exception('Invalid data encoding in "%s".' % strFileName)
+
+    if strIdent[4] == 1:
+        strHeader = strEndian + 'HHIIIIIHHHHHH'
+        strSection = strEndian + 'IIIIIIIIII'
+        strProgram = strEndian + 'IIIIIIII'
+    elif strIdent[4] == 2:
+        strHeader = strEndian + 'HHIQQQIHHHHHH'
+        strSection = strEndian + 'IIQQQQIIQQ'
+        strProgram = strEndian + 'IIQQQQQQ'
+    else:
+        tFile.close()
+        raise Exception('Invalid ELF class in "%s".' % strFileName)
+
+    atHeader = struct.unpack(strHeader, tFile.read(struct.calcsize(strHeader)))
+    ulPhOff = atHeader[4]
+    ulShOff = atHeader[5]
+    uiPhEntSize = atHeader[8]
+    uiPhNum = atHeader[9]
+    uiShEntSize = atHeader[10]
+    uiShNum = atHeader[11]
+    uiShStrNdx = atHeader[12]
+
+    # Read all loadable program headers. They map the virtual addresses to
+    # the load addresses.
+    atLoad = []
+    for uiIndex in range(0, uiPhNum):
+        tFile.seek(ulPhOff + uiIndex * uiPhEntSize)
+        atProgram = struct.unpack(strProgram, tFile.read(struct.calcsize(strProgram)))
+        if strIdent[4] == 1:
+            ulType, ulOffset, ulVaddr, ulPaddr, ulFileSize, ulMemSize = atProgram[0:6]
+        else:
+            ulType = atProgram[0]
+            ulOffset, ulVaddr, ulPaddr, ulFileSize, ulMemSize = atProgram[2:7]
+        # Only PT_LOAD segments are interesting.
+        if ulType == 1:
+            atLoad.append((ulOffset, ulVaddr, ulPaddr, ulFileSize, ulMemSize))
+
+    # Read all section headers.
+    atRawSections = []
+    for uiIndex in range(0, uiShNum):
+        tFile.seek(ulShOff + uiIndex * uiShEntSize)
+        atRawSections.append(
+            struct.unpack(strSection, tFile.read(struct.calcsize(strSection)))
+        )
+
+    # Read the section names.
+    strNames = b''
+    if uiShStrNdx < len(atRawSections):
+        tFile.seek(atRawSections[uiShStrNdx][4])
+        strNames = tFile.read(atRawSections[uiShStrNdx][5])
+    tFile.close()
+
+    atSegments = []
+    for uiIndex, atSection in enumerate(atRawSections):
+        ulName, ulType, ulFlags, ulAddr, ulOffset, ulSize = atSection[0:6]
+        ulAlign = atSection[8]
+        # Skip the NULL section.
+        if ulType == 0:
+            continue
+        strName = strNames[ulName:strNames.index(b'\0', ulName)].decode('utf-8')
+        if (astrSectionsToConsider is not None) and (strName not in astrSectionsToConsider):
+            continue
+
+        # SHF_ALLOC is 0x2 and SHT_NOBITS is 8.
+        astrFlags = []
+        if ulType != 8:
+            astrFlags.append('CONTENTS')
+        if (ulFlags & 0x2) != 0:
+            astrFlags.append('ALLOC')
+            if ulType != 8:
+                astrFlags.append('LOAD')
+
+        # Get the load address from the segment with the section.
+        ulLma = ulAddr
+        if 'LOAD' in astrFlags:
+            for ulSegOffset, ulVaddr, ulPaddr, ulFileSize, ulMemSize in atLoad:
+                if(
+                    (ulAddr >= ulVaddr) and
+                    (ulAddr + ulSize <= ulVaddr + ulMemSize) and
+                    (ulOffset >= ulSegOffset) and
+                    (ulOffset + ulSize <= ulSegOffset + ulFileSize)
+                ):
+                    ulLma = ulAddr - ulVaddr + ulPaddr
+                    break
+
+        atSegments.append(dict({
+            'idx':      uiIndex - 1,
+            'name':     strName,
+            'size':     ulSize,
+            'vma':      ulAddr,
+            'lma':      ulLma,
+            'file_off': ulOffset,
+            'align':    ulAlign,
+            'flags':    astrFlags
+        }))
+    return atSegments
+
+
+def get_binary_extents(atSegments):
+    # Get the contents of a binary dump as a list of extents. Each extent
+    # has the offset in the binary, the size and the offset in the ELF file.
+    # The offset in the file is None for the gaps between the sections,
+    # which are filled with 0x00.
+    ulLoadAddress = get_load_address(atSegments)
+    atSections = []
+    for tSegment in atSegments:
+        if segment_is_loadable(tSegment) and (tSegment['size'] != 0):
+            atSections.append(tSegment)
+    atSections.sort(key=lambda tSegment: tSegment['lma'])
+
+    atExtents = []
+    ulOffset = 0
+    for tSegment in atSections:
+        ulSectionOffset = tSegment['lma'] - ulLoadAddress
+        if ulSectionOffset < ulOffset:
+            raise Exception(
+                'The section "%s" overlaps the previous one.' % tSegment['name']
+            )
+        if ulSectionOffset > ulOffset:
+            atExtents.append((ulOffset, ulSectionOffset - ulOffset, None))
+        atExtents.append((ulSectionOffset, tSegment['size'], tSegment['file_off']))
+        ulOffset = ulSectionOffset + tSegment['size']
+    return atExtents
+
+
 def get_exec_address(env, strElfFileName):
     # Get the start address.
     # Try the global symbol first, then fall back to the file header.
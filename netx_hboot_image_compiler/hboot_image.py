@@ -2,23 +2,33 @@
 
 import array
 import ast
-import base64
 import binascii
+import concurrent.futures
+import csv
+import functools
 import hashlib
+import io
+import json
 import math
 import os
 import os.path
 import re
 import string
+import struct
 import subprocess
 import tempfile
+import time
 import xml.dom.minidom
-import xml.etree.ElementTree
 
 from . import elf_support
+from . import image_template
+from . import key_cache
+from . import keyrom
 from . import option_compiler
 from . import patch_definitions
+from . import signer
 from . import snippet_library
+from . import xz_compressor
 
 
 class ResolveDefines(ast.NodeTransformer):
@@ -60,6 +70,11 @@ class HbootImage:
     # This is a list with all chunks.
     __atChunkData = None
 
+    # This is the hash over the chunk data. It is updated whenever a chunk
+    # is finished.
+    __tChunkHash = None
+    __sizChunkHashBytes = None
+
     # This is the environment.
     __tEnv = None
 
@@ -69,6 +84,10 @@ class HbootImage:
     # This is a dictionary of all resolved files.
     __atKnownFiles = None
 
+    # These are the contents of known files which only exist in memory. The
+    # key is the file ID without the "@".
+    __atKnownTexts = None
+
     # This is a dictionary of key/value pairs to do replacements with.
     __atGlobalDefines = None
 
@@ -91,7 +110,91 @@ class HbootImage:
     __IMAGE_TYPE_ALTERNATIVE = 5
     __sizHashDw = None
 
-    __XmlKeyromContents = None
+    __cKeyrom = None
+    __cKeyCache = None
+    __cSigner = None
+
+    # The image closes the signer only if it created it.
+    __fOwnsSigner = False
+
+    # This compresses the payload of DaXZ chunks.
+    __cXzCompressor = None
+
+    # This is the optional cache for the target independent work. It is
+    # shared by all images which compile the same definition.
+    __cSourceCache = None
+
+    # Signatures and hashes which are computed in the background leave a
+    # placeholder in the chunk. These are the patches for the placeholders.
+    __atChunkPatches = None
+    __atPendingPatches = None
+
+    # This is the optional thread pool for the hashes of large chunks.
+    __tHashPool = None
+    __uiHashThreads = None
+    __sizParallelHashMinimum = 1024 * 1024
+    __atHashStatistics = None
+
+    # This is the position of all chunks in the chunk data for the layout
+    # map.
+    __atLayoutChunks = None
+
+    # Large fill areas of "Skip" chunks are not part of the chunk data.
+    # They are kept as extents with an offset in the chunk data, a size and
+    # a fill value.
+    __atFillExtents = None
+    __sizFillExtents = None
+    __uiHashedFillExtents = None
+    __sizFillBlock = 64 * 1024
+
+    # ELF files with a larger binary are not extracted to memory. The
+    # contents of their sections are streamed from the file in blocks of
+    # __sizStreamBlock bytes.
+    __sizMemoryBudget = 0x20000000
+    __sizStreamBlock = 1024 * 1024
+
+    # These are the patch slots and the signatures and hash table entries
+    # which can depend on them. They are used to build an ImageTemplate.
+    __atTemplateSlots = None
+    __atTemplateHashTables = None
+    __atTemplateSignatures = None
+
+    # Write fill areas as normal data (None), as holes in the file ('holes')
+    # or as extents in an extent list ('extents').
+    __strSparseMode = None
+    __astrSparseModes = [None, 'holes', 'extents']
+
+    # A dry run only computes the layout. It does not read the payload
+    # data and leaves all hashes and signatures empty.
+    __fLayoutOnly = False
+
+    # Remove redundant writes from Register chunks.
+    __fOptimizeRegisters = False
+
+    # These are the registers of the register model with their default
+    # values. The key is the address. Only writes to these registers are
+    # merged or removed by the optimization, as they just hold a setting.
+    __atRegisterDefaults = None
+
+    # Expect the default values of the register model in the hardware before
+    # the first chunk and remove writes which do not change them. The model
+    # does not guarantee that the defaults are the reset values.
+    __fDropRegisterDefaults = False
+
+    # These chunks end with the truncated hash of the chunk.
+    __astrChunksWithTrailingHash = [
+        'OPTS',
+        'REGI',
+        'FRWL',
+        'DATA',
+        'TEXT',
+        'EXEC',
+        'EXA9',
+        'SPIM',
+        'MDUP',
+        'NEXT',
+        'DAXZ'
+    ]
     __cfg_openssl = 'openssl'
     __cfg_openssloptions = None
 
@@ -122,12 +225,23 @@ class HbootImage:
 
     def __init__(self, tEnv, strNetxType, **kwargs):
         strPatchDefinition = None
-        strKeyromFile = None
+        tKeyrom = None
+        strKeyCacheFolder = None
         astrIncludePaths = []
         astrSnippetSearchPaths = []
         atKnownFiles = {}
         atGlobalDefines = {}
         atOpensslOptions = []
+        cSigner = None
+        uiHashThreads = 0
+        strSparseMode = None
+        cSourceCache = None
+        strCompressCacheFolder = None
+        uiCompressThreads = None
+        sizMemoryBudget = None
+        fOptimizeRegisters = False
+        atRegisterDefaults = {}
+        fDropRegisterDefaults = False
         fVerbose = False
 
         # Parse the kwargs.
@@ -136,7 +250,10 @@ class HbootImage:
                 strPatchDefinition = tValue
 
             elif strKey == 'keyrom':
-                strKeyromFile = tValue
+                tKeyrom = tValue
+
+            elif strKey == 'keycache':
+                strKeyCacheFolder = tValue
 
             elif strKey == 'sniplibs':
                 if tValue is None:
@@ -169,11 +286,54 @@ class HbootImage:
             elif strKey == 'openssloptions':
                 atOpensslOptions = tValue
 
+            elif strKey == 'signer':
+                cSigner = tValue
+
+            elif strKey == 'hash_threads':
+                if tValue is not None:
+                    uiHashThreads = int(tValue)
+
+            elif strKey == 'sparse':
+                if tValue not in self.__astrSparseModes:
+                    raise Exception('Invalid sparse mode: "%s"' % tValue)
+                strSparseMode = tValue
+
+            elif strKey == 'source_cache':
+                cSourceCache = tValue
+
+            elif strKey == 'compress_cache':
+                strCompressCacheFolder = tValue
+
+            elif strKey == 'compress_threads':
+                if tValue is not None:
+                    uiCompressThreads = int(tValue)
+
+            elif strKey == 'memory_budget':
+                if tValue is not None:
+                    sizMemoryBudget = int(tValue)
+
+            elif strKey == 'optimize_registers':
+                fOptimizeRegisters = bool(tValue)
+
+            elif strKey == 'register_defaults':
+                if tValue is not None:
+                    atRegisterDefaults.update(tValue)
+
+            elif strKey == 'drop_register_defaults':
+                fDropRegisterDefaults = bool(tValue)
+
         # Set the default search path if nothing was specified.
         if len(astrSnippetSearchPaths) == 0:
             astrSnippetSearchPaths = ['sniplib']
 
         self.__fVerbose = fVerbose
+        self.__strSparseMode = strSparseMode
+        self.__cSourceCache = cSourceCache
+        self.__fOptimizeRegisters = fOptimizeRegisters
+        self.__atRegisterDefaults = atRegisterDefaults
+        self.__fDropRegisterDefaults = fDropRegisterDefaults
+        if sizMemoryBudget is not None:
+            self.__sizMemoryBudget = sizMemoryBudget
 
         # Do not override anything in the pre-calculated header yet.
         self.__atHeaderOverride = [None] * 16
@@ -189,6 +349,7 @@ class HbootImage:
 
         # Set the known files.
         self.__atKnownFiles = atKnownFiles
+        self.__atKnownTexts = {}
 
         # Set the defines.
         self.__atGlobalDefines = atGlobalDefines
@@ -201,7 +362,7 @@ class HbootImage:
             print('[HBootImage] Configuration: patch definitions = "%s"' %
                   strPatchDefinition)
             print('[HBootImage] Configuration: Keyrom = "%s"' %
-                  str(strKeyromFile))
+                  str(tKeyrom))
 
             if len(astrSnippetSearchPaths) == 0:
                 print('[HBootImage] Configuration: No Sniplibs.')
@@ -270,16 +431,42 @@ class HbootImage:
         # Initialize the include paths from the environment.
         self.__astrIncludePaths = astrIncludePaths
 
-        # Read the keyrom file if specified.
-        if strKeyromFile is not None:
+        # The decoded keys are shared by all images in this process. The
+        # optional folder keeps the public parts across runs.
+        self.__cKeyCache = key_cache.KeyCache(strKeyCacheFolder)
+
+        # Read the keyrom file if specified. This can also be an already
+        # loaded keyrom, which is shared with other images.
+        if tKeyrom is not None:
+            self.__cKeyrom = keyrom.load_keyrom(tKeyrom, self.__cKeyCache)
             if self.__fVerbose:
-                print('[HBootImage] Init: Reading key ROM file "%s".' %
-                      strKeyromFile)
-            # Parse the XML file.
-            tFile = open(strKeyromFile, 'rt')
-            strXml = tFile.read()
-            tFile.close()
-            self.__XmlKeyromContents = xml.etree.ElementTree.fromstring(strXml)
+                print('[HBootImage] Init: Using key ROM file "%s".' %
+                      self.__cKeyrom.get_file_name())
+
+        # Sign with OpenSSL if no other backend was specified.
+        if cSigner is None:
+            cSigner = signer.OpenSslSigner(
+                self.__cfg_openssl,
+                atOpensslOptions
+            )
+            self.__fOwnsSigner = True
+        self.__cSigner = cSigner
+        self.__atChunkPatches = {}
+        self.__atPendingPatches = []
+
+        # Hash large chunks in parallel if requested.
+        self.__uiHashThreads = uiHashThreads
+        if uiHashThreads > 1:
+            self.__tHashPool = concurrent.futures.ThreadPoolExecutor(
+                uiHashThreads
+            )
+
+        # Compressed payloads are cached in the process and optionally in
+        # a folder.
+        self.__cXzCompressor = xz_compressor.XzCompressor(
+            strCompressCacheFolder,
+            uiCompressThreads
+        )
 
         self.__resolver = ResolveDefines()
 
@@ -318,6 +505,20 @@ class HbootImage:
         atReplace,
         fIsStandalone
     ):
+        # Images with other defines may have parsed the same text already.
+        # The key contains only the defines which are used in the text.
+        tCacheKey = None
+        if self.__cSourceCache is not None:
+            tCacheKey = self.__cSourceCache.get_fragment_key(
+                strPlaintext,
+                atReplace,
+                fIsStandalone
+            )
+            if tCacheKey is not None:
+                tResult = self.__cSourceCache.get_fragment(tCacheKey)
+                if tResult is not None:
+                    return tResult
+
         # Set all key/value pairs in the local resolver.
         self.__resolver.setDefines(atReplace)
 
@@ -335,6 +536,9 @@ class HbootImage:
                 strText
             )
             tResult = tXml.documentElement
+
+        if tCacheKey is not None:
+            self.__cSourceCache.add_fragment(tCacheKey, tResult)
         return tResult
 
     def __preprocess_snip(self, tSnipNode):
@@ -470,16 +674,28 @@ class HbootImage:
                     raise Exception('Include failed: unknown tag "%s" '
                                     'found!' % strTag)
 
-        # Search the file in the current path and all include paths.
-        strAbsIncludeName = self.__find_file(strIncludeName)
-        if strAbsIncludeName is None:
-            raise Exception('Failed to include file "%s": file not found.' %
-                            strIncludeName)
+        # Known files in memory are used before all other files.
+        strAbsIncludeName = None
+        strFileContents = None
+        if strIncludeName[0] == '@':
+            strFileContents = self.__atKnownTexts.get(strIncludeName[1:])
 
-        # Read the complete file as text.
-        tFile = open(strAbsIncludeName, 'rt')
-        strFileContents = tFile.read()
-        tFile.close()
+        if strFileContents is None:
+            # Search the file in the current path and all include paths.
+            strAbsIncludeName = self.__find_file(strIncludeName)
+            if strAbsIncludeName is None:
+                raise Exception('Failed to include file "%s": file not found.' %
+                                strIncludeName)
+
+            # Read the complete file as text.
+            if self.__cSourceCache is None:
+                tFile = open(strAbsIncludeName, 'rt')
+                strFileContents = tFile.read()
+                tFile.close()
+            else:
+                strFileContents = self.__cSourceCache.get_text_contents(
+                    strAbsIncludeName
+                )
 
         # Replace and convert to XML.
         atReplace = {}
@@ -492,7 +708,7 @@ class HbootImage:
         )
 
         # Add the include file to the dependencies.
-        if strAbsIncludeName not in self.__astrDependencies:
+        if (strAbsIncludeName is not None) and (strAbsIncludeName not in self.__astrDependencies):
             self.__astrDependencies.append(strAbsIncludeName)
 
         # Get the parent node of the "Include" node.
@@ -507,6 +723,10 @@ class HbootImage:
         tParentNode.removeChild(tIncludeNode)
 
     def __preprocess(self, tXmlDocument):
+        self.__preprocess_netx_type(tXmlDocument)
+        self.__preprocess_directives(tXmlDocument)
+
+    def __preprocess_netx_type(self, tXmlDocument):
         if self.__strNetxType == 'NETX90_MPW':
             # The netX90 MPW does not have a 'StartAPP' function yet.
             # Replace it with a snippet.
@@ -528,6 +748,7 @@ class HbootImage:
                 # Remove the old "StartAPP" node.
                 tParentNode.removeChild(tReplaceNode)
 
+    def __preprocess_directives(self, tXmlDocument):
         # Look for all 'Snip' nodes repeatedly until the maximum count is
         # reached or no more 'Snip' nodes are found.
         uiMaximumDepth = 100
@@ -605,7 +826,7 @@ class HbootImage:
         aBootBlock[2] = ulFlashOffset
 
 
-    def __build_standard_header(self, atChunks):
+    def __build_standard_header(self):
 
         ulMagicCookie = None
         ulSignature = None
@@ -643,10 +864,15 @@ class HbootImage:
                 'configured, please update the HBOOT image compiler.'
             )
 
-        # Get the hash for the image.
-        tHash = hashlib.sha224()
-        tHash.update(atChunks.tobytes())
-        aulHash = array.array('I', tHash.digest())
+        # Get the hash for the image. The chunk data is already hashed, only
+        # the end marker is missing.
+        if self.__tChunkHash is None:
+            # A dry run has no hash.
+            aulHash = array.array('I', [0] * 7)
+        else:
+            tHash = self.__tChunkHash.copy()
+            tHash.update(bytes(4))
+            aulHash = array.array('I', tHash.digest())
 
         # Get the parameter0 value.
         # For now only the lower 4 bits are defined. They set the number of
@@ -659,7 +885,7 @@ class HbootImage:
         aBootBlock[0x01] = 0                    # reserved
         aBootBlock[0x02] = 0                    # reserved
         aBootBlock[0x03] = 0                    # reserved
-        aBootBlock[0x04] = len(atChunks)        # chunks dword size
+        aBootBlock[0x04] = self.__get_chunk_data_size() // 4 + 1  # chunks dword size
         aBootBlock[0x05] = 0                    # reserved
         aBootBlock[0x06] = ulSignature          # The image signature.
         aBootBlock[0x07] = ulParameter0         # Image parameters.
@@ -869,7 +1095,7 @@ class HbootImage:
 
                 # Get the hash for the chunk.
                 tHash = hashlib.sha384()
-                tHash.update(atChunk.tobytes())
+                tHash.update(atChunk)
                 strHash = tHash.digest()
                 aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
                 atChunk.extend(aulHash)
@@ -893,7 +1119,7 @@ class HbootImage:
 
                 # Get the hash for the chunk.
                 tHash = hashlib.sha384()
-                tHash.update(atChunk.tobytes())
+                tHash.update(atChunk)
                 strHash = tHash.digest()
                 aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
                 atChunk.extend(aulHash)
@@ -908,7 +1134,7 @@ class HbootImage:
         tChunkAttributes['atData'] = atChunk
         tChunkAttributes['aulHash'] = array.array('I', strHash)
 
-    def __get_data_contents_elf(self, tNode, strAbsFilePath, fWantLoadAddress):
+    def __get_data_contents_elf(self, tNode, strAbsFilePath, fWantLoadAddress, fNeedsPayload=False, fAllowExtents=False):
         # Get the segment names to dump. It is a comma separated string.
         # This is optional. If no segment names are specified, all sections
         # with PROGBITS are dumped.
@@ -921,17 +1147,30 @@ class HbootImage:
             ]
 
         # Extract the segments.
-        atSegments = elf_support.get_segment_table(
-            self.__tEnv,
-            strAbsFilePath,
-            astrSegmentsToDump
-        )
+        if self.__cSourceCache is None:
+            atSegments = elf_support.read_section_table(
+                strAbsFilePath,
+                astrSegmentsToDump
+            )
+        else:
+            atSegments = self.__cSourceCache.get_elf_segment_table(
+                self.__tEnv,
+                strAbsFilePath,
+                astrSegmentsToDump
+            )
         # Get the estimated binary size from the segments.
         ulEstimatedBinSize = elf_support.get_estimated_bin_size(atSegments)
-        # Do not create files larger than 512MB.
-        if ulEstimatedBinSize >= 0x20000000:
-            raise Exception('The resulting file seems to extend '
-                            '512MBytes. Too scared to continue!')
+        # Binaries above the memory budget are only streamed from the file.
+        fStream = ulEstimatedBinSize >= self.__sizMemoryBudget
+        if (fStream is True) and (fAllowExtents is not True):
+            raise Exception(
+                'The binary of "%s" has %d bytes. This exceeds the memory '
+                'budget of %d bytes and can not be streamed here.' % (
+                    strAbsFilePath,
+                    ulEstimatedBinSize,
+                    self.__sizMemoryBudget
+                )
+            )
 
         if fWantLoadAddress is True:
             strOverwriteAddress = tNode.getAttribute(
@@ -944,40 +1183,63 @@ class HbootImage:
         else:
             pulLoadAddress = None
 
-        # Extract the binary.
-        tBinFile, strBinFileName = tempfile.mkstemp()
-        os.close(tBinFile)
+        # Return a list of extents instead of the data if the binary is
+        # streamed. The extents have no offset yet.
+        if fStream is True:
+            atExtents = []
+            for ulOffset, sizExtent, ulFileOffset in elf_support.get_binary_extents(atSegments):
+                if ulFileOffset is None:
+                    atExtents.append({
+                        'sizFill': sizExtent,
+                        'ucFill': 0x00
+                    })
+                else:
+                    atExtents.append({
+                        'sizFill': sizExtent,
+                        'ucFill': None,
+                        'strFile': strAbsFilePath,
+                        'ulFileOffset': ulFileOffset
+                    })
+            return atExtents, pulLoadAddress
+
+        # A dry run only needs the size from the section headers. The layout
+        # reserves it with a fill extent. Chunks without extents are below
+        # the memory budget and get a placeholder.
+        if (self.__fLayoutOnly is True) and (fNeedsPayload is not True):
+            if fAllowExtents is True:
+                return [{
+                    'sizFill': ulEstimatedBinSize,
+                    'ucFill': 0x00
+                }], pulLoadAddress
+            return bytes(ulEstimatedBinSize), pulLoadAddress
 
-        astrCmd = [
-            self.__tEnv['OBJCOPY'],
-            '--output-target=binary'
-        ]
-        if astrSegmentsToDump is not None:
-            for strSegment in astrSegmentsToDump:
-                astrCmd.append('--only-section=%s' % strSegment)
-        astrCmd.append(strAbsFilePath)
-        astrCmd.append(strBinFileName)
-        #subprocess.check_call(astrCmd)
-
-        try:
-            subprocess.check_call(astrCmd)
-        except Exception as e:
-            print("Failed to call external program:")
-            print(astrCmd)
-            print(e)
-            raise
-
-
-        # Get the application data.
-        tBinFile = open(strBinFileName, 'rb')
-        strData = tBinFile.read()
-        tBinFile.close()
-
-        # Remove the temp file.
-        os.remove(strBinFileName)
+        # Extract the binary.
+        if self.__cSourceCache is None:
+            strData = elf_support.get_binary(
+                self.__tEnv,
+                strAbsFilePath,
+                astrSegmentsToDump
+            )
+        else:
+            strData = self.__cSourceCache.get_elf_binary(
+                self.__tEnv,
+                strAbsFilePath,
+                astrSegmentsToDump
+            )
 
         return strData, pulLoadAddress
 
+    def __read_data_file(self, strAbsFilePath):
+        # Read the complete file. Images for several netX types share the
+        # contents.
+        if self.__cSourceCache is None:
+            tBinFile = open(strAbsFilePath, 'rb')
+            strData = tBinFile.read()
+            tBinFile.close()
+        else:
+            strData = self.__cSourceCache.get_file_contents(strAbsFilePath)
+        return strData
+
     def __get_data_contents_key(self, tKeyNode):
         strData = None
 
@@ -1198,6 +1460,86 @@ class HbootImage:
 
         aulCmds.extend(aulData)
 
+    # Remove redundant writes from the intermediate representation of a
+    # Register chunk.
+    # Only the registers in atValues are optimized. These are the registers
+    # of the register model which just hold a setting. All other addresses
+    # can have side effects, e.g. a sequence which sets and clears a bit.
+    # Adjacent "set" and "setmask" commands for the same register are merged
+    # to one command. A "setmask" takes the bits in "mask" from "value" and
+    # keeps all other bits. The value of the registers is tracked over
+    # consecutive Register chunks and writes which do not change a known
+    # value are removed. A "copy", "copymask" or "poll" makes the value
+    # unknown.
+    # The order of the commands is never changed, as the order of the
+    # accesses matters for the hardware.
+    def __optimize_register_commands(self, atCmd, atValues):
+        astrWrites = ['set', 'setmask']
+        atResult = []
+        for tCmd in atCmd:
+            strName = tCmd['name']
+            if (strName in astrWrites) and (tCmd['address'] in atValues):
+                ulAddress = tCmd['address']
+                if strName == 'set':
+                    ulMask = 0xffffffff
+                else:
+                    ulMask = tCmd['mask']
+                ulValue = tCmd['value'] & ulMask
+
+                # Skip the write if it does not change the known value.
+                ulKnownValue = atValues.get(ulAddress)
+                if (ulKnownValue is not None) and ((ulKnownValue & ulMask) == ulValue):
+                    continue
+                if ulKnownValue is not None:
+                    atValues[ulAddress] = (ulKnownValue & ~ulMask) | ulValue
+                elif strName == 'set':
+                    atValues[ulAddress] = ulValue
+
+                # Merge the write with a write to the same address before.
+                tLast = None
+                if len(atResult) != 0:
+                    tLast = atResult[-1]
+                if (
+                    (tLast is not None) and
+                    (tLast['name'] in astrWrites) and
+                    (tLast['address'] == ulAddress) and
+                    (tLast['unlock'] == tCmd['unlock'])
+                ):
+                    if (tLast['name'] == 'set') or (strName == 'set'):
+                        if strName == 'set':
+                            ulNewValue = ulValue
+                        else:
+                            ulNewValue = (tLast['value'] & ~ulMask) | ulValue
+                        atResult[-1] = {
+                            'name': 'set',
+                            'address': ulAddress,
+                            'value': ulNewValue,
+                            'unlock': tCmd['unlock']
+                        }
+                    else:
+                        atResult[-1] = {
+                            'name': 'setmask',
+                            'address': ulAddress,
+                            'mask': tLast['mask'] | ulMask,
+                            'value': (tLast['value'] & tLast['mask'] & ~ulMask) | ulValue,
+                            'unlock': tCmd['unlock']
+                        }
+                else:
+                    atResult.append(dict(tCmd))
+
+            else:
+                if strName in ['copy', 'copymask']:
+                    ulAddress = tCmd['dest']
+                elif strName == 'poll':
+                    ulAddress = tCmd['address']
+                else:
+                    ulAddress = None
+                if ulAddress in atValues:
+                    atValues[ulAddress] = None
+                atResult.append(tCmd)
+
+        return atResult
+
     # Construct a chunk out of chunk data, adding chunk ID, size and hash.
     def __wrap_chunk(self, tChunkAttributes, ulTagId, aulData):
         # Build the chunk.
@@ -1208,7 +1550,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -1228,6 +1570,42 @@ class HbootImage:
         aulData = array.array('I')
         self.__serialize_register_chunk(atCmd, aulData)
 
+        if self.__fOptimizeRegisters is True:
+            # The known register values are shared by all Register chunks.
+            # All other chunks can change registers, e.g. Firewall or
+            # MemoryDeviceUp. The values are unknown after them. The default
+            # values are only used if no chunk runs before the first
+            # Register chunk.
+            if 'atRegisterValues' not in atParserState:
+                if (self.__fDropRegisterDefaults is True) and (uiChunkIndex == 0):
+                    atParserState['atRegisterValues'] = dict(self.__atRegisterDefaults)
+                else:
+                    atParserState['atRegisterValues'] = dict.fromkeys(self.__atRegisterDefaults)
+            elif atParserState['uiLastRegisterChunk'] != (uiChunkIndex - 1):
+                atRegisterValues = atParserState['atRegisterValues']
+                for ulAddress in atRegisterValues:
+                    atRegisterValues[ulAddress] = None
+            atParserState['uiLastRegisterChunk'] = uiChunkIndex
+            atOptimizedCmd = self.__optimize_register_commands(
+                atCmd,
+                atParserState['atRegisterValues']
+            )
+            aulOptimizedData = array.array('I')
+            self.__serialize_register_chunk(atOptimizedCmd, aulOptimizedData)
+            print(
+                '[HBootImage] Register chunk %d: %d commands in %d words, '
+                '%d commands in %d words after the optimization. Saved %d '
+                'words.' % (
+                    uiChunkIndex,
+                    len(atCmd),
+                    len(aulData),
+                    len(atOptimizedCmd),
+                    len(aulOptimizedData),
+                    len(aulData) - len(aulOptimizedData)
+                )
+            )
+            aulData = aulOptimizedData
+
         # Build the chunk
         ulTagId = self.__get_tag_id('R', 'E', 'G', 'I')
         self.__wrap_chunk(tChunkAttributes, ulTagId, aulData)
@@ -1260,14 +1638,43 @@ class HbootImage:
         self.__wrap_chunk(tChunkAttributes, ulTagId, aulData)
 
 
+    def __add_data_slot(self, tNode, strType, ulOffset, sizData, atSlots):
+        # A node with a "slot" attribute can be patched in an image template.
+        strSlot = tNode.getAttribute('slot')
+        if len(strSlot) != 0:
+            if atSlots is None:
+                raise Exception(
+                    'The slot "%s" is not allowed in this chunk.' % strSlot
+                )
+            atSlots.append({
+                'strName': strSlot,
+                'ulOffset': ulOffset,
+                'sizData': sizData,
+                'strType': strType
+            })
+
     def __get_data_contents(self, tDataNode, atData, fWantLoadAddress):
         strData = None
         pulLoadAddress = None
+        # Only some chunks support patch slots.
+        atSlotsData = atData.get('atSlots')
+        atSlots = None
+        # The size of compressed data depends on the payload. A dry run must
+        # read it.
+        fNeedsPayload = atData.get('fNeedsPayload', False)
+        # Only some chunks can stream large ELF files.
+        fAllowExtents = atData.get('fAllowExtents', False)
+        atExtents = None
 
         # Loop over all child nodes.
         for tNode in tDataNode.childNodes:
             # Is this a node element?
             if tNode.nodeType == tNode.ELEMENT_NODE:
+                # Only the slots of the last data node are used.
+                if atSlotsData is not None:
+                    atSlots = []
+                atExtents = None
+
                 # Is this a "File" node?
                 if tNode.localName == 'File':
                     # Get the file name.
@@ -1289,8 +1696,13 @@ class HbootImage:
                         strData, pulLoadAddress = self.__get_data_contents_elf(
                             tNode,
                             strAbsFilePath,
-                            True
+                            True,
+                            fNeedsPayload,
+                            fAllowExtents
                         )
+                        if isinstance(strData, list):
+                            atExtents = strData
+                            strData = bytes()
 
                     elif strExtension == '.bin':
                         if fWantLoadAddress is True:
@@ -1305,9 +1717,20 @@ class HbootImage:
                                 strLoadAddress
                             )
 
-                        tBinFile = open(strAbsFilePath, 'rb')
-                        strData = tBinFile.read()
-                        tBinFile.close()
+                        if (self.__fLayoutOnly is True) and (fNeedsPayload is not True):
+                            # A dry run only needs the size of the file.
+                            # The layout reserves it with a fill extent.
+                            sizFile = os.path.getsize(strAbsFilePath)
+                            if fAllowExtents is True:
+                                atExtents = [{
+                                    'sizFill': sizFile,
+                                    'ucFill': 0x00
+                                }]
+                                strData = bytes()
+                            else:
+                                strData = bytes(sizFile)
+                        else:
+                            strData = self.__read_data_file(strAbsFilePath)
 
                     else:
                         raise Exception('The File node points to a file with '
@@ -1333,6 +1756,7 @@ class HbootImage:
 
                     strDataHex = self.__remove_all_whitespace(strDataHex)
                     strData = binascii.unhexlify(strDataHex)
+                    self.__add_data_slot(tNode, 'Hex', 0, len(strData), atSlots)
 
                 elif tNode.localName == 'UInt32':
                     if fWantLoadAddress is True:
@@ -1360,6 +1784,7 @@ class HbootImage:
                         aulNumbers.append(ulNum)
 
                     strData = aulNumbers.tobytes()
+                    self.__add_data_slot(tNode, 'UInt32', 0, len(strData), atSlots)
 
                 elif tNode.localName == 'UInt16':
                     if fWantLoadAddress is True:
@@ -1387,6 +1812,7 @@ class HbootImage:
                         ausNumbers.append(usNum)
 
                     strData = ausNumbers.tobytes()
+                    self.__add_data_slot(tNode, 'UInt16', 0, len(strData), atSlots)
 
                 elif tNode.localName == 'UInt8':
                     if fWantLoadAddress is True:
@@ -1414,6 +1840,7 @@ class HbootImage:
                         aucNumbers.append(ucNum)
 
                     strData = aucNumbers.tobytes()
+                    self.__add_data_slot(tNode, 'UInt8', 0, len(strData), atSlots)
 
                 elif tNode.localName == 'Key':
                     if fWantLoadAddress is True:
@@ -1461,6 +1888,13 @@ class HbootImage:
                                     strDataHex
                                 )
                                 strDataChunk = binascii.unhexlify(strDataHex)
+                                self.__add_data_slot(
+                                    tConcatNode,
+                                    'Hex',
+                                    sum(len(strPart) for strPart in astrData),
+                                    len(strDataChunk),
+                                    atSlots
+                                )
                                 astrData.append(strDataChunk)
 
                             elif tConcatNode.localName == 'String':
@@ -1494,6 +1928,13 @@ class HbootImage:
                                     aulNumbers.append(ulNum)
 
                                 strDataChunk = aulNumbers.tobytes()
+                                self.__add_data_slot(
+                                    tConcatNode,
+                                    'UInt32',
+                                    sum(len(strPart) for strPart in astrData),
+                                    len(strDataChunk),
+                                    atSlots
+                                )
                                 astrData.append(strDataChunk)
 
                             elif tConcatNode.localName == 'UInt16':
@@ -1515,6 +1956,13 @@ class HbootImage:
                                     ausNumbers.append(usNum)
 
                                 strDataChunk = ausNumbers.tobytes()
+                                self.__add_data_slot(
+                                    tConcatNode,
+                                    'UInt16',
+                                    sum(len(strPart) for strPart in astrData),
+                                    len(strDataChunk),
+                                    atSlots
+                                )
                                 astrData.append(strDataChunk)
 
                             elif tConcatNode.localName == 'UInt8':
@@ -1536,6 +1984,13 @@ class HbootImage:
                                     aucNumbers.append(ucNum)
 
                                 strDataChunk = aucNumbers.tobytes()
+                                self.__add_data_slot(
+                                    tConcatNode,
+                                    'UInt8',
+                                    sum(len(strPart) for strPart in astrData),
+                                    len(strDataChunk),
+                                    atSlots
+                                )
                                 astrData.append(strDataChunk)
 
                             elif tConcatNode.localName == 'Key':
@@ -1560,56 +2015,108 @@ class HbootImage:
             raise Exception('No load address specified!')
 
         atData['data'] = strData
+        if atExtents is not None:
+            atData['atExtents'] = atExtents
         if fWantLoadAddress is True:
             atData['load_address'] = pulLoadAddress
+        if atSlots is not None:
+            atSlotsData.extend(atSlots)
+
+    def __get_payload(self, tChunkAttributes, atData, ulOffsetInChunk):
+        # Get the data padded to a multiple of DWORDs as an array. Streamed
+        # data is not in the array. It is set as extents of the chunk at
+        # ulOffsetInChunk. Returns the array and the size in DWORDs.
+        atExtents = atData.get('atExtents')
+        aulData = array.array('I')
+        tChunkAttributes['atExtents'] = []
+        if atExtents is None:
+            strData = atData['data']
+            strPadding = bytes((4 - (len(strData) % 4)) & 3)
+            aulData.frombytes(strData + strPadding)
+            sizPayloadDw = len(aulData)
+
+        else:
+            sizData = 0
+            for tExtent in atExtents:
+                tExtent = dict(tExtent)
+                tExtent['ulOffset'] = ulOffsetInChunk
+                tChunkAttributes['atExtents'].append(tExtent)
+                sizData += tExtent['sizFill']
+            sizPadding = (4 - (sizData % 4)) & 3
+            if sizPadding != 0:
+                tChunkAttributes['atExtents'].append({
+                    'ulOffset': ulOffsetInChunk,
+                    'sizFill': sizPadding,
+                    'ucFill': 0x00
+                })
+            sizPayloadDw = (sizData + sizPadding) // 4
+
+        return aulData, sizPayloadDw
+
+    def __get_extents_size(self, atExtents):
+        sizExtents = 0
+        for tExtent in atExtents:
+            sizExtents += tExtent['sizFill']
+        return sizExtents
+
+    def __add_chunk_slots(self, tChunkAttributes, atSlots, ulOffsetInChunk):
+        # Move the slots from the data to the position in the chunk.
+        for atSlot in atSlots:
+            atSlot = dict(atSlot)
+            atSlot['ulOffset'] += ulOffsetInChunk
+            tChunkAttributes['atSlots'].append(atSlot)
 
     def __build_chunk_data(self, tChunkAttributes, atParserState, uiChunkIndex, atAllChunks):
         tChunkNode = tChunkAttributes['tNode']
 
-        # Get the data block.
-        atData = {}
+        fIsInfoPage = (
+            (self.__tImageType == self.__IMAGE_TYPE_COM_INFO_PAGE) or
+            (self.__tImageType == self.__IMAGE_TYPE_APP_INFO_PAGE)
+        )
+
+        # Get the data block. Large ELF files are streamed. This is not
+        # possible for info pages.
+        atData = {'atSlots': [], 'fAllowExtents': not fIsInfoPage}
         self.__get_data_contents(tChunkNode, atData, True)
-        strData = atData['data']
         pulLoadAddress = atData['load_address']
 
-        # Pad the application size to a multiple of DWORDs.
-        strPadding = bytes((4 - (len(strData) % 4)) & 3)
-        strChunk = strData + strPadding
-
-        # Convert the padded data to an array.
-        aulData = array.array('I')
-        aulData.frombytes(strChunk)
+        # Pad the application size to a multiple of DWORDs. The data starts
+        # after the ID, the size and the load address.
+        aulData, sizDataDw = self.__get_payload(tChunkAttributes, atData, 12)
 
         aulChunk = array.array('I')
         # Do not add an ID for info page images.
-        if(
-            (self.__tImageType != self.__IMAGE_TYPE_COM_INFO_PAGE) and
-            (self.__tImageType != self.__IMAGE_TYPE_APP_INFO_PAGE)
-        ):
+        if fIsInfoPage is not True:
             aulChunk.append(self.__get_tag_id('D', 'A', 'T', 'A'))
-            aulChunk.append(len(aulData) + 1 + self.__sizHashDw)
+            aulChunk.append(sizDataDw + 1 + self.__sizHashDw)
             aulChunk.append(pulLoadAddress)
             aulChunk.extend(aulData)
 
-            # Get the hash for the chunk.
-            tHash = hashlib.sha384()
-            tHash.update(aulChunk.tobytes())
-            strHash = tHash.digest()
-            aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
-            aulChunk.extend(aulHash)
+            # Append the hash for the chunk.
+            self.__append_chunk_hash(tChunkAttributes, uiChunkIndex, aulChunk)
+            tChunkAttributes['ulLoadAddress'] = pulLoadAddress
+            tChunkAttributes['fHasTrailingHash'] = True
+
+            # The data starts after the ID, the size and the load address.
+            self.__add_chunk_slots(tChunkAttributes, atData['atSlots'], 12)
 
         else:
             # The info pages only get the data.
             aulChunk = aulData
 
             # Get the hash for the chunk.
-            tHash = hashlib.sha384()
-            tHash.update(aulChunk.tobytes())
-            strHash = tHash.digest()
+            if self.__fLayoutOnly is True:
+                tChunkAttributes['aulHash'] = array.array('I', [0] * 12)
+            else:
+                tHash = hashlib.sha384()
+                tHash.update(aulChunk)
+                strHash = tHash.digest()
+                tChunkAttributes['aulHash'] = array.array('I', strHash)
+
+            self.__add_chunk_slots(tChunkAttributes, atData['atSlots'], 0)
 
         tChunkAttributes['fIsFinished'] = True
         tChunkAttributes['atData'] = aulChunk
-        tChunkAttributes['aulHash'] = array.array('I', strHash)
 
     def __build_chunk_text(self, tChunkAttributes, atParserState, uiChunkIndex, atAllChunks):
         tChunkNode = tChunkAttributes['tNode']
@@ -1630,24 +2137,18 @@ class HbootImage:
         aulChunk.append(len(aulData) + self.__sizHashDw)
         aulChunk.extend(aulData)
 
-        # Get the hash for the chunk.
-        tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
-        strHash = tHash.digest()
-        aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
-        aulChunk.extend(aulHash)
+        # Append the hash for the chunk.
+        self.__append_chunk_hash(tChunkAttributes, uiChunkIndex, aulChunk)
 
         tChunkAttributes['fIsFinished'] = True
         tChunkAttributes['atData'] = aulChunk
-        tChunkAttributes['aulHash'] = array.array('I', strHash)
 
     def __build_chunk_xip(self, tChunkAttributes, atParserState, uiChunkIndex, atAllChunks):
         tChunkNode = tChunkAttributes['tNode']
 
-        # Get the data block.
-        atData = {}
+        # Get the data block. Large ELF files are streamed.
+        atData = {'fAllowExtents': True}
         self.__get_data_contents(tChunkNode, atData, True)
-        strData = atData['data']
         pulLoadAddress = atData['load_address']
 
         # Get the available XIP areas for the current platform.
@@ -1740,28 +2241,19 @@ class HbootImage:
 
         # The load address must be exactly the address where the code starts.
         # Pad the application size to a multiple of DWORDs.
-        strPadding = bytes((4 - (len(strData) % 4)) & 3)
-        strChunk = strData + strPadding
-
-        # Convert the padded data to an array.
-        aulData = array.array('I')
-        aulData.frombytes(strChunk)
+        aulData, sizDataDw = self.__get_payload(tChunkAttributes, atData, 8)
 
         aulChunk = array.array('I')
         aulChunk.append(self.__get_tag_id('T', 'E', 'X', 'T'))
-        aulChunk.append(len(aulData) + self.__sizHashDw)
+        aulChunk.append(sizDataDw + self.__sizHashDw)
         aulChunk.extend(aulData)
 
-        # Get the hash for the chunk.
-        tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
-        strHash = tHash.digest()
-        aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
-        aulChunk.extend(aulHash)
+        # Append the hash for the chunk.
+        self.__append_chunk_hash(tChunkAttributes, uiChunkIndex, aulChunk)
 
         tChunkAttributes['fIsFinished'] = True
         tChunkAttributes['atData'] = aulChunk
-        tChunkAttributes['aulHash'] = array.array('I', strHash)
+        tChunkAttributes['ulLoadAddress'] = pulLoadAddress
 
     def __get_execute_data(self, tExecuteNode, atData):
         pfnExecFunction = None
@@ -1937,7 +2429,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -2004,7 +2496,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -2051,7 +2543,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -2197,7 +2689,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -2210,8 +2702,9 @@ class HbootImage:
         aulChunk, ucFill, sizSkip, strAbsFilePath, tNodeFile =\
             self.__build_chunk_skip_header(tChunkAttributes, atParserState)
 
-        # Append the placeholder for the skip area.
-        if strAbsFilePath is not None:
+        # Append the placeholder for the skip area. A dry run does not read
+        # the file and uses a fill extent for the complete area.
+        if (strAbsFilePath is not None) and (self.__fLayoutOnly is not True):
             # sizSkip is the numbers of DWORDS to skip. Convert it to bytes.
             sizSkipBytes = sizSkip * 4
 
@@ -2228,27 +2721,35 @@ class HbootImage:
                 if len(strFillData) > sizSkipBytes:
                     strFillData = strFillData[:sizSkipBytes]
 
+            elif self.__cSourceCache is not None:
+                # Use at most sizSkipBytes from the file.
+                strFillData = self.__cSourceCache.get_file_contents(
+                    strAbsFilePath
+                )[:sizSkipBytes]
+
             else:
                 # Read at most sizSkipBytes from the file.
                 tFile = open(strAbsFilePath, 'rb')
                 strFillData = tFile.read(sizSkipBytes)
                 tFile.close()
 
-            # Fill up to the requested size.
+            # Fill up to the next DWORD. The rest of the area is a fill
+            # extent.
             sizFillData = len(strFillData)
-            if sizFillData < sizSkipBytes:
-                strFillData += chr(ucFill) * (sizSkipBytes - sizFillData)
+            strFillData += bytes([ucFill]) * ((4 - (sizFillData % 4)) & 3)
 
             # Append the contents to the chunk.
             aulChunk.frombytes(strFillData)
+            sizFill = sizSkipBytes - len(strFillData)
 
         else:
-            # Repeat the fill byte in all 4 bytes of a 32 bit value.
-            ulFill = ucFill + 256 * ucFill + 65536 * ucFill + 16777216 * ucFill
-            aulChunk.extend([ulFill] * sizSkip)
+            # The complete area is a fill extent.
+            sizFill = sizSkip * 4
 
         tChunkAttributes['fIsFinished'] = True
         tChunkAttributes['atData'] = aulChunk
+        tChunkAttributes['sizFill'] = sizFill
+        tChunkAttributes['ucFill'] = ucFill
 
     def __build_chunk_skip_incomplete(self, tChunkAttributes, atParserState, uiChunkIndex, atAllChunks):
         # This chunk is not allowed for images with an end marker.
@@ -2272,291 +2773,212 @@ class HbootImage:
             strData = strData.replace(strWhitespace, '')
         return strData
 
-    # This function gets a data block from the OpenSSL output.
-    def __openssl_get_data_block(self, strStdout, strID):
-        aucData = array.array('B')
-        tReData = re.compile(r'^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2})*:?$')
-        iState = 0
-        for strLine in iter(strStdout.splitlines()):
-            strLine = strLine.strip()
-            if iState == 0:
-                if strLine == strID:
-                    iState = 1
-            elif iState == 1:
-                tMatch = tReData.search(strLine)
-                if tMatch is None:
-                    break
-                else:
-                    for strDataHex in strLine.split(':'):
-                        strDataHexStrip = strDataHex.strip()
-                        if len(strDataHexStrip) != 0:
-                            strDataBin = binascii.unhexlify(strDataHexStrip)
-                            aucData.append(ord(strDataBin))
-
-        return aucData
-
-    def __openssl_cut_leading_zero(self, aucData):
-        # Does the number start with "00" and is the third digit >= 8?
-        if aucData[0] == 0x00 and aucData[1] >= 0x80:
-            # Remove the leading "00".
-            aucData.pop(0)
-
-    def __openssl_convert_to_little_endian(self, aucData):
-        aucData.reverse()
-
-    def __openssl_uncompress_field(self, aucData):
-        # The data must not be compressed.
-        if aucData[0] != 0x04:
-            raise Exception('The data is compressed. This is not supported yet.')
-        # Cut off the first byte.
-        aucData.pop(0)
-
-    def __openssl_cut_in_half(self, aucData):
-        # Cut the public key in equal parts.
-        sizDataHalf = len(aucData) / 2
-        aucData0 = array.array('B', aucData[:sizDataHalf])
-        aucData1 = array.array('B', aucData[sizDataHalf:])
-        return aucData0, aucData1
-
     def __keyrom_get_key(self, uiIndex):
         # This needs the keyrom data.
-        if self.__XmlKeyromContents is None:
+        if self.__cKeyrom is None:
             raise Exception('No Keyrom contents specified!')
 
-        # Find the requested key and hash.
-        tNode = self.__XmlKeyromContents.find('Entry/[@index="%d"]' % uiIndex)
-        if tNode is None:
-            raise Exception('Key %d was not found!' % uiIndex)
-        tNode_key = tNode.find('Key')
-        if tNode_key is None:
-            raise Exception('Key %d has no "Key" child!' % uiIndex)
-        tNode_hash = tNode.find('Hash')
-        if tNode_hash is None:
-            raise Exception('Key %d has no "Hash" child!' % uiIndex)
+        # Get the decoded key from the index.
+        return self.__cKeyrom.get_key(uiIndex)
 
-        strKeyBase64 = tNode_key.text
-
-        # Decode the BASE64 data. Now we have the key pair in DER format.
-        strKeyDER = base64.b64decode(strKeyBase64)
+    def __get_cert_mod_exp(self, tNodeParent, strKeyDER, fIsPublicKey):
+        # Keys from the keyrom are already decoded. Decode all other keys or
+        # get them from the cache.
+        tAttributes = None
+        if self.__cKeyrom is not None:
+            tAttributes = self.__cKeyrom.find_key_attributes(strKeyDER)
+        if tAttributes is None:
+            tAttributes = self.__cKeyCache.get_key_attributes(strKeyDER)
+        iKeyTyp_1ECC_2RSA, atAttr = tAttributes
+
+        # The netX90 starts counting the key sizes with 1.
+        if(
+            (self.__strNetxType == 'NETX90_MPW') or
+            (self.__strNetxType == 'NETX90') or
+            (self.__strNetxType == 'NETX90B')
+        ):
+            atAttr['id'] += 1
 
-        return strKeyDER
+        return iKeyTyp_1ECC_2RSA, atAttr
 
-    def __get_cert_mod_exp(self, tNodeParent, strKeyDER, fIsPublicKey):
-        # Extract all information from the key.
-        astrCmd = [
-            self.__cfg_openssl,
-            'pkey',
-            '-inform',
-            'DER',
-            '-text',
-            '-noout'
-        ]
-        if fIsPublicKey is True:
-            astrCmd.append('-pubin')
-        tProcess = subprocess.Popen(
-            astrCmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE
+    def __signature_submit(self, uiChunkIndex, ulOffsetInChunk, strKeyDER, strDataToSign, fConvert):
+        # Get the key type and the size of the signature.
+        iKeyTyp_1ECC_2RSA, atAttr = self.__get_cert_mod_exp(
+            None,
+            strKeyDER,
+            False
+        )
+        if iKeyTyp_1ECC_2RSA == 1:
+            sizKeyInBytes = len(atAttr['Qx'])
+            sizSignature = 2 * sizKeyInBytes
+        elif iKeyTyp_1ECC_2RSA == 2:
+            sizKeyInBytes = len(atAttr['mod'])
+            sizSignature = sizKeyInBytes
+        else:
+            raise Exception('Unknown key type: %s' % str(iKeyTyp_1ECC_2RSA))
+
+        # An unconverted ECC signature is DER encoded. Its size depends on
+        # the values of "r" and "s". Reserve the largest possible size. It
+        # does not need the signature, so a dry run gets the same layout as
+        # a real build.
+        fIsDer = (iKeyTyp_1ECC_2RSA == 1) and (fConvert is not True)
+        if fIsDer is True:
+            sizSignature = signer.get_der_signature_size(sizKeyInBytes)
+
+        # A dry run only reserves the space for the signature.
+        if self.__fLayoutOnly is True:
+            return sizSignature
+
+        # Only the digest is passed to the signer. The request is sent with
+        # all other signatures of this batch in "resolve_signatures".
+        strDigest = hashlib.sha384(strDataToSign).digest()
+        tRequest = self.__cSigner.submit(
+            strKeyDER,
+            iKeyTyp_1ECC_2RSA,
+            strDigest
         )
-        (strStdout, _) = tProcess.communicate(strKeyDER)
-        if tProcess.returncode != 0:
-            raise Exception('OpenSSL failed with return code %d.' %
-                            tProcess.returncode)
-
-        # Try to guess if this is an RSA or ECC key.
-        # The text dump of an RSA key has " modulus:", while an ECC key has
-        # "priv:".
-        iKeyTyp_1ECC_2RSA = None
-        atAttr = None
-        if strStdout.find('modulus:') != -1:
-            # Looks like this is an RSA key.
-            iKeyTyp_1ECC_2RSA = 2
-
-            strMatchExponent = 'publicExponent:'
-            strMatchModulus = 'modulus:'
-            if fIsPublicKey is True:
-                strMatchExponent = 'Exponent:'
-                strMatchModulus = 'Modulus:'
-
-            # Extract the public exponent.
-            tReExp = re.compile(
-                r'^{}\s+(\d+)\s+\(0x([0-9a-fA-F]+)\)$'.format(strMatchExponent),
-                re.MULTILINE
-            )
-            tMatch = tReExp.search(strStdout)
-            if tMatch is None:
-                raise Exception('Can not find public exponent!')
-            ulExp = int(tMatch.group(1))
-            ulExpHex = int(tMatch.group(2), 16)
-            if ulExp != ulExpHex:
-                raise Exception('Decimal version differs from hex version!')
-            if (ulExp < 0) or (ulExp > 0xffffff):
-                raise Exception('The exponent exceeds the allowed range of a '
-                                '24bit unsigned integer!')
-            strData = (
-                chr(ulExp & 0xff) +
-                chr((ulExp >> 8) & 0xff) +
-                chr((ulExp >> 16) & 0xff)
-            )
-            aucExp = array.array('B', strData)
-
-            # Extract the modulus "N".
-            aucMod = self.__openssl_get_data_block(strStdout, strMatchModulus)
-            self.__openssl_cut_leading_zero(aucMod)
-            self.__openssl_convert_to_little_endian(aucMod)
 
-            __atKnownRsaSizes = {
-                0: {'mod': 256, 'exp': 3, 'rsa': 2048},
-                1: {'mod': 384, 'exp': 3, 'rsa': 3072},
-                2: {'mod': 512, 'exp': 3, 'rsa': 4096}
+        self.__add_chunk_patch(
+            uiChunkIndex,
+            'signature',
+            ulOffsetInChunk,
+            sizSignature,
+            True,
+            functools.partial(
+                self.__signature_get_data,
+                tRequest,
+                iKeyTyp_1ECC_2RSA,
+                sizKeyInBytes,
+                fConvert,
+                sizSignature
+            ),
+            {
+                # The signed data ends at the signature.
+                'ulSourceOffset': ulOffsetInChunk - memoryview(strDataToSign).nbytes,
+                'strKeyDER': strKeyDER,
+                'iKeyTyp_1ECC_2RSA': iKeyTyp_1ECC_2RSA,
+                'sizKeyInBytes': sizKeyInBytes,
+                'fConvert': fConvert
             }
+        )
 
-            sizMod = len(aucMod)
-            sizExp = len(aucExp)
-            uiId = None
-            for uiElementId, atAttr in __atKnownRsaSizes.items():
-                if (sizMod == atAttr['mod']) and (sizExp == atAttr['exp']):
-                    # Found the RSA type.
-                    if(
-                        (self.__strNetxType == 'NETX90_MPW') or
-                        (self.__strNetxType == 'NETX90') or
-                        (self.__strNetxType == 'NETX90B')
-                    ):
-                        uiId = uiElementId + 1
-                    else:
-                        uiId = uiElementId
-                    break
-
-            if uiId is None:
-                strErr = (
-                    'The modulo has a size of %d bytes. '
-                    'The public exponent has a size of %d bytes.\n'
-                    'These values can not be mapped to a RSA bit size. '
-                    'Known sizes are:\n' % (
-                        sizMod,
-                        sizExp
-                    )
-                )
-                for uiElementId, atAttr in __atKnownRsaSizes.items():
-                    strErr += (
-                        '  RSA%d: %d bytes modulo, %d bytes public exponent\n' %
-                        (atAttr['rsa'], atAttr['mod'], atAttr['exp'])
-                    )
-                raise Exception(strErr)
-
-            atAttr = {
-                'id': uiId,
-                'mod': aucMod,
-                'exp': aucExp
-            }
+        return sizSignature
 
-        elif strStdout.find('priv:') != -1:
-            # Looks like this is an ECC key.
-            iKeyTyp_1ECC_2RSA = 1
-
-            aucPriv = self.__openssl_get_data_block(strStdout, 'priv:')
-            self.__openssl_cut_leading_zero(aucPriv)
-            self.__openssl_convert_to_little_endian(aucPriv)
-
-            aucPub = self.__openssl_get_data_block(strStdout, 'pub:')
-            self.__openssl_uncompress_field(aucPub)
-            aucPubX, aucPubY = self.__openssl_cut_in_half(aucPub)
-            self.__openssl_convert_to_little_endian(aucPubX)
-            self.__openssl_convert_to_little_endian(aucPubY)
-
-            aucPrime = self.__openssl_get_data_block(strStdout, 'Prime:')
-            self.__openssl_cut_leading_zero(aucPrime)
-            self.__openssl_convert_to_little_endian(aucPrime)
-
-            aucA = self.__openssl_get_data_block(strStdout, 'A:')
-            self.__openssl_cut_leading_zero(aucA)
-            self.__openssl_convert_to_little_endian(aucA)
-
-            aucB = self.__openssl_get_data_block(strStdout, 'B:')
-            self.__openssl_cut_leading_zero(aucB)
-            self.__openssl_convert_to_little_endian(aucB)
-
-            strData = self.__openssl_get_data_block(strStdout, 'Generator (uncompressed):')
-            aucGen = array.array('B', strData)
-            self.__openssl_uncompress_field(aucGen)
-            aucGenX, aucGenY = self.__openssl_cut_in_half(aucGen)
-            self.__openssl_convert_to_little_endian(aucGenX)
-            self.__openssl_convert_to_little_endian(aucGenY)
-
-            aucOrder = self.__openssl_get_data_block(strStdout, 'Order:')
-            self.__openssl_cut_leading_zero(aucOrder)
-            self.__openssl_convert_to_little_endian(aucOrder)
-
-            # Extract the cofactor.
-            tReExp = re.compile(r'^Cofactor:\s+(\d+)\s+\(0x([0-9a-fA-F]+)\)$', re.MULTILINE)
-            tMatch = tReExp.search(strStdout)
-            if tMatch is None:
-                raise Exception('Can not find cofactor!')
-            ulCofactor = int(tMatch.group(1))
-            ulCofactorHex = int(tMatch.group(2), 16)
-            if ulCofactor != ulCofactorHex:
-                raise Exception('Decimal version differs from hex version!')
-
-            __atKnownEccSizes = {
-                0: 32,
-                1: 48,
-                2: 64
-            }
+    def __signature_get_data(self, tRequest, iKeyTyp_1ECC_2RSA, sizKeyInBytes, fConvert, sizSignature):
+        strSignature = tRequest.result()
+        if fConvert is True:
+            aucSignature = signer.convert_signature(
+                strSignature,
+                iKeyTyp_1ECC_2RSA,
+                sizKeyInBytes
+            )
+        elif iKeyTyp_1ECC_2RSA == 1:
+            aucSignature = array.array(
+                'B',
+                signer.pad_der_signature(strSignature, sizSignature)
+            )
+        else:
+            aucSignature = array.array('B', strSignature)
+        return aucSignature
 
-            sizD = len(aucPriv)
-            sizQx = len(aucPubX)
-            sizQy = len(aucPubY)
-            sizP = len(aucPrime)
-            sizA = len(aucA)
-            sizB = len(aucB)
-            sizGx = len(aucGenX)
-            sizGy = len(aucGenY)
-            sizN = len(aucOrder)
-            uiId = None
-            for uiElementId, sizNumbers in __atKnownEccSizes.items():
-                if(
-                    (sizNumbers == sizD) and
-                    (sizNumbers == sizQx) and
-                    (sizNumbers == sizQy) and
-                    (sizNumbers == sizP) and
-                    (sizNumbers == sizA) and
-                    (sizNumbers == sizB) and
-                    (sizNumbers == sizGx) and
-                    (sizNumbers == sizGy) and
-                    (sizNumbers == sizN)
-                ):
-                    # Found the ECC type.
-                    if(
-                        (self.__strNetxType == 'NETX90_MPW') or
-                        (self.__strNetxType == 'NETX90') or
-                        (self.__strNetxType == 'NETX90B')
-                    ):
-                        uiId = uiElementId + 1
-                    else:
-                        uiId = uiElementId
-                    break
+    def __add_chunk_patch(self, uiChunkIndex, strKind, ulOffsetInChunk, sizData, fNeedsSigner, pfnGetData, atSignature=None):
+        # A chunk built in 2 passes replaces the patch of the first pass.
+        atPatches = self.__atChunkPatches.setdefault(uiChunkIndex, {})
+        atPatches[strKind] = {
+            'ulOffset': ulOffsetInChunk,
+            'sizData': sizData,
+            'fNeedsSigner': fNeedsSigner,
+            'pfnGetData': pfnGetData,
+            'atSignature': atSignature
+        }
 
-            if uiId is None:
-                raise Exception('Invalid ECC key.')
-
-            atAttr = {
-                'id': uiId,
-                'd': aucPriv,
-                'Qx': aucPubX,
-                'Qy': aucPubY,
-                'p': aucPrime,
-                'a': aucA,
-                'b': aucB,
-                'Gx': aucGenX,
-                'Gy': aucGenY,
-                'n': aucOrder,
-                'cof': ulCofactor
-            }
+    def __update_hash_with_extents(self, tHash, tData, atExtents):
+        # Add the data to the hash. The extents are inserted at their offset.
+        with memoryview(tData) as tView:
+            with tView.cast('B') as aucData:
+                ulOffset = 0
+                for tExtent in atExtents:
+                    tHash.update(aucData[ulOffset:tExtent['ulOffset']])
+                    for strBlock in self.__get_extent_blocks(tExtent):
+                        tHash.update(strBlock)
+                    ulOffset = tExtent['ulOffset']
+                tHash.update(aucData[ulOffset:])
+
+    def __hash_chunk_job(self, tView, atExtents):
+        # This runs in the thread pool. It only reads its own chunk.
+        tStart = time.perf_counter()
+        tHash = hashlib.sha384()
+        self.__update_hash_with_extents(tHash, tView, atExtents)
+        tView.release()
+        tEnd = time.perf_counter()
+        return tHash.digest(), tEnd - tStart, tEnd
+
+    def __chunk_hash_get_data(self, tFuture):
+        strHash, tDuration, tEnd = tFuture.result()
+        self.__atHashStatistics['uiJobs'] += 1
+        self.__atHashStatistics['tHashTime'] += tDuration
+        self.__atHashStatistics['tEnd'] = max(
+            self.__atHashStatistics['tEnd'],
+            tEnd
+        )
+        return strHash[:self.__sizHashDw * 4]
+
+    def __append_chunk_hash(self, tChunkAttributes, uiChunkIndex, aulChunk):
+        # Append the hash of the chunk data to the chunk and set the hash
+        # attribute. The hash also covers the extents of the chunk.
+        sizChunk = len(aulChunk) * 4
+        atExtents = tChunkAttributes['atExtents']
+        sizHashed = sizChunk + self.__get_extents_size(atExtents)
+        if self.__fLayoutOnly is True:
+            # A dry run only reserves the space for the hash.
+            aulChunk.extend([0] * self.__sizHashDw)
+            tChunkAttributes['aulHash'] = array.array('I', [0] * 12)
+            tChunkAttributes['tHashFuture'] = None
+
+        elif (self.__tHashPool is None) or (sizHashed < self.__sizParallelHashMinimum):
+            tHash = hashlib.sha384()
+            self.__update_hash_with_extents(tHash, aulChunk, atExtents)
+            strHash = tHash.digest()
+            aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
+            aulChunk.extend(aulHash)
+            tChunkAttributes['aulHash'] = array.array('I', strHash)
+            tChunkAttributes['tHashFuture'] = None
 
         else:
-            raise Exception('Unknown key format.')
+            # Reserve space for the hash. The chunk must not grow while the
+            # thread pool reads it.
+            aulChunk.extend([0] * self.__sizHashDw)
+            tView = memoryview(aulChunk).cast('B')[0:sizChunk]
+
+            if self.__atHashStatistics['uiSubmitted'] == 0:
+                self.__atHashStatistics['tStart'] = time.perf_counter()
+            self.__atHashStatistics['uiSubmitted'] += 1
+            self.__atHashStatistics['sizBytes'] += sizHashed
+
+            tFuture = self.__tHashPool.submit(
+                self.__hash_chunk_job,
+                tView,
+                atExtents
+            )
+            self.__add_chunk_patch(
+                uiChunkIndex,
+                'hash',
+                sizChunk,
+                self.__sizHashDw * 4,
+                False,
+                functools.partial(self.__chunk_hash_get_data, tFuture)
+            )
+            tChunkAttributes['aulHash'] = None
+            tChunkAttributes['tHashFuture'] = tFuture
 
-        return iKeyTyp_1ECC_2RSA, atAttr
+    def __get_chunk_hash(self, tChunkAttributes):
+        # Wait for the chunk hash if it is computed in the thread pool.
+        tFuture = tChunkAttributes.get('tHashFuture')
+        if tFuture is not None:
+            strHash = tFuture.result()[0]
+            tChunkAttributes['aulHash'] = array.array('I', strHash)
+            tChunkAttributes['tHashFuture'] = None
+        return tChunkAttributes['aulHash']
 
     def __cert_parse_binding(self, tNodeParent, strName):
         # The binding is not yet set.
@@ -3066,58 +3488,20 @@ class HbootImage:
                 __atRootCert['RootPublicKey']['idx']
             )
 
-            # Create a temporary file for the keypair.
-            iFile, strPathKeypair = tempfile.mkstemp(
-                suffix='der',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
-            )
-            os.close(iFile)
-
-            # Create a temporary file for the data to sign.
-            iFile, strPathSignatureInputData = tempfile.mkstemp(
-                suffix='bin',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
+            # Reserve space for the signature. It is filled in before the
+            # image is written.
+            sizSignature = self.__signature_submit(
+                uiChunkIndex,
+                8 + len(atData),
+                strKeyDER,
+                atData,
+                False
             )
-            os.close(iFile)
-
-            # Write the DER key to the temporary file.
-            tFile = open(strPathKeypair, 'wt')
-            tFile.write(strKeyDER)
-            tFile.close()
-
-            # Write the data to sign to the temporary file.
-            tFile = open(strPathSignatureInputData, 'wb')
-            tFile.write(atData.tobytes())
-            tFile.close()
-
-            astrCmd = [
-                self.__cfg_openssl,
-                'dgst',
-                '-sign', strPathKeypair,
-                '-keyform', 'DER',
-                '-sigopt', 'rsa_padding_mode:pss',
-                '-sigopt', 'rsa_pss_saltlen:-1',
-                '-sha384'
-            ]
-            astrCmd.extend(self.__cfg_openssloptions)
-            astrCmd.append(strPathSignatureInputData)
-            strSignature = subprocess.check_output(astrCmd)
-
-            # Remove the temp files.
-            os.remove(strPathKeypair)
-            os.remove(strPathSignatureInputData)
-
-            # Append the signature to the chunk.
-            aulSignature = array.array('B', strSignature)
-            atData.extend(aulSignature)
+            atData.extend([0] * sizSignature)
 
             # Pad the data to a multiple of dwords.
             strData = atData.tobytes()
-            strPadding = chr(0x00) * ((4 - (len(strData) % 4)) & 3)
+            strPadding = bytes((4 - (len(strData) % 4)) & 3)
             strChunk = strData + strPadding
 
             # Convert the padded data to an array.
@@ -3235,58 +3619,20 @@ class HbootImage:
             # Get the key in DER encoded format.
             strKeyDER = __atCert['Key']['der']
 
-            # Create a temporary file for the keypair.
-            iFile, strPathKeypair = tempfile.mkstemp(
-                suffix='der',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
-            )
-            os.close(iFile)
-
-            # Create a temporary file for the data to sign.
-            iFile, strPathSignatureInputData = tempfile.mkstemp(
-                suffix='bin',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
+            # Reserve space for the signature. It is filled in before the
+            # image is written.
+            sizSignature = self.__signature_submit(
+                uiChunkIndex,
+                8 + len(atData),
+                strKeyDER,
+                atData,
+                False
             )
-            os.close(iFile)
-
-            # Write the DER key to the temporary file.
-            tFile = open(strPathKeypair, 'wt')
-            tFile.write(strKeyDER)
-            tFile.close()
-
-            # Write the data to sign to the temporary file.
-            tFile = open(strPathSignatureInputData, 'wb')
-            tFile.write(atData.tobytes())
-            tFile.close()
-
-            astrCmd = [
-                self.__cfg_openssl,
-                'dgst',
-                '-sign', strPathKeypair,
-                '-keyform', 'DER',
-                '-sigopt', 'rsa_padding_mode:pss',
-                '-sigopt', 'rsa_pss_saltlen:-1',
-                '-sha384'
-            ]
-            astrCmd.extend(self.__cfg_openssloptions)
-            astrCmd.append(strPathSignatureInputData)
-            strSignature = subprocess.check_output(astrCmd)
-
-            # Remove the temp files.
-            os.remove(strPathKeypair)
-            os.remove(strPathSignatureInputData)
-
-            # Append the signature to the chunk.
-            aulSignature = array.array('B', strSignature)
-            atData.extend(aulSignature)
+            atData.extend([0] * sizSignature)
 
             # Pad the data to a multiple of dwords.
             strData = atData.tobytes()
-            strPadding = chr(0x00) * ((4 - (len(strData) % 4)) & 3)
+            strPadding = bytes((4 - (len(strData) % 4)) & 3)
             strChunk = strData + strPadding
 
             # Convert the padded data to an array.
@@ -3430,58 +3776,20 @@ class HbootImage:
             # Get the key in DER encoded format.
             strKeyDER = __atCert['Key']['der']
 
-            # Create a temporary file for the keypair.
-            iFile, strPathKeypair = tempfile.mkstemp(
-                suffix='der',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
+            # Reserve space for the signature. It is filled in before the
+            # image is written.
+            sizSignature = self.__signature_submit(
+                uiChunkIndex,
+                8 + len(atData),
+                strKeyDER,
+                atData,
+                False
             )
-            os.close(iFile)
-
-            # Create a temporary file for the data to sign.
-            iFile, strPathSignatureInputData = tempfile.mkstemp(
-                suffix='bin',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
-            )
-            os.close(iFile)
-
-            # Write the DER key to the temporary file.
-            tFile = open(strPathKeypair, 'wt')
-            tFile.write(strKeyDER)
-            tFile.close()
-
-            # Write the data to sign to the temporary file.
-            tFile = open(strPathSignatureInputData, 'wb')
-            tFile.write(atData.tobytes())
-            tFile.close()
-
-            astrCmd = [
-                self.__cfg_openssl,
-                'dgst',
-                '-sign', strPathKeypair,
-                '-keyform', 'DER',
-                '-sigopt', 'rsa_padding_mode:pss',
-                '-sigopt', 'rsa_pss_saltlen:-1',
-                '-sha384'
-            ]
-            astrCmd.extend(self.__cfg_openssloptions)
-            astrCmd.append(strPathSignatureInputData)
-            strSignature = subprocess.check_output(astrCmd)
-
-            # Remove the temp files.
-            os.remove(strPathKeypair)
-            os.remove(strPathSignatureInputData)
-
-            # Append the signature to the chunk.
-            aulSignature = array.array('B', strSignature)
-            atData.extend(aulSignature)
+            atData.extend([0] * sizSignature)
 
             # Pad the data to a multiple of dwords.
             strData = atData.tobytes()
-            strPadding = chr(0x00) * ((4 - (len(strData) % 4)) & 3)
+            strPadding = bytes((4 - (len(strData) % 4)) & 3)
             strChunk = strData + strPadding
 
             # Convert the padded data to an array.
@@ -3660,58 +3968,20 @@ class HbootImage:
             # Get the key in DER encoded format.
             strKeyDER = __atCert['Key']['der']
 
-            # Create a temporary file for the keypair.
-            iFile, strPathKeypair = tempfile.mkstemp(
-                suffix='der',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
+            # Reserve space for the signature. It is filled in before the
+            # image is written.
+            sizSignature = self.__signature_submit(
+                uiChunkIndex,
+                8 + len(atData),
+                strKeyDER,
+                atData,
+                False
             )
-            os.close(iFile)
-
-            # Create a temporary file for the data to sign.
-            iFile, strPathSignatureInputData = tempfile.mkstemp(
-                suffix='bin',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
-            )
-            os.close(iFile)
-
-            # Write the DER key to the temporary file.
-            tFile = open(strPathKeypair, 'wt')
-            tFile.write(strKeyDER)
-            tFile.close()
-
-            # Write the data to sign to the temporary file.
-            tFile = open(strPathSignatureInputData, 'wb')
-            tFile.write(atData.tobytes())
-            tFile.close()
-
-            astrCmd = [
-                self.__cfg_openssl,
-                'dgst',
-                '-sign', strPathKeypair,
-                '-keyform', 'DER',
-                '-sigopt', 'rsa_padding_mode:pss',
-                '-sigopt', 'rsa_pss_saltlen:-1',
-                '-sha384'
-            ]
-            astrCmd.extend(self.__cfg_openssloptions)
-            astrCmd.append(strPathSignatureInputData)
-            strSignature = subprocess.check_output(astrCmd)
-
-            # Remove the temp files.
-            os.remove(strPathKeypair)
-            os.remove(strPathSignatureInputData)
-
-            # Append the signature to the chunk.
-            aulSignature = array.array('B', strSignature)
-            atData.extend(aulSignature)
+            atData.extend([0] * sizSignature)
 
             # Pad the data to a multiple of dwords.
             strData = atData.tobytes()
-            strPadding = chr(0x00) * ((4 - (len(strData) % 4)) & 3)
+            strPadding = bytes((4 - (len(strData) % 4)) & 3)
             strChunk = strData + strPadding
 
             # Convert the padded data to an array.
@@ -3788,7 +4058,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -3846,51 +4116,6 @@ class HbootImage:
         atData['atAttr'] = atAttr
         atData['der'] = strKeyDER
 
-    def __openssl_ecc_get_signature(self, aucSignature, sizKeyInBytes):
-        # Get the start of the firt element, which is "r".
-        uiLen = aucSignature[1]
-        if uiLen >= 128:
-            uiLen -= 128
-        else:
-            uiLen = 0
-        uiElementStart = 2 + uiLen
-
-        sizR = aucSignature[uiElementStart + 1]
-        aucR = aucSignature[uiElementStart + 2:uiElementStart + 2 + sizR]
-
-        if sizR > sizKeyInBytes + 1:
-            raise Exception('The R field is too big. Expected %d bytes, '
-                            'but got %d.' % (sizKeyInBytes, sizR))
-        elif sizR == sizKeyInBytes + 1:
-            self.__openssl_cut_leading_zero(aucR)
-        elif sizR < sizKeyInBytes:
-            # The signature data is smaller than expected. Pad it with 0x00.
-            aucR.extend([0] * (sizKeyInBytes - sizR))
-        self.__openssl_convert_to_little_endian(aucR)
-
-        # Get the start of the second element, which is "s".
-        uiElementStart = 2 + uiLen + 2 + sizR
-
-        sizS = aucSignature[uiElementStart + 1]
-        aucS = aucSignature[uiElementStart + 2:uiElementStart + 2 + sizS]
-
-        if sizS > sizKeyInBytes + 1:
-            raise Exception('The S field is too big. Expected %d bytes, '
-                            'but got %d.' % (sizKeyInBytes, sizS))
-        elif sizS == sizKeyInBytes + 1:
-            self.__openssl_cut_leading_zero(aucS)
-        elif sizS < sizKeyInBytes:
-            # The signature data is smaller than expected. Pad it with 0x00.
-            aucS.extend([0] * (sizKeyInBytes - sizS))
-        self.__openssl_convert_to_little_endian(aucS)
-
-        # Combine R and S.
-        aucSignature = array.array('B')
-        aucSignature.extend(aucR)
-        aucSignature.extend(aucS)
-
-        return aucSignature
-
     def __build_chunk_update_secure_info_page(self, tChunkAttributes, atParserState, uiChunkIndex, atAllChunks):
         tChunkNode = tChunkAttributes['tNode']
 
@@ -3919,7 +4144,8 @@ class HbootImage:
 
             # The data must be set by the user.
             'Data': {
-                'data': None
+                'data': None,
+                'atSlots': []
             }
         }
 
@@ -4021,7 +4247,12 @@ class HbootImage:
         if __atCert['KeyIndex'] == 0xff:
             # Non-secure.
 
-            # Add the patch data.
+            # Add the patch data. It follows the ID and the size.
+            self.__add_chunk_slots(
+                tChunkAttributes,
+                __atCert['Data']['atSlots'],
+                8 + len(atData)
+            )
             atData.extend(aucPatchData)
             # Pad the patch data with 0x00.
             sizPadding = (4 - (sizPatchData % 4)) & 3
@@ -4038,7 +4269,7 @@ class HbootImage:
 
             # Get the hash for the chunk.
             tHash = hashlib.sha384()
-            tHash.update(aulChunk.tobytes())
+            tHash.update(aulChunk)
             strHash = tHash.digest()
             aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
             aulChunk.extend(aulHash)
@@ -4046,6 +4277,7 @@ class HbootImage:
             tChunkAttributes['fIsFinished'] = True
             tChunkAttributes['atData'] = aulChunk
             tChunkAttributes['aulHash'] = array.array('I', strHash)
+            tChunkAttributes['fHasTrailingHash'] = True
 
         else:
             # Secure.
@@ -4087,22 +4319,27 @@ class HbootImage:
                 # Pad the key with 3 bytes.
                 atData.extend([0, 0, 0])
 
-            # Add the patch data.
+            # Add the patch data. It follows the ID and the size.
+            self.__add_chunk_slots(
+                tChunkAttributes,
+                __atCert['Data']['atSlots'],
+                8 + len(atData)
+            )
             atData.extend(aucPatchData)
             # Pad the patch data with 0x00.
             sizPadding = (4 - (sizPatchData % 4)) & 3
             atData.extend([0] * sizPadding)
 
             if iKeyTyp_1ECC_2RSA == 1:
-                sizKeyInDwords = len(atAttr['Qx']) / 4
+                sizKeyInDwords = len(atAttr['Qx']) // 4
                 sizSignatureInDwords = 2 * sizKeyInDwords
             elif iKeyTyp_1ECC_2RSA == 2:
-                sizKeyInDwords = len(atAttr['mod']) / 4
+                sizKeyInDwords = len(atAttr['mod']) // 4
                 sizSignatureInDwords = sizKeyInDwords
 
             # Convert the padded data to an array.
             aulData = array.array('I')
-            aulData.frombytes(atData.tobytes)
+            aulData.frombytes(atData.tobytes())
 
             aulChunk = array.array('I')
             aulChunk.append(self.__get_tag_id('U', 'S', 'I', 'P'))
@@ -4112,73 +4349,16 @@ class HbootImage:
             # Get the key in DER encoded format.
             strKeyDER = __atCert['Key']['der']
 
-            # Create a temporary file for the keypair.
-            iFile, strPathKeypair = tempfile.mkstemp(
-                suffix='der',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
-            )
-            os.close(iFile)
-
-            # Create a temporary file for the data to sign.
-            iFile, strPathSignatureInputData = tempfile.mkstemp(
-                suffix='bin',
-                prefix='tmp_hboot_image',
-                dir=None,
-                text=False
+            # Reserve space for the signature. It is filled in before the
+            # image is written.
+            sizSignature = self.__signature_submit(
+                uiChunkIndex,
+                len(aulChunk) * 4,
+                strKeyDER,
+                aulChunk,
+                True
             )
-            os.close(iFile)
-
-            # Write the DER key to the temporary file.
-            tFile = open(strPathKeypair, 'wt')
-            tFile.write(strKeyDER)
-            tFile.close()
-
-            # Write the data to sign to the temporary file.
-            tFile = open(strPathSignatureInputData, 'wb')
-            tFile.write(aulChunk.tobytes())
-            tFile.close()
-
-            if iKeyTyp_1ECC_2RSA == 1:
-                astrCmd = [
-                    self.__cfg_openssl,
-                    'dgst',
-                    '-sign', strPathKeypair,
-                    '-keyform', 'DER',
-                    '-sha384'
-                ]
-                astrCmd.extend(self.__cfg_openssloptions)
-                astrCmd.append(strPathSignatureInputData)
-                strEccSignature = subprocess.check_output(astrCmd)
-                aucEccSignature = array.array('B', strEccSignature)
-
-                # Parse the signature.
-                aucSignature = self.__openssl_ecc_get_signature(aucEccSignature, sizKeyInDwords * 4)
-
-            elif iKeyTyp_1ECC_2RSA == 2:
-                astrCmd = [
-                    self.__cfg_openssl,
-                    'dgst',
-                    '-sign', strPathKeypair,
-                    '-keyform', 'DER',
-                    '-sigopt', 'rsa_padding_mode:pss',
-                    '-sigopt', 'rsa_pss_saltlen:-1',
-                    '-sha384'
-                ]
-                astrCmd.extend(self.__cfg_openssloptions)
-                astrCmd.append(strPathSignatureInputData)
-                strSignatureMirror = subprocess.check_output(astrCmd)
-                aucSignature = array.array('B', strSignatureMirror)
-                # Mirror the signature.
-                aucSignature.reverse()
-
-            # Remove the temp files.
-            os.remove(strPathKeypair)
-            os.remove(strPathSignatureInputData)
-
-            # Append the signature to the chunk.
-            aulChunk.frombytes(aucSignature.tobytes())
+            aulChunk.extend([0] * (sizSignature // 4))
 
             tChunkAttributes['fIsFinished'] = True
             tChunkAttributes['atData'] = aulChunk
@@ -4320,10 +4500,10 @@ class HbootImage:
         iKeyTyp_1ECC_2RSA = __atData['Key']['iKeyTyp_1ECC_2RSA']
         atAttr = __atData['Key']['atAttr']
         if iKeyTyp_1ECC_2RSA == 1:
-            sizKeyInDwords = len(atAttr['Qx']) / 4
+            sizKeyInDwords = len(atAttr['Qx']) // 4
             sizSignatureInDwords = 2 * sizKeyInDwords
         elif iKeyTyp_1ECC_2RSA == 2:
-            sizKeyInDwords = len(atAttr['mod']) / 4
+            sizKeyInDwords = len(atAttr['mod']) // 4
             sizSignatureInDwords = sizKeyInDwords
 
         # The minimum size of the HTBL chunk is...
@@ -4355,8 +4535,8 @@ class HbootImage:
             if sizChunkMinimumInBytes > ulRequiredSizeInBytes:
                 raise Exception('The HashTable size has a minimum size of %d bytes, which exceeds the requested size of %d bytes.' % (sizChunkMinimumInBytes, ulRequiredSizeInBytes))
 
-            sizFillUpInDwords = (ulRequiredSizeInBytes - sizChunkMinimumInBytes) / 4
-        sizChunkMinimumSizeInDwords = sizChunkMinimumInBytes / 4
+            sizFillUpInDwords = (ulRequiredSizeInBytes - sizChunkMinimumInBytes) // 4
+        sizChunkMinimumSizeInDwords = sizChunkMinimumInBytes // 4
 
         uiPass = atParserState['uiPass']
         if uiPass == 0:
@@ -4405,8 +4585,8 @@ class HbootImage:
 
             # Collect hash sums of the next chunks.
             atHashes = []
-            for uiChunkIndex in range(sizHtblFirstChunk, sizHtblLastChunkPlus1):
-                tAttr = atAllChunks[uiChunkIndex]
+            for uiHashedChunkIndex in range(sizHtblFirstChunk, sizHtblLastChunkPlus1):
+                tAttr = atAllChunks[uiHashedChunkIndex]
 
                 # Is this one of the chunks which needs a hash entry?
                 strChunkName = tAttr['strName']
@@ -4419,7 +4599,7 @@ class HbootImage:
                     break
                 else:
                     # Add the hash to the list.
-                    atHashes.append(tAttr['aulHash'])
+                    atHashes.append(self.__get_chunk_hash(tAttr))
 
             # Found all hashes?
             if len(atHashes) == ulNumberOfHashes:
@@ -4474,9 +4654,16 @@ class HbootImage:
                         # Pad the key with 3 bytes.
                         aucData.extend([0, 0, 0])
 
-                # Append all hashes.
-                for atHash in atHashes:
+                # Append all hashes. Remember their position after the ID
+                # and the size for image templates.
+                atHashTableEntries = []
+                for uiHashIndex, atHash in enumerate(atHashes):
+                    atHashTableEntries.append({
+                        'ulOffset': 8 + len(aucData),
+                        'uiHashedChunkIndex': sizHtblFirstChunk + uiHashIndex
+                    })
                     aucData.frombytes(atHash.tobytes())
+                tChunkAttributes['atHashTableEntries'] = atHashTableEntries
 
                 aulChunk = array.array('I')
                 # Add the ID.
@@ -4491,73 +4678,16 @@ class HbootImage:
                 # Get the key in DER encoded format.
                 strKeyDER = __atData['Key']['der']
 
-                # Create a temporary file for the keypair.
-                iFile, strPathKeypair = tempfile.mkstemp(
-                    suffix='der',
-                    prefix='tmp_hboot_image',
-                    dir=None,
-                    text=False
+                # Reserve space for the signature. It is filled in before the
+                # image is written.
+                sizSignature = self.__signature_submit(
+                    uiChunkIndex,
+                    len(aulChunk) * 4,
+                    strKeyDER,
+                    aulChunk,
+                    True
                 )
-                os.close(iFile)
-
-                # Create a temporary file for the data to sign.
-                iFile, strPathSignatureInputData = tempfile.mkstemp(
-                    suffix='bin',
-                    prefix='tmp_hboot_image',
-                    dir=None,
-                    text=False
-                )
-                os.close(iFile)
-
-                # Write the DER key to the temporary file.
-                tFile = open(strPathKeypair, 'wt')
-                tFile.write(strKeyDER)
-                tFile.close()
-
-                # Write the data to sign to the temporary file.
-                tFile = open(strPathSignatureInputData, 'wb')
-                tFile.write(aulChunk.tobytes())
-                tFile.close()
-
-                if iKeyTyp_1ECC_2RSA == 1:
-                    astrCmd = [
-                        self.__cfg_openssl,
-                        'dgst',
-                        '-sign', strPathKeypair,
-                        '-keyform', 'DER',
-                        '-sha384'
-                    ]
-                    astrCmd.extend(self.__cfg_openssloptions)
-                    astrCmd.append(strPathSignatureInputData)
-                    strEccSignature = subprocess.check_output(astrCmd)
-                    aucEccSignature = array.array('B', strEccSignature)
-
-                    # Parse the signature.
-                    aucSignature = self.__openssl_ecc_get_signature(aucEccSignature, sizKeyInDwords * 4)
-
-                elif iKeyTyp_1ECC_2RSA == 2:
-                    astrCmd = [
-                        self.__cfg_openssl,
-                        'dgst',
-                        '-sign', strPathKeypair,
-                        '-keyform', 'DER',
-                        '-sigopt', 'rsa_padding_mode:pss',
-                        '-sigopt', 'rsa_pss_saltlen:-1',
-                        '-sha384'
-                    ]
-                    astrCmd.extend(self.__cfg_openssloptions)
-                    astrCmd.append(strPathSignatureInputData)
-                    strSignatureMirror = subprocess.check_output(astrCmd)
-                    aucSignature = array.array('B', strSignatureMirror)
-                    # Mirror the signature.
-                    aucSignature.reverse()
-
-                # Remove the temp files.
-                os.remove(strPathKeypair)
-                os.remove(strPathSignatureInputData)
-
-                # Append the signature to the chunk.
-                aulChunk.frombytes(aucSignature.tobytes())
+                aulChunk.extend([0] * (sizSignature // 4))
 
                 tChunkAttributes['fIsFinished'] = True
                 tChunkAttributes['atData'] = aulChunk
@@ -4620,7 +4750,7 @@ class HbootImage:
 
         # Get the hash for the chunk.
         tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
+        tHash.update(aulChunk)
         strHash = tHash.digest()
         aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
         aulChunk.extend(aulHash)
@@ -4640,14 +4770,39 @@ class HbootImage:
 
         pulWorkingAddress = self.__parse_numeric_expression(strWorkingAddress)
 
+        # The data is already compressed unless the "compress" attribute is
+        # set.
+        strCompress = tChunkNode.getAttribute('compress')
+        if strCompress not in ['', 'xz']:
+            raise Exception(
+                'Invalid compression for the DaXZ chunk: "%s"' % strCompress
+            )
+        fCompress = (strCompress == 'xz')
+
         # Get the data block.
-        atData = {}
+        atData = {'fNeedsPayload': fCompress}
         self.__get_data_contents(tChunkNode, atData, True)
         strData = atData['data']
         pulLoadAddress = atData['load_address']
 
+        if fCompress is True:
+            atSettings = {}
+            for strAttribute, strSetting, ulDefault in [
+                ('level', 'uiLevel', 6),
+                ('dict_size', 'sizDictionary', 0x100000),
+                ('block_size', 'sizBlock', 0x100000)
+            ]:
+                strValue = tChunkNode.getAttribute(strAttribute)
+                if len(strValue) == 0:
+                    atSettings[strSetting] = ulDefault
+                else:
+                    atSettings[strSetting] = self.__parse_numeric_expression(
+                        strValue
+                    )
+            strData = self.__cXzCompressor.compress(strData, **atSettings)
+
         # Pad the data to a multiple of DWORDs.
-        strPadding = chr(0x00) * ((4 - (len(strData) % 4)) & 3)
+        strPadding = bytes((4 - (len(strData) % 4)) & 3)
         strPaddedData = strData + strPadding
 
         # Convert the padded data to an array.
@@ -4661,16 +4816,12 @@ class HbootImage:
         aulChunk.append(pulLoadAddress)
         aulChunk.extend(aulData)
 
-        # Get the hash for the chunk.
-        tHash = hashlib.sha384()
-        tHash.update(aulChunk.tobytes())
-        strHash = tHash.digest()
-        aulHash = array.array('I', strHash[:self.__sizHashDw * 4])
-        aulChunk.extend(aulHash)
+        # Append the hash for the chunk.
+        self.__append_chunk_hash(tChunkAttributes, uiChunkIndex, aulChunk)
 
         tChunkAttributes['fIsFinished'] = True
         tChunkAttributes['atData'] = aulChunk
-        tChunkAttributes['aulHash'] = array.array('I', strHash)
+        tChunkAttributes['ulLoadAddress'] = pulLoadAddress
 
     def __string_to_bool(self, strBool):
         strBool = strBool.upper()
@@ -4701,7 +4852,14 @@ class HbootImage:
             'fIsFinished': False,
             'tNode': tNode,
             'atData': None,
-            'aulHash': None
+            'aulHash': None,
+            'ulLoadAddress': None,
+            'sizFill': 0,
+            'ucFill': None,
+            'atSlots': [],
+            'atExtents': [],
+            'fHasTrailingHash': False,
+            'atHashTableEntries': []
         }
         atChunks.append(tAttr)
 
@@ -5189,7 +5347,11 @@ class HbootImage:
                         sizChunkInBytes = len(tAttr['atData'])
                     else:
                         sizChunkInBytes = len(tAttr['atData']) * 4
-                    atState['ulCurrentOffset'] += sizChunkInBytes
+                    atState['ulCurrentOffset'] += (
+                        sizChunkInBytes +
+                        self.__get_extents_size(tAttr['atExtents']) +
+                        tAttr['sizFill']
+                    )
 
             if fAllChunksAreFinished is True:
                 break
@@ -5198,8 +5360,124 @@ class HbootImage:
             raise Exception('Some chunks are still not finished.')
 
         # Collect all data from the chunks.
-        for tAttr in atChunks:
+        for uiChunkIndex, tAttr in enumerate(atChunks):
+            ulChunkOffset = len(self.__atChunkData) * self.__atChunkData.itemsize
+            sizData = len(tAttr['atData']) * self.__atChunkData.itemsize
+            sizExtents = self.__get_extents_size(tAttr['atExtents'])
+            self.__atLayoutChunks.append({
+                'strName': tAttr['strName'],
+                'ulOffset': ulChunkOffset,
+                'ulImageOffset': ulChunkOffset + self.__sizFillExtents,
+                'sizData': sizData,
+                'sizExtents': sizExtents,
+                'sizChunk': sizData + sizExtents + tAttr['sizFill'],
+                'ulLoadAddress': tAttr['ulLoadAddress'],
+                'fHasTrailingHash': tAttr['fHasTrailingHash']
+            })
+
+            # Keep everything an image template needs.
+            for atSlot in tAttr['atSlots']:
+                atSlot = dict(atSlot)
+                atSlot['uiChunkIndex'] = uiChunkIndex
+                self.__atTemplateSlots.append(atSlot)
+            for atEntry in tAttr['atHashTableEntries']:
+                atEntry = dict(atEntry)
+                atEntry['uiChunkIndex'] = uiChunkIndex
+                self.__atTemplateHashTables.append(atEntry)
+
+            # Convert the offsets of the patches to the chunk data.
+            atPatches = self.__atChunkPatches.get(uiChunkIndex)
+            if atPatches is not None:
+                for tPatch in sorted(atPatches.values(), key=lambda tPatch: tPatch['ulOffset']):
+                    if tPatch['atSignature'] is not None:
+                        atSignature = dict(tPatch['atSignature'])
+                        atSignature['uiChunkIndex'] = uiChunkIndex
+                        atSignature['ulOffset'] = tPatch['ulOffset']
+                        atSignature['sizSignature'] = tPatch['sizData']
+                        self.__atTemplateSignatures.append(atSignature)
+                    tPatch['ulOffset'] += ulChunkOffset
+                    self.__atPendingPatches.append(tPatch)
             self.__atChunkData.extend(tAttr['atData'])
+            # Streamed data is not in the chunk data.
+            for tExtent in tAttr['atExtents']:
+                tExtent = dict(tExtent)
+                tExtent['ulOffset'] += ulChunkOffset
+                self.__atFillExtents.append(tExtent)
+            self.__sizFillExtents += sizExtents
+            if tAttr['sizFill'] != 0:
+                self.__atFillExtents.append({
+                    'ulOffset': ulChunkOffset + sizData,
+                    'sizFill': tAttr['sizFill'],
+                    'ucFill': tAttr['ucFill']
+                })
+                self.__sizFillExtents += tAttr['sizFill']
+            self.__update_chunk_hash(False)
+        self.__atChunkPatches = {}
+
+    def __get_chunk_data_size(self):
+        # Get the size of the chunk data in bytes including the fill extents.
+        return len(self.__atChunkData) * self.__atChunkData.itemsize + self.__sizFillExtents
+
+    def __read_input(self, tInput):
+        # Read the complete input file as plain text.
+        if os.path.isfile(tInput):
+            strPath = tInput
+        else:
+            strPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), tInput)
+
+        # Images for several netX types share the target independent part of
+        # the preprocessing. It depends on the defines and the search paths.
+        tCacheKey = None
+        tEntry = None
+        if self.__cSourceCache is not None:
+            tStat = os.stat(strPath)
+            tCacheKey = (
+                os.path.realpath(strPath),
+                tStat.st_size,
+                tStat.st_mtime_ns,
+                tuple(sorted(self.__atGlobalDefines.items())),
+                tuple(sorted(self.__atKnownFiles.items())),
+                tuple(sorted(self.__atKnownTexts.items())),
+                tuple(self.__astrIncludePaths)
+            )
+            tEntry = self.__cSourceCache.get_document(tCacheKey)
+
+        if tEntry is not None:
+            tXml, self.__astrDependencies = tEntry
+
+        else:
+            # Initialize the list of dependencies.
+            self.__astrDependencies = []
+
+            if self.__cSourceCache is None:
+                tFile = open(strPath, 'rt')
+                strFileContents = tFile.read()
+                tFile.close()
+            else:
+                strFileContents = self.__cSourceCache.get_text_contents(
+                    strPath
+                )
+
+            # Replace and convert to XML.
+            tXml = self.__plaintext_to_xml_with_replace(
+                strFileContents,
+                self.__atGlobalDefines,
+                True
+            )
+
+            self.__preprocess_directives(tXml)
+            if tCacheKey is not None:
+                self.__cSourceCache.add_document(
+                    tCacheKey,
+                    tXml,
+                    self.__astrDependencies
+                )
+
+        # Some netX types replace nodes with snippets.
+        self.__preprocess_netx_type(tXml)
+        self.__preprocess_directives(tXml)
+
+        return tXml
 
     def parse_image(self, tInput):
         # Parsing an image requires the patch definition.
@@ -5209,30 +5487,10 @@ class HbootImage:
                 'function, but none was specified!'
             )
 
-        # Initialize the list of dependencies.
-        self.__astrDependencies = []
-
-        # Read the complete input file as plain text.
-        if os.path.isfile(tInput):
-            tFile = open(tInput, 'rt')
-        else:
-            path = os.path.join(os.path.dirname(os.path.realpath(__file__)), tInput)
-            tFile = open(path, 'rt')
-
-        strFileContents = tFile.read()
-        tFile.close()
-
-        # Replace and convert to XML.
-        tXml = self.__plaintext_to_xml_with_replace(
-            strFileContents,
-            self.__atGlobalDefines,
-            True
-        )
+        # Read and preprocess the image.
+        tXml = self.__read_input(tInput)
         tXmlRootNode = tXml.documentElement
 
-        # Preprocess the image.
-        self.__preprocess(tXml)
-
         # Get the type of the image. Default to "REGULAR".
         strType = tXmlRootNode.getAttribute('type')
         if len(strType) != 0:
@@ -5297,6 +5555,38 @@ class HbootImage:
             self.__atChunkData = array.array('B')
         else:
             self.__atChunkData = array.array('I')
+        self.__atChunkPatches = {}
+        self.__atPendingPatches = []
+        self.__atLayoutChunks = []
+        self.__atTemplateSlots = []
+        self.__atTemplateHashTables = []
+        self.__atTemplateSignatures = []
+        self.__atFillExtents = []
+        self.__sizFillExtents = 0
+        self.__uiHashedFillExtents = 0
+        self.__atHashStatistics = {
+            'uiSubmitted': 0,
+            'uiJobs': 0,
+            'sizBytes': 0,
+            'tHashTime': 0.0,
+            'tStart': 0.0,
+            'tEnd': 0.0
+        }
+
+        # Info pages end with a SHA384 over the chunks, the standard header
+        # has a SHA224. SECMEM images have no hash.
+        if self.__tImageType == self.__IMAGE_TYPE_SECMEM:
+            self.__tChunkHash = None
+        elif(
+            (self.__tImageType == self.__IMAGE_TYPE_COM_INFO_PAGE) or
+            (self.__tImageType == self.__IMAGE_TYPE_APP_INFO_PAGE)
+        ):
+            self.__tChunkHash = hashlib.sha384()
+        else:
+            self.__tChunkHash = hashlib.sha224()
+        if self.__fLayoutOnly is True:
+            self.__tChunkHash = None
+        self.__sizChunkHashBytes = 0
 
         # Get the hash size.
         # Default to 12 DWORDS for info page images.
@@ -5424,8 +5714,543 @@ class HbootImage:
 
         return ucCrc
 
+    def __update_chunk_hash(self, fSignerFlushed):
+        # Patch all finished placeholders and add the chunk data up to the
+        # next open placeholder to the hash. Signatures are only available
+        # after the signer was flushed.
+        sizEnd = len(self.__atChunkData) * self.__atChunkData.itemsize
+        with memoryview(self.__atChunkData) as tView:
+            with tView.cast('B') as aucChunkData:
+                while len(self.__atPendingPatches) != 0:
+                    tPatch = self.__atPendingPatches[0]
+                    ulOffset = tPatch['ulOffset']
+                    if (tPatch['fNeedsSigner'] is True) and (fSignerFlushed is not True):
+                        sizEnd = ulOffset
+                        break
+
+                    # Hash everything up to the placeholder.
+                    self.__hash_chunk_data(aucChunkData, ulOffset)
+
+                    aucData = tPatch['pfnGetData']()
+                    sizData = len(aucData)
+                    if sizData != tPatch['sizData']:
+                        raise Exception(
+                            'The patch has %d bytes, but %d were reserved.' % (
+                                sizData,
+                                tPatch['sizData']
+                            )
+                        )
+                    aucChunkData[ulOffset:ulOffset + sizData] = aucData
+                    self.__atPendingPatches.pop(0)
+
+                self.__hash_chunk_data(aucChunkData, sizEnd)
+
+    def __hash_chunk_data(self, aucChunkData, sizEnd):
+        # The fill extents are not in the chunk data. Add them to the hash
+        # at their offset.
+        atExtents = self.__atFillExtents
+        while True:
+            sizStop = sizEnd
+            tExtent = None
+            if self.__uiHashedFillExtents < len(atExtents):
+                tExtent = atExtents[self.__uiHashedFillExtents]
+                if tExtent['ulOffset'] <= sizEnd:
+                    sizStop = tExtent['ulOffset']
+                else:
+                    tExtent = None
+
+            if sizStop > self.__sizChunkHashBytes:
+                if self.__tChunkHash is not None:
+                    self.__tChunkHash.update(
+                        aucChunkData[self.__sizChunkHashBytes:sizStop]
+                    )
+                self.__sizChunkHashBytes = sizStop
+
+            if tExtent is None:
+                break
+            if self.__tChunkHash is not None:
+                for strBlock in self.__get_extent_blocks(tExtent):
+                    self.__tChunkHash.update(strBlock)
+            self.__uiHashedFillExtents += 1
+
+    def __get_fill_blocks(self, sizFill, ucFill):
+        # Generate a fill area in blocks of at most __sizFillBlock bytes.
+        strBlock = bytes([ucFill]) * min(sizFill, self.__sizFillBlock)
+        while sizFill != 0:
+            sizChunk = min(sizFill, len(strBlock))
+            if sizChunk == len(strBlock):
+                yield strBlock
+            else:
+                yield strBlock[:sizChunk]
+            sizFill -= sizChunk
+
+    def __get_extent_blocks(self, tExtent):
+        # Generate the contents of an extent in blocks. Extents without a
+        # fill value are read from a file.
+        if tExtent['ucFill'] is not None:
+            for strBlock in self.__get_fill_blocks(tExtent['sizFill'], tExtent['ucFill']):
+                yield strBlock
+
+        else:
+            sizLeft = tExtent['sizFill']
+            tFile = open(tExtent['strFile'], 'rb')
+            tFile.seek(tExtent['ulFileOffset'])
+            while sizLeft != 0:
+                strBlock = tFile.read(min(sizLeft, self.__sizStreamBlock))
+                if len(strBlock) == 0:
+                    tFile.close()
+                    raise Exception(
+                        'The file "%s" ends before offset 0x%08x.' % (
+                            tExtent['strFile'],
+                            tExtent['ulFileOffset'] + tExtent['sizFill']
+                        )
+                    )
+                sizLeft -= len(strBlock)
+                yield strBlock
+            tFile.close()
+
+    def __print_hash_statistics(self):
+        atStats = self.__atHashStatistics
+        if atStats['uiJobs'] != 0:
+            tWallTime = atStats['tEnd'] - atStats['tStart']
+            print(
+                '[HBootImage] Hash: %d chunks with %d bytes on %d threads. '
+                'Hash time %.3fs, wall time %.3fs, speedup %.2f.' % (
+                    atStats['uiJobs'],
+                    atStats['sizBytes'],
+                    self.__uiHashThreads,
+                    atStats['tHashTime'],
+                    tWallTime,
+                    atStats['tHashTime'] / max(tWallTime, 1e-9)
+                )
+            )
+
+    def resolve_signatures(self):
+        """ Get all pending signatures from the signer and patch them into
+            the chunks.
+
+            This is done by "write". Call it only to sign several images in
+            one batch: parse all images, flush the signer once and write the
+            images afterwards.
+        """
+        if len(self.__atPendingPatches) != 0:
+            self.__cSigner.flush()
+            self.__update_chunk_hash(True)
+
+        if self.__fVerbose:
+            self.__print_hash_statistics()
+
+    def __build_header(self):
+        # Generate the standard header.
+        atHeaderStandard = self.__build_standard_header()
+
+        # Insert flasher parameters if selected.
+        if self.__fSetFlasherParameters == True:
+            self.__set_flasher_parameters(atHeaderStandard)
+
+        # Combine the standard header with the overrides.
+        return self.__combine_headers(atHeaderStandard)
+
+    def set_known_text(self, strFileId, strText):
+        """Provide the contents of the known file "@strFileId" from memory.
+
+        Include nodes with this name use the text directly. Nothing is read
+        from the disk. The text replaces a known file with the same ID.
+        """
+        self.__atKnownTexts[strFileId] = strText
+
+    def set_register_defaults(self, atRegisterDefaults):
+        """Set the registers of the register model for the optimization.
+
+        atRegisterDefaults is a dict with the address as the key and the
+        default value of the register. Only writes to these registers are
+        optimized. It replaces all values set before.
+        """
+        self.__atRegisterDefaults = dict(atRegisterDefaults)
+
+    def set_drop_register_defaults(self, fDropRegisterDefaults):
+        """Remove writes of the default values of the register model.
+
+        This expects the default values in the hardware before the first
+        chunk of the image.
+        """
+        self.__fDropRegisterDefaults = bool(fDropRegisterDefaults)
+
+    def set_optimize_registers(self, fOptimizeRegisters):
+        """Enable or disable the optimization of Register chunks."""
+        self.__fOptimizeRegisters = bool(fOptimizeRegisters)
+
+    def get_layout_map(self):
+        """ Get the position of the header, all chunks and the end marker
+            in the output file.
+
+            All offsets are file offsets. The "address" of an element is
+            the offset plus the start offset of the image without the
+            padding.
+        """
+        # The truncated hashes are only complete with all signatures.
+        self.resolve_signatures()
+
+        fIsSecmem = (self.__tImageType == self.__IMAGE_TYPE_SECMEM)
+        fIsInfoPage = (
+            (self.__tImageType == self.__IMAGE_TYPE_COM_INFO_PAGE) or
+            (self.__tImageType == self.__IMAGE_TYPE_APP_INFO_PAGE)
+        )
+        astrImageTypes = dict(
+            (tValue, strKey) for strKey, tValue in self.__astrToImageType.items()
+        )
+
+        ulFileOffset = self.__ulPaddingPreSize
+        # The chunk offsets in the parser start at the start offset.
+        lAddressDelta = self.__ulStartOffset - self.__ulPaddingPreSize
+        atLayout = {
+            'netx': self.__strNetxType,
+            'image_type': astrImageTypes[self.__tImageType],
+            'start_offset': self.__ulStartOffset,
+            'padding_pre': {
+                'offset': 0,
+                'size': self.__ulPaddingPreSize,
+                'value': self.__ucPaddingPreValue
+            },
+            'hash_size': self.__sizHashDw,
+            'dry_run': self.__fLayoutOnly,
+            'header': None,
+            'chunks': [],
+            'chunks_hash': None,
+            'end_marker': None
+        }
+
+        if self.__fHasHeader is True:
+            atHeader = self.__build_header()
+            atLayout['header'] = {
+                'offset': ulFileOffset,
+                'address': ulFileOffset + lAddressDelta,
+                'size': 64,
+                'magic': atHeader[0],
+                'chunks_size': atHeader[4] * 4,
+                'hash': None,
+                'checksum': None
+            }
+            # A dry run has no hashes.
+            if self.__fLayoutOnly is not True:
+                atLayout['header']['hash'] = atHeader[8:15].tobytes().hex()
+                atLayout['header']['checksum'] = atHeader[15]
+            ulFileOffset += 64
+
+        # SECMEM images are reorganized in zones when they are written.
+        if fIsSecmem is not True:
+            with memoryview(self.__atChunkData) as tView:
+                with tView.cast('B') as aucChunkData:
+                    for uiChunkIndex, atChunk in enumerate(self.__atLayoutChunks):
+                        ulOffset = atChunk['ulOffset']
+                        sizData = atChunk['sizData']
+                        strTag = None
+                        strHash = None
+                        # Info pages have no tags.
+                        if fIsInfoPage is not True and sizData >= 4:
+                            strTag = bytes(
+                                aucChunkData[ulOffset:ulOffset + 4]
+                            ).decode('ascii', 'replace')
+                            sizHash = self.__sizHashDw * 4
+                            # A dry run has no hashes.
+                            if self.__fLayoutOnly is True:
+                                strHash = None
+                            elif strTag == 'SKIP':
+                                # The hash follows the tag and the size.
+                                strHash = bytes(
+                                    aucChunkData[ulOffset + 8:ulOffset + 8 + sizHash]
+                                ).hex()
+                            elif(
+                                (strTag in self.__astrChunksWithTrailingHash) and
+                                not ((strTag == 'OPTS') and (self.__strNetxType == 'NETX56'))
+                            ):
+                                ulEnd = ulOffset + sizData
+                                strHash = bytes(
+                                    aucChunkData[ulEnd - sizHash:ulEnd]
+                                ).hex()
+                        atLayout['chunks'].append({
+                            'index': uiChunkIndex,
+                            'name': atChunk['strName'],
+                            'tag': strTag,
+                            'offset': ulFileOffset + atChunk['ulImageOffset'],
+                            'address': ulFileOffset + atChunk['ulImageOffset'] + lAddressDelta,
+                            'size': atChunk['sizChunk'],
+                            'load_address': atChunk['ulLoadAddress'],
+                            'hash': strHash
+                        })
+            ulFileOffset += self.__get_chunk_data_size()
+
+            if fIsInfoPage is True:
+                atLayout['chunks_hash'] = {
+                    'offset': ulFileOffset,
+                    'address': ulFileOffset + lAddressDelta,
+                    'size': 48,
+                    'hash': None
+                }
+                if self.__tChunkHash is not None:
+                    atLayout['chunks_hash']['hash'] = self.__tChunkHash.digest().hex()
+                ulFileOffset += 48
+
+            elif self.__fHasEndMarker is True:
+                atLayout['end_marker'] = {
+                    'offset': ulFileOffset,
+                    'address': ulFileOffset + lAddressDelta,
+                    'size': 4
+                }
+
+        return atLayout
+
+    def write_layout_map(self, strTargetPath):
+        """ Write the layout map to strTargetPath.
+
+            Files ending in ".csv" get one line per element. All other
+            files get the complete map as JSON.
+        """
+        atLayout = self.get_layout_map()
+
+        tFile = open(strTargetPath, 'wt', newline='')
+        if strTargetPath.lower().endswith('.csv'):
+            tWriter = csv.writer(tFile)
+            tWriter.writerow([
+                'element',
+                'index',
+                'name',
+                'tag',
+                'offset',
+                'address',
+                'size',
+                'load_address',
+                'hash'
+            ])
+            atPadding = atLayout['padding_pre']
+            if atPadding['size'] != 0:
+                tWriter.writerow([
+                    'padding_pre', '', '', '', 0, '', atPadding['size'], '', ''
+                ])
+            atHeader = atLayout['header']
+            if atHeader is not None:
+                tWriter.writerow([
+                    'header', '', '', '',
+                    atHeader['offset'],
+                    atHeader['address'],
+                    atHeader['size'],
+                    '',
+                    atHeader['hash']
+                ])
+            for atChunk in atLayout['chunks']:
+                ulLoadAddress = atChunk['load_address']
+                tWriter.writerow([
+                    'chunk',
+                    atChunk['index'],
+                    atChunk['name'],
+                    atChunk['tag'] or '',
+                    atChunk['offset'],
+                    atChunk['address'],
+                    atChunk['size'],
+                    '' if ulLoadAddress is None else '0x%08x' % ulLoadAddress,
+                    atChunk['hash'] or ''
+                ])
+            for strElement in ['chunks_hash', 'end_marker']:
+                atElement = atLayout[strElement]
+                if atElement is not None:
+                    tWriter.writerow([
+                        strElement, '', '', '',
+                        atElement['offset'],
+                        atElement['address'],
+                        atElement['size'],
+                        '',
+                        atElement.get('hash', '')
+                    ])
+        else:
+            json.dump(atLayout, tFile, indent=2)
+            tFile.write('\n')
+        tFile.close()
+
+    def __template_get_chunk_offset(self, ulChunksOffset, uiChunkIndex):
+        return ulChunksOffset + self.__atLayoutChunks[uiChunkIndex]['ulImageOffset']
+
+    def __template_get_hash_source(self, ulChunksOffset, uiChunkIndex):
+        # The hash of a chunk covers everything up to the hash.
+        atChunk = self.__atLayoutChunks[uiChunkIndex]
+        if atChunk['fHasTrailingHash'] is not True:
+            raise Exception(
+                'The hash of the %s chunk %d can not be updated.' % (
+                    atChunk['strName'],
+                    uiChunkIndex
+                )
+            )
+        ulStart = self.__template_get_chunk_offset(ulChunksOffset, uiChunkIndex)
+        return ulStart, ulStart + atChunk['sizData'] + atChunk['sizExtents'] - self.__sizHashDw * 4
+
+    def get_template(self):
+        """ Get an ImageTemplate for the compiled image.
+
+            The template patches the nodes with a "slot" attribute and
+            computes all hashes and signatures which depend on them.
+        """
+        self.__check_not_dry_run()
+
+        # The template starts with the complete image.
+        self.resolve_signatures()
+        tImage = io.BytesIO()
+        self.__write_image(tImage, None)
+        strImage = tImage.getvalue()
+
+        sizHash = self.__sizHashDw * 4
+        ulChunksOffset = self.__ulPaddingPreSize
+        if self.__fHasHeader is True:
+            ulChunksOffset += 64
+
+        atSlots = []
+        auiPatchedChunks = set()
+        for atSlot in self.__atTemplateSlots:
+            atSlots.append({
+                'strName': atSlot['strName'],
+                'ulOffset': self.__template_get_chunk_offset(ulChunksOffset, atSlot['uiChunkIndex']) + atSlot['ulOffset'],
+                'sizData': atSlot['sizData'],
+                'strType': atSlot['strType']
+            })
+            auiPatchedChunks.add(atSlot['uiChunkIndex'])
+
+        # The fields are sorted by their dependencies. The hashes of the
+        # chunks come first, then the hash tables and the signatures. The
+        # image hash and the checksum cover everything.
+        atFields = []
+        for uiChunkIndex in sorted(auiPatchedChunks):
+            if self.__atLayoutChunks[uiChunkIndex]['fHasTrailingHash'] is True:
+                ulStart, ulEnd = self.__template_get_hash_source(ulChunksOffset, uiChunkIndex)
+                atFields.append({
+                    'strKind': 'hash',
+                    'strAlgorithm': 'sha384',
+                    'ulStart': ulStart,
+                    'ulEnd': ulEnd,
+                    'ulDst': ulEnd,
+                    'sizDst': sizHash
+                })
+
+        for atEntry in self.__atTemplateHashTables:
+            if atEntry['uiHashedChunkIndex'] in auiPatchedChunks:
+                ulStart, ulEnd = self.__template_get_hash_source(ulChunksOffset, atEntry['uiHashedChunkIndex'])
+                atFields.append({
+                    'strKind': 'hash',
+                    'strAlgorithm': 'sha384',
+                    'ulStart': ulStart,
+                    'ulEnd': ulEnd,
+                    'ulDst': self.__template_get_chunk_offset(ulChunksOffset, atEntry['uiChunkIndex']) + atEntry['ulOffset'],
+                    'sizDst': 48
+                })
+
+        for atSignature in self.__atTemplateSignatures:
+            ulChunkOffset = self.__template_get_chunk_offset(ulChunksOffset, atSignature['uiChunkIndex'])
+            atFields.append({
+                'strKind': 'signature',
+                'strAlgorithm': 'sha384',
+                'ulStart': ulChunkOffset + atSignature['ulSourceOffset'],
+                'ulEnd': ulChunkOffset + atSignature['ulOffset'],
+                'ulDst': ulChunkOffset + atSignature['ulOffset'],
+                'sizDst': atSignature['sizSignature'],
+                'strKeyDER': atSignature['strKeyDER'],
+                'iKeyTyp_1ECC_2RSA': atSignature['iKeyTyp_1ECC_2RSA'],
+                'sizKeyInBytes': atSignature['sizKeyInBytes'],
+                'fConvert': atSignature['fConvert']
+            })
+
+        ulChunksEnd = ulChunksOffset + self.__get_chunk_data_size()
+        if self.__fHasHeader is True:
+            ulHeaderOffset = self.__ulPaddingPreSize
+
+            # The header has a SHA224 over the chunks and the end marker.
+            # Overridden DWORDs are not changed.
+            afWriteDword = [
+                self.__atHeaderOverride[uiIndex] is None for uiIndex in range(8, 15)
+            ]
+            if True in afWriteDword:
+                atFields.append({
+                    'strKind': 'hash',
+                    'strAlgorithm': 'sha224',
+                    'ulStart': ulChunksOffset,
+                    'ulEnd': ulChunksEnd,
+                    'strSuffix': bytes(4),
+                    'ulDst': ulHeaderOffset + 32,
+                    'sizDst': 28,
+                    'afWriteDword': afWriteDword
+                })
+            if self.__atHeaderOverride[0x0f] is None:
+                atFields.append({
+                    'strKind': 'checksum',
+                    'ulStart': ulHeaderOffset,
+                    'ulEnd': ulHeaderOffset + 60,
+                    'ulDst': ulHeaderOffset + 60,
+                    'sizDst': 4
+                })
+
+        elif(
+            (self.__tImageType == self.__IMAGE_TYPE_COM_INFO_PAGE) or
+            (self.__tImageType == self.__IMAGE_TYPE_APP_INFO_PAGE)
+        ):
+            # Info pages end with a SHA384 over the data.
+            atFields.append({
+                'strKind': 'hash',
+                'strAlgorithm': 'sha384',
+                'ulStart': ulChunksOffset,
+                'ulEnd': ulChunksEnd,
+                'ulDst': ulChunksEnd,
+                'sizDst': 48
+            })
+
+        return image_template.ImageTemplate(
+            strImage,
+            atSlots,
+            atFields,
+            self.__cSigner
+        )
+
+    def dry_run(self, tInput):
+        """ Compute only the layout of an image and return the layout map.
+
+            The chunks get their final size and position, but the payload
+            of files is not read. Only the size of binary files and the
+            section headers of ELF files are used. All hashes and
+            signatures are left empty. The image can not be written
+            afterwards.
+        """
+        self.__fLayoutOnly = True
+        self.parse_image(tInput)
+        return self.get_layout_map()
+
+    def __check_not_dry_run(self):
+        if self.__fLayoutOnly is True:
+            raise Exception('The image was compiled in a dry run. It has no data.')
+
     def write(self, strTargetPath):
         """ Write all compiled chunks to the file strTargetPath . """
+        self.__check_not_dry_run()
+
+        # The header and the hashes need the final signatures.
+        self.resolve_signatures()
+
+        tFile = open(strTargetPath, 'wb')
+        self.__write_image(tFile, self.__strSparseMode)
+        tFile.close()
+
+    def close(self):
+        """ Stop the worker threads of the image.
+
+            This closes the signer if the image created it. A signer passed
+            to the constructor must be closed by the caller. Templates from
+            "get_template" use the signer of the image, so close the image
+            only after the last template is generated.
+        """
+        if self.__fOwnsSigner is True:
+            self.__cSigner.close()
+            self.__fOwnsSigner = False
+        if self.__tHashPool is not None:
+            self.__tHashPool.shutdown(wait=True)
+            self.__tHashPool = None
+
+    def __write_image(self, tFile, strSparseMode):
+        # Only info pages have a hash after the chunks.
+        atChunkHash = None
 
         if self.__tImageType == self.__IMAGE_TYPE_SECMEM:
             # Collect data for zone 2 and 3.
@@ -5523,50 +6348,112 @@ class HbootImage:
                     'bytes, but it is %d bytes.' % sizChunksInDWORDs
                 )
 
-            # Build the hash for the info page.
-            tHash = hashlib.sha384()
-            tHash.update(atChunks.tobytes())
-            strHash = tHash.digest()
-            aulHash = array.array('I', strHash)
-            atChunks.extend(aulHash)
+            # The hash for the info page follows the chunks.
+            atChunkHash = array.array('I', self.__tChunkHash.digest())
 
         else:
-            # Get a copy of the chunk data.
-            atChunks = array.array('I', self.__atChunkData)
-
-            # Terminate the chunks with a DWORD of 0.
-            atChunks.append(0x00000000)
-
-            # Generate the standard header.
-            atHeaderStandard = self.__build_standard_header(atChunks)
-
-            # Insert flasher parameters if selected.
-            if self.__fSetFlasherParameters == True:
-                self.__set_flasher_parameters(atHeaderStandard)
-
-            # Combine the standard header with the overrides.
-            atHeader = self.__combine_headers(atHeaderStandard)
+            atHeader = self.__build_header()
 
-            # Get a fresh copy of the chunk data.
-            atChunks = array.array('I', self.__atChunkData)
+            atChunks = self.__atChunkData
 
             # Terminate the chunks with a DWORD of 0.
             atEndMarker = array.array('I', [0x00000000])
 
-        # Write all components to the output file.
-        tFile = open(strTargetPath, 'wb')
+        # Collect all components of the output file. Fill areas are only
+        # a size and a fill value. Streamed areas have their extent instead
+        # of the data.
+        atSegments = []
         if self.__ulPaddingPreSize != 0:
-            atPadding = array.array(
-                'B',
-                [self.__ucPaddingPreValue] * self.__ulPaddingPreSize
+            atSegments.append(
+                (self.__ulPaddingPreSize, self.__ucPaddingPreValue, None)
             )
-            atPadding.tofile(tFile)
         if self.__fHasHeader is True:
-            atHeader.tofile(tFile)
-        atChunks.tofile(tFile)
-        if self.__fHasEndMarker is True:
-            atEndMarker.tofile(tFile)
-        tFile.close()
+            atSegments.append((len(atHeader) * 4, None, atHeader))
+
+        with memoryview(atChunks) as tView:
+            with tView.cast('B') as aucChunks:
+                # Insert the fill extents into the chunk data.
+                ulOffset = 0
+                if atChunks is self.__atChunkData:
+                    for tExtent in self.__atFillExtents:
+                        ulExtentOffset = tExtent['ulOffset']
+                        if ulExtentOffset > ulOffset:
+                            atSegments.append((
+                                ulExtentOffset - ulOffset,
+                                None,
+                                aucChunks[ulOffset:ulExtentOffset]
+                            ))
+                        if tExtent['ucFill'] is None:
+                            atSegments.append(
+                                (tExtent['sizFill'], None, tExtent)
+                            )
+                        else:
+                            atSegments.append(
+                                (tExtent['sizFill'], tExtent['ucFill'], None)
+                            )
+                        ulOffset = ulExtentOffset
+                if len(aucChunks) > ulOffset:
+                    atSegments.append((
+                        len(aucChunks) - ulOffset,
+                        None,
+                        aucChunks[ulOffset:]
+                    ))
+
+                if atChunkHash is not None:
+                    atSegments.append((len(atChunkHash) * 4, None, atChunkHash))
+                if self.__fHasEndMarker is True:
+                    atSegments.append(
+                        (len(atEndMarker) * atEndMarker.itemsize, None, atEndMarker)
+                    )
+
+                # Write all components to the output file.
+                if strSparseMode == 'extents':
+                    self.__write_extent_list(tFile, atSegments)
+                else:
+                    self.__write_segments(tFile, atSegments, strSparseMode)
+
+                # Release the views on the chunk data.
+                for _, _, tData in atSegments:
+                    if isinstance(tData, memoryview):
+                        tData.release()
+
+    def __write_segments(self, tFile, atSegments, strSparseMode):
+        # Write the data and the fill areas. Areas filled with 0x00 become
+        # holes in sparse mode.
+        for sizSegment, ucFill, tData in atSegments:
+            if isinstance(tData, dict):
+                for strBlock in self.__get_extent_blocks(tData):
+                    tFile.write(strBlock)
+            elif tData is not None:
+                tFile.write(tData)
+            elif (strSparseMode == 'holes') and (ucFill == 0x00):
+                tFile.seek(sizSegment, os.SEEK_CUR)
+            else:
+                for strBlock in self.__get_fill_blocks(sizSegment, ucFill):
+                    tFile.write(strBlock)
+        # A hole at the end of the file is only created by the size.
+        tFile.truncate()
+
+    def __write_extent_list(self, tFile, atSegments):
+        # The extent list starts with the magic "HBEX", a version, the size
+        # of the complete image and the number of extents. Each extent has
+        # the offset in the image, the size and the flags. A set bit 8 in
+        # the flags marks a fill area with the fill value in bits 0-7. All
+        # other extents are followed by their data.
+        sizImage = sum(tSegment[0] for tSegment in atSegments)
+        tFile.write(struct.pack('<4sIII', b'HBEX', 1, sizImage, len(atSegments)))
+        ulOffset = 0
+        for sizSegment, ucFill, tData in atSegments:
+            if tData is None:
+                tFile.write(struct.pack('<III', ulOffset, sizSegment, 0x100 | ucFill))
+            else:
+                tFile.write(struct.pack('<III', ulOffset, sizSegment, 0))
+                if isinstance(tData, dict):
+                    for strBlock in self.__get_extent_blocks(tData):
+                        tFile.write(strBlock)
+                else:
+                    tFile.write(tData)
+            ulOffset += sizSegment
 
     def dependency_scan(self, strInput):
         tXml = xml.dom.minidom.parse(strInput)
@@ -32,11 +32,53 @@ tParserD = tSubparsers.add_parser('update_hwconfig',
     description = 'Update a hardware config from an older version to be compatible  with the current hwconfig GUI.',
     help='update_hwconfig -h')
 
+tParserG = tSubparsers.add_parser('update_hwconfig_tree',
+    description = 'Update all hardware configs in a directory tree to the current version. Only files which change are written.',
+    help='update_hwconfig_tree -h')
+
+tParserF = tSubparsers.add_parser('watch_hboot_xml',
+    description = 'Generate a HBoot XML file from a hardware configuration and update it after each change of the hardware configuration.',
+    help='watch_hboot_xml -h')
+
+tParserE = tSubparsers.add_parser('make_hboot_xml_batch',
+    description = 'Generate HBoot XML files for many hardware configurations. The peripheral definitions are read only once.',
+    help='make_hboot_xml_batch -h')
+
 tParserA.add_argument('-p', '--peripherals',
                      dest='strPeripheralsFile',
                      required=True,
                      metavar='FILE',
                      help='Read the peripheral definition from FILE.')
+tParserA.add_argument('--model-cache',
+                     dest='strModelCacheFolder',
+                     required=False,
+                     default=None,
+                     metavar='PATH',
+                     help='Keep the compiled peripheral definitions in PATH.')
+tParserA.add_argument('--script-times',
+                     dest='fScriptTimes',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='Show the execution time of all peripheral, constraint and template scripts.')
+tParserA.add_argument('-i', '--hboot-image',
+                     dest='strImageTemplate',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Compile the HBoot XML with the top level definition FILE and write the HBoot image instead. FILE must include "@hw_config", like top_hboot_image_hwc.xml.')
+tParserA.add_argument('--optimize-registers',
+                     dest='fOptimizeRegisters',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='Merge adjacent writes to the registers of the peripheral definition in the Register chunks of the HBoot image and print the number of saved words. This is only available with "-i".')
+tParserA.add_argument('--drop-register-defaults',
+                     dest='fDropRegisterDefaults',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='With "--optimize-registers" also remove writes of the default values from the peripheral definition. Only use this if the defaults are the reset values. They are only used if no chunk runs before the first Register chunk.')
 tParserA.add_argument('-v', '--verbose',
                      dest='tVerboseLevel',
                      required=False,
@@ -52,6 +94,121 @@ tParserA.add_argument('strOutputFile',
                      help='Write the HBoot image to FILE.')
 tParserA.set_defaults(func=hwconfig.make_hboot_xml)
 
+# Arguments for make_hboot_xml_batch
+tParserE.add_argument('-p', '--peripherals',
+                     dest='strPeripheralsFile',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Read the peripheral definition from FILE. The default is the definition for the chip type of each hardware config.')
+tParserE.add_argument('-l', '--list',
+                     dest='strListFile',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Read the hwconfig and output files from FILE. Each line has one pair.')
+tParserE.add_argument('-j', '--jobs',
+                     dest='uiJobs',
+                     required=False,
+                     default=1,
+                     type=int,
+                     metavar='N',
+                     help='Process the hardware configs in N processes. 0 uses one process for each CPU. The default is 1.')
+tParserE.add_argument('--model-cache',
+                     dest='strModelCacheFolder',
+                     required=False,
+                     default=None,
+                     metavar='PATH',
+                     help='Keep the compiled peripheral definitions in PATH.')
+tParserE.add_argument('--script-times',
+                     dest='fScriptTimes',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='Show the execution time of all scripts. This is only available with one process.')
+tParserE.add_argument('-i', '--hboot-image',
+                     dest='strImageTemplate',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Compile the HBoot XML with the top level definition FILE and write the HBoot image instead. FILE must include "@hw_config", like top_hboot_image_hwc.xml.')
+tParserE.add_argument('--optimize-registers',
+                     dest='fOptimizeRegisters',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='Merge adjacent writes to the registers of the peripheral definition in the Register chunks of the HBoot image and print the number of saved words. This is only available with "-i".')
+tParserE.add_argument('--drop-register-defaults',
+                     dest='fDropRegisterDefaults',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='With "--optimize-registers" also remove writes of the default values from the peripheral definition. Only use this if the defaults are the reset values. They are only used if no chunk runs before the first Register chunk.')
+tParserE.add_argument('-v', '--verbose',
+                     dest='tVerboseLevel',
+                     required=False,
+                     default='info',
+                     choices=atLogLevels.keys(),
+                     metavar='LEVEL',
+                     help='Set the log level to LEVEL. Possible values for LEVEL are %s' % ', '.join(atLogLevels.keys()))
+tParserE.add_argument('astrFiles',
+                     nargs='*',
+                     metavar='FILE',
+                     help='Pairs of hwconfig and output files.')
+tParserE.set_defaults(func=hwconfig.make_hboot_xml_batch)
+
+
+# Arguments for watch_hboot_xml
+tParserF.add_argument('-p', '--peripherals',
+                     dest='strPeripheralsFile',
+                     required=True,
+                     metavar='FILE',
+                     help='Read the peripheral definition from FILE.')
+tParserF.add_argument('--model-cache',
+                     dest='strModelCacheFolder',
+                     required=False,
+                     default=None,
+                     metavar='PATH',
+                     help='Keep the compiled peripheral definitions in PATH.')
+tParserF.add_argument('-i', '--hboot-image',
+                     dest='strImageTemplate',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Compile the HBoot XML with the top level definition FILE and write the HBoot image instead. FILE must include "@hw_config", like top_hboot_image_hwc.xml.')
+tParserF.add_argument('--optimize-registers',
+                     dest='fOptimizeRegisters',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='Merge adjacent writes to the registers of the peripheral definition in the Register chunks of the HBoot image and print the number of saved words. This is only available with "-i".')
+tParserF.add_argument('--drop-register-defaults',
+                     dest='fDropRegisterDefaults',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='With "--optimize-registers" also remove writes of the default values from the peripheral definition. Only use this if the defaults are the reset values. They are only used if no chunk runs before the first Register chunk.')
+tParserF.add_argument('--interval',
+                     dest='fInterval',
+                     required=False,
+                     default=0.5,
+                     type=float,
+                     metavar='SECONDS',
+                     help='Check the hwconfig for changes every SECONDS. The default is 0.5.')
+tParserF.add_argument('-v', '--verbose',
+                     dest='tVerboseLevel',
+                     required=False,
+                     default='info',
+                     choices=atLogLevels.keys(),
+                     metavar='LEVEL',
+                     help='Set the log level to LEVEL. Possible values for LEVEL are %s' % ', '.join(atLogLevels.keys()))
+tParserF.add_argument('strHwConfigFile',
+                     metavar='FILE',
+                     help='Read the hwconfig from FILE.')
+tParserF.add_argument('strOutputFile',
+                     metavar='FILE',
+                     help='Write the HBoot XML to FILE.')
+tParserF.set_defaults(func=hwconfig.watch_hboot_xml)
 
 # Arguments for list_supported_targets
 tParserB.add_argument('-o', '--output', 
@@ -83,6 +240,12 @@ tParserC.add_argument('-o', '--output',
                      required=False,
                      metavar='FILE',
                      help='write the dynamic cfg to FILE.')
+tParserC.add_argument('--index',
+                     dest='strIndexFile',
+                     required=False,
+                     default=None,
+                     metavar='FILE',
+                     help='Keep the index of the overlays in FILE. Only changed folders and files are read again.')
 tParserC.set_defaults(func=hwconfig.list_dynamic_cfg)
 
 tParserD.add_argument('strHwConfigFile',
@@ -94,6 +257,31 @@ tParserD.add_argument('strOutputFile',
                      help='Write the updated hwconfig to FILE.')
 tParserD.set_defaults(func=hwconfig.update_hwconfig)
 
+# Arguments for update_hwconfig_tree
+tParserG.add_argument('--pattern',
+                     dest='strPattern',
+                     required=False,
+                     default='*.xml',
+                     metavar='PATTERN',
+                     help='Update only files matching PATTERN. The default is "*.xml".')
+tParserG.add_argument('-j', '--jobs',
+                     dest='uiJobs',
+                     required=False,
+                     default=0,
+                     type=int,
+                     metavar='N',
+                     help='Update the files in N processes. 0 uses one process for each CPU. This is the default.')
+tParserG.add_argument('-n', '--dry-run',
+                     dest='fDryRun',
+                     required=False,
+                     default=False,
+                     action='store_true',
+                     help='Only show which files would be updated.')
+tParserG.add_argument('strPath',
+                     metavar='PATH',
+                     help='Update all hardware configs below PATH.')
+tParserG.set_defaults(func=hwconfig.update_hwconfig_tree)
+
 
 # Parse args
 tArgs = tMainParser.parse_args()
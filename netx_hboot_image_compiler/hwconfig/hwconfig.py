@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
   
 import argparse
+import array
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
 import logging
+import marshal
+import os
 import os.path
 import fnmatch
+import pickle
+import shlex
 import string
+import tempfile
+import time
 import xml.etree.ElementTree as ElementTree
 #import ElementTree_keep_attr_order as ElementTree
 import xml.dom.minidom as dom
 from . import hwconfig_version
+from .. import hboot_image
+from .. import source_cache
 
 # Import version info.
 # This is the version of the HWConfig tool.
@@ -323,48 +336,96 @@ class HwConfig:
     def write_hwconfig(self, strOutputPath):
         logging.info('Writing hwconfig to "%s".' % strOutputPath)
         tElementTree = ElementTree.ElementTree(self.__tXmlRoot)
-        tFile = open(strOutputPath, 'wt')
+        tFile = open(strOutputPath, 'wb')
         tElementTree.write(tFile, encoding="UTF-8", xml_declaration=True, method="xml")
         tFile.close()
 
+    def __apply_pad(self, tPadCtrl):
+        # Get the pad name.
+        strPadID = tPadCtrl['id']
+        # Get the drive strength.
+        tDriveStrength = tPadCtrl['drive_strength']
+        # Get the pull enable.
+        tPullEnable = tPadCtrl['pull_enable']
+        # Get the input enable.
+        tInputEnable = tPadCtrl['input_enable']
+        # Apply the pad control values.
+        self.__cPeripherals.set_pad_ctrl(strPadID, tDriveStrength, tPullEnable, tInputEnable)
+
+    def __apply_mmio(self, tMmio):
+        # Get the pad name.
+        strID = tMmio['id'].upper()
+
+        # The "signal" attribut must be set.
+        tSignal = tMmio['signal']
+        if tSignal is not None:
+            strSignal = tSignal.upper()
+            self.__cPeripherals.mmio_set_signal(strID, strSignal)
+
+    def __apply_peripheral(self, tPeripheral):
+        strID = tPeripheral['id']
+        strOwner = 'peripheral %s' % strID
+        self.__cPeripherals.apply_peripheral(strID, tPeripheral['config_id'], tPeripheral['config'], tPeripheral['verbatim'], strOwner)
+
     def apply_pads(self):
         # Loop over all pads.
         for tPadCtrl in self.__atPadCtrl:
-            # Get the pad name.
-            strPadID = tPadCtrl['id']
-            # Get the drive strength.
-            tDriveStrength = tPadCtrl['drive_strength']
-            # Get the pull enable.
-            tPullEnable = tPadCtrl['pull_enable']
-            # Get the input enable.
-            tInputEnable = tPadCtrl['input_enable']
-            # Apply the pad control values.
-            self.__cPeripherals.set_pad_ctrl(strPadID, tDriveStrength, tPullEnable, tInputEnable)
+            self.__apply_pad(tPadCtrl)
 
     def apply_mmio_config(self):
         # Loop over all pads.
         for tMmio in self.__atMMIO:
-            # Get the pad name.
-            strID = tMmio['id'].upper()
-
-            # The "signal" attribut must be set.
-            tSignal = tMmio['signal']
-            if tSignal is not None:
-                strSignal = tSignal.upper()
-                self.__cPeripherals.mmio_set_signal(strID, strSignal)
+            self.__apply_mmio(tMmio)
 
     def apply_peripherals(self):
         # Loop over all peripherals.
         for tPeripheral in self.__atPeripherals:
-            strID = tPeripheral['id']
-            strOwner = 'peripheral %s' % strID
-            self.__cPeripherals.apply_peripheral(strID, tPeripheral['config_id'], tPeripheral['config'], tPeripheral['verbatim'], strOwner)
+            self.__apply_peripheral(tPeripheral)
 
     def apply_sdram(self):
         if self.__atSDRAM is not None:
             atSDRAM = self.__atSDRAM
             self.__cPeripherals.apply_sdram_settings(atSDRAM['general_ctrl'], atSDRAM['timing_ctrl'], atSDRAM['mode_register'])
 
+    # Get all settings as units in the order they are applied.
+    # Each unit is a tuple with a key, the data for apply_unit and a
+    # signature. The key is the kind, the ID and the number of the ID, as
+    # some IDs can appear more than once. The signature changes with the
+    # settings of the unit.
+    def get_units(self):
+        atUnits = []
+        atCounts = {}
+        for strKind, atEntries in [('pad', self.__atPadCtrl), ('mmio', self.__atMMIO), ('peripheral', self.__atPeripherals)]:
+            for tEntry in atEntries:
+                tCountKey = (strKind, tEntry['id'])
+                uiCount = atCounts.get(tCountKey, 0)
+                atCounts[tCountKey] = uiCount + 1
+                if strKind == 'peripheral':
+                    tSignature = (
+                        tEntry['config_id'],
+                        tuple(sorted(tEntry['config'].items())),
+                        tuple(ElementTree.tostring(tNode) for tNode in tEntry['verbatim'])
+                    )
+                else:
+                    tSignature = tuple(sorted(tEntry.items()))
+                atUnits.append(((strKind, tEntry['id'], uiCount), tEntry, tSignature))
+        if self.__atSDRAM is not None:
+            atUnits.append((('sdram', None, 0), self.__atSDRAM, tuple(sorted(self.__atSDRAM.items()))))
+        return atUnits
+
+    def apply_unit(self, tKey, tData):
+        strKind = tKey[0]
+        if strKind == 'pad':
+            self.__apply_pad(tData)
+        elif strKind == 'mmio':
+            self.__apply_mmio(tData)
+        elif strKind == 'peripheral':
+            self.__apply_peripheral(tData)
+        elif strKind == 'sdram':
+            self.apply_sdram()
+        else:
+            raise Exception('Unknown unit "%s".' % strKind)
+
 
     #
     # Update SQI config
@@ -773,13 +834,80 @@ class Peripherals:
     __strHwConfigChipType = None
 
     __tXmlRoot = None
-    __atRegisters = None
     __atIoConfigurations = None
     __atPeripherals = None
     __atAffectedPins = None
+    __atPinOwners = None
     __atConstraints = None
     __strTemplate = None
 
+    # The parsed peripheral definitions are shared by all instances in this
+    # process. The key is the SHA384 of the XML together with the tool
+    # version. The model is stored pickled, so each instance gets its own
+    # registers.
+    __atModelCache = {}
+    __MODEL_FORMAT = 4
+
+    # These are the compiled scripts of the peripherals, the constraints
+    # and the template. The key is the file ID of the script.
+    __atScripts = None
+
+    # All scripts run with the same globals.
+    __atSandboxGlobals = None
+
+    # This is the number of runs and the execution time for each script.
+    __atScriptTimes = None
+
+    # The registers and bitfields are kept in flat arrays. Registers and
+    # bitfields have integer IDs. The bitfields of a register are
+    # consecutive. The bitfields of the register with the ID i are the
+    # IDs from __auiRegisterBitfields[i] to __auiRegisterBitfields[i+1]-1.
+    # __alRegisterAddress is -1 for registers without an address.
+    __astrRegisterPaths = None
+    __alRegisterAddress = None
+    __auiRegisterBitfields = None
+    __astrBitfieldIDs = None
+    __auiBitfieldRegister = None
+    __aucBitfieldStart = None
+    __aucBitfieldWidth = None
+    __aulBitfieldDefault = None
+
+    # These are computed from the arrays above. The indexes translate a
+    # path to the ID of the register or bitfield.
+    __atRegisterIndex = None
+    __atBitfieldIndex = None
+    __aulBitfieldMask = None
+    __aulRegisterDefault = None
+    __aulRegisterMask = None
+
+    # This is the state of the registers. It has the current value of each
+    # register and the owner of each bitfield. The owner is an index in
+    # __astrOwners. The index 0 marks a free bitfield.
+    # __aulRegisterOwned has the mask of all bitfields with an owner for
+    # each register.
+    __aulRegisterValue = None
+    __auiBitfieldOwner = None
+    __aulRegisterOwned = None
+    __astrOwners = None
+    __atOwnerIndex = None
+
+    # This is the owner for pins which are set by scripts. It is the
+    # peripheral or constraint which is running.
+    __strCurrentOwner = None
+
+    # Conflicting settings are collected here. They are reported all at once
+    # by check_conflicts.
+    __atConflicts = None
+
+    # This translates the pad ID to the path of the pad_ctrl register.
+    __atPadCtrlIndex = None
+
+    # The journals record the bitfields and pins which are written and the
+    # bitfields which are read by each unit of an incremental build. The key
+    # is the unit key. __atJournal is the journal of the running unit.
+    __atJournals = None
+    __atJournal = None
+
     # Translate the name from pad_config/pin/@id to a valid pad_ctrl register name.
     # Note: the registers must be ordered by address. 
     __atPadCtrlRegisters = [
@@ -973,6 +1101,9 @@ class Peripherals:
         logging.debug('Created a new Peripherals instance.')
         # All pins are free by default.
         self.__atAffectedPins = {}
+        self.__atPinOwners = {}
+        self.__atConflicts = []
+        self.__atScriptTimes = {}
 
     def get_version(self):
         return self.__strVersion
@@ -991,12 +1122,16 @@ class Peripherals:
 
     def set_hwconfig_doc_version(self, strDocVersion):
         self.__strHwConfigDocVersion = strDocVersion
+        if self.__atSandboxGlobals is not None:
+            self.__atSandboxGlobals['HWCONFIG_DOC_VERSION'] = strDocVersion
         
     def get_hwconfig_doc_version(self):
         return self.__strHwConfigDocVersion
         
     def set_hwconfig_chip_type(self, strChipType):
         self.__strHwConfigChipType = strChipType
+        if self.__atSandboxGlobals is not None:
+            self.__atSandboxGlobals['HWCONFIG_CHIP_TYPE'] = strChipType
         
     def get_hwconfig_chip_type(self):
         return self.__strHwConfigChipType
@@ -1048,7 +1183,66 @@ class Peripherals:
 
         return atAffectedPins
 
-    def read(self, strInputPath):
+    def __get_model_key(self, strXml):
+        tHash = hashlib.sha384()
+        tHash.update(strXml.encode('utf-8'))
+        tHash.update(('%s/%d' % (hwconfig_tool_version_short, self.__MODEL_FORMAT)).encode('utf-8'))
+        # The compiled scripts depend on the Python version.
+        tHash.update(importlib.util.MAGIC_NUMBER)
+        return tHash.hexdigest()
+
+    def __get_model(self):
+        return {
+            'version': self.__strVersion,
+            'chiptypes': self.__strChiptypes,
+            'registers': {
+                'paths': self.__astrRegisterPaths,
+                'addresses': self.__alRegisterAddress,
+                'bitfields': self.__auiRegisterBitfields,
+                'bitfield_ids': self.__astrBitfieldIDs,
+                'bitfield_register': self.__auiBitfieldRegister,
+                'bitfield_start': self.__aucBitfieldStart,
+                'bitfield_width': self.__aucBitfieldWidth,
+                'bitfield_default': self.__aulBitfieldDefault
+            },
+            'ioconfigs': self.__atIoConfigurations,
+            'peripherals': self.__atPeripherals,
+            'constraints': self.__atConstraints,
+            'template': self.__strTemplate,
+            'scripts': marshal.dumps(self.__atScripts)
+        }
+
+    def __set_model(self, atModel):
+        self.__strVersion = atModel['version']
+        self.__strChiptypes = atModel['chiptypes']
+        self.__astrChiptypes = self.__strChiptypes.split(",")
+        self.__set_register_model(atModel['registers'])
+        self.__atIoConfigurations = atModel['ioconfigs']
+        self.__atPeripherals = atModel['peripherals']
+        self.__atConstraints = atModel['constraints']
+        self.__strTemplate = atModel['template']
+        self.__atScripts = marshal.loads(atModel['scripts'])
+
+    def __model_cache_read(self, strCacheFolder, strKey):
+        strModel = None
+        strPath = os.path.join(strCacheFolder, '%s.pickle' % strKey)
+        if os.path.isfile(strPath):
+            tFile = open(strPath, 'rb')
+            strModel = tFile.read()
+            tFile.close()
+        return strModel
+
+    def __model_cache_write(self, strCacheFolder, strKey, strModel):
+        if os.path.isdir(strCacheFolder) is not True:
+            os.makedirs(strCacheFolder)
+        # Write to a temp file first, so parallel runs never see a
+        # half-written entry.
+        tFile = tempfile.NamedTemporaryFile(mode='wb', dir=strCacheFolder, delete=False)
+        tFile.write(strModel)
+        tFile.close()
+        os.replace(tFile.name, os.path.join(strCacheFolder, '%s.pickle' % strKey))
+
+    def read(self, strInputPath, strCacheFolder=None):
         logging.debug('Reading the peripherals definition from "%s".' % strInputPath)
 
         if os.path.isfile(strInputPath):
@@ -1059,6 +1253,47 @@ class Peripherals:
 
         strXml = tFile.read()
         tFile.close()
+
+        # Use the compiled model if this definition was already parsed with
+        # this tool version.
+        strKey = self.__get_model_key(strXml)
+        strModel = Peripherals.__atModelCache.get(strKey)
+        if (strModel is None) and (strCacheFolder is not None):
+            strModel = self.__model_cache_read(strCacheFolder, strKey)
+            if strModel is not None:
+                Peripherals.__atModelCache[strKey] = strModel
+
+        if strModel is not None:
+            logging.debug('Using the compiled peripherals definition %s.' % strKey)
+            self.__set_model(pickle.loads(strModel))
+
+        else:
+            self.__parse(strXml)
+            self.__atScripts = self.__compile_scripts()
+            strModel = pickle.dumps(self.__get_model(), pickle.HIGHEST_PROTOCOL)
+            Peripherals.__atModelCache[strKey] = strModel
+            if strCacheFolder is not None:
+                self.__model_cache_write(strCacheFolder, strKey, strModel)
+
+    def __compile_script(self, atScripts, strCode, strFileID):
+        # Scripts with errors are compiled again when they are used. This
+        # reports the error only for the scripts which are really used.
+        if strCode is not None:
+            try:
+                atScripts[strFileID] = compile(strCode.strip(), strFileID, 'exec')
+            except SyntaxError:
+                pass
+
+    def __compile_scripts(self):
+        atScripts = {}
+        for strID, atPeripheral in self.__atPeripherals.items():
+            self.__compile_script(atScripts, atPeripheral['code'], 'Peripheral code for %s' % strID)
+        for strID, atConstraint in self.__atConstraints.items():
+            self.__compile_script(atScripts, atConstraint['code'], 'Constraint code for %s' % strID)
+        self.__compile_script(atScripts, self.__strTemplate, 'Template code')
+        return atScripts
+
+    def __parse(self, strXml):
         tXmlRoot = ElementTree.fromstring(strXml)
         self.__tXmlRoot = tXmlRoot
 
@@ -1087,11 +1322,22 @@ class Peripherals:
             if strPath in atRegisters:
                 raise Exception('The register "%s" is already defined.' % strPath)
 
+            # The "address" attribute is optional. Helper registers have no
+            # address.
+            ulAddress = None
+            if 'address' in tNodeRegister.attrib:
+                try:
+                    ulAddress = int(tNodeRegister.attrib['address'], 0)
+                except ValueError:
+                    logging.error('Attribute "address" in register definition is no number.')
+                    raise Exception('Invalid peripheral definition.')
+
             # Collect all bitfields.
             atRegister = {}
             atBitfields = {}
             atRegister['bitfields'] = atBitfields
             atRegister['path'] = strPath
+            atRegister['address'] = ulAddress
             for tNodeBitfield in tNodeRegister.findall('Bitfield'):
                 fAllOK = True
                 # The id attribute is required.
@@ -1149,7 +1395,7 @@ class Peripherals:
                 atBitfields[strID] = atBitfield
             atRegisters[strPath] = atRegister
 
-        self.__atRegisters = atRegisters
+        self.__set_register_model(self.__compact_registers(atRegisters))
 
         # Parse all IO configurations.
         atIoConfigurations = {}
@@ -1228,137 +1474,320 @@ class Peripherals:
             raise Exception('No "Template" node found.')
         self.__strTemplate = tNodeTemplate.text.strip()
 
-    def __bitfield_get_value(self, atBitfield, bOnlyDefaults=False):
-        strPath = atBitfield['path']
-        strBitfield = atBitfield['id']
+    def __compact_registers(self, atRegisters):
+        # Convert the registers from the definition to flat arrays.
+        astrRegisterPaths = []
+        alRegisterAddress = array.array('q')
+        auiRegisterBitfields = array.array('I', [0])
+        astrBitfieldIDs = []
+        auiBitfieldRegister = array.array('I')
+        aucBitfieldStart = array.array('B')
+        aucBitfieldWidth = array.array('B')
+        aulBitfieldDefault = array.array('I')
+        for strPath, atRegister in atRegisters.items():
+            uiRegister = len(astrRegisterPaths)
+            astrRegisterPaths.append(strPath)
+            if atRegister['address'] is None:
+                alRegisterAddress.append(-1)
+            else:
+                alRegisterAddress.append(atRegister['address'])
+            ulRegisterMask = 0
+            for strBitfield, atBitfield in atRegister['bitfields'].items():
+                ulStart = atBitfield['start']
+                ulWidth = atBitfield['width']
+                if (ulWidth < 1) or (ulStart + ulWidth > 32):
+                    raise Exception('The bitfield %s of register %s does not fit into 32 bits.' % (strBitfield, strPath))
+                ulMask = ((1 << ulWidth) - 1) << ulStart
+                if (ulRegisterMask & ulMask) != 0:
+                    raise Exception('The bitfield %s of register %s overlaps another bitfield.' % (strBitfield, strPath))
+                ulRegisterMask |= ulMask
+                if atBitfield['default'] >= (1 << ulWidth):
+                    raise Exception('The default value 0x%08x exceeds the bitfield %s of register %s.' % (atBitfield['default'], strBitfield, strPath))
+
+                astrBitfieldIDs.append(strBitfield)
+                auiBitfieldRegister.append(uiRegister)
+                aucBitfieldStart.append(ulStart)
+                aucBitfieldWidth.append(ulWidth)
+                aulBitfieldDefault.append(atBitfield['default'])
+            auiRegisterBitfields.append(len(astrBitfieldIDs))
+
+        return {
+            'paths': astrRegisterPaths,
+            'addresses': alRegisterAddress,
+            'bitfields': auiRegisterBitfields,
+            'bitfield_ids': astrBitfieldIDs,
+            'bitfield_register': auiBitfieldRegister,
+            'bitfield_start': aucBitfieldStart,
+            'bitfield_width': aucBitfieldWidth,
+            'bitfield_default': aulBitfieldDefault
+        }
 
+    def __set_register_model(self, atRegisters):
+        self.__astrRegisterPaths = atRegisters['paths']
+        self.__alRegisterAddress = atRegisters['addresses']
+        self.__auiRegisterBitfields = atRegisters['bitfields']
+        self.__astrBitfieldIDs = atRegisters['bitfield_ids']
+        self.__auiBitfieldRegister = atRegisters['bitfield_register']
+        self.__aucBitfieldStart = atRegisters['bitfield_start']
+        self.__aucBitfieldWidth = atRegisters['bitfield_width']
+        self.__aulBitfieldDefault = atRegisters['bitfield_default']
+
+        # Build the indexes and the masks.
+        self.__atRegisterIndex = {}
+        for uiRegister, strPath in enumerate(self.__astrRegisterPaths):
+            self.__atRegisterIndex[strPath] = uiRegister
+        self.__atBitfieldIndex = {}
+        self.__aulBitfieldMask = array.array('I')
+        self.__aulRegisterDefault = array.array('I', [0] * len(self.__astrRegisterPaths))
+        self.__aulRegisterMask = array.array('I', [0] * len(self.__astrRegisterPaths))
+        for uiBitfield, strBitfield in enumerate(self.__astrBitfieldIDs):
+            uiRegister = self.__auiBitfieldRegister[uiBitfield]
+            ulStart = self.__aucBitfieldStart[uiBitfield]
+            ulMask = (1 << self.__aucBitfieldWidth[uiBitfield]) - 1
+            self.__atBitfieldIndex['%s/%s' % (self.__astrRegisterPaths[uiRegister], strBitfield)] = uiBitfield
+            self.__aulBitfieldMask.append(ulMask)
+            self.__aulRegisterDefault[uiRegister] |= self.__aulBitfieldDefault[uiBitfield] << ulStart
+            self.__aulRegisterMask[uiRegister] |= ulMask << ulStart
+
+        self.__reset_register_state()
+
+    def __reset_register_state(self):
+        # All registers have their default value and all bitfields are free.
+        self.__aulRegisterValue = array.array('I', self.__aulRegisterDefault)
+        self.__auiBitfieldOwner = array.array('I', [0] * len(self.__astrBitfieldIDs))
+        self.__aulRegisterOwned = array.array('I', [0] * len(self.__astrRegisterPaths))
+        self.__astrOwners = [None]
+        self.__atOwnerIndex = {}
+
+    def reset(self):
+        # Prepare the definition for the next hardware config. All
+        # registers get their default values and all pins are free again.
+        # The compiled model and scripts are kept.
+        self.__reset_register_state()
+        self.__atAffectedPins = {}
+        self.__atPinOwners = {}
+        self.__atConflicts = []
+        self.__atJournals = None
+        self.__atJournal = None
+        self.__strHwConfigDocVersion = None
+        self.__strHwConfigChipType = None
+        self.__atSandboxGlobals = None
+
+    def __get_owner_index(self, strOwner):
+        uiOwner = self.__atOwnerIndex.get(strOwner)
+        if uiOwner is None:
+            uiOwner = len(self.__astrOwners)
+            self.__astrOwners.append(strOwner)
+            self.__atOwnerIndex[strOwner] = uiOwner
+        return uiOwner
+
+    def __get_bitfield_path(self, uiBitfield):
+        return '%s/%s' % (self.__astrRegisterPaths[self.__auiBitfieldRegister[uiBitfield]], self.__astrBitfieldIDs[uiBitfield])
+
+    def __bitfield_get_value(self, uiBitfield, bOnlyDefaults=False):
         if bOnlyDefaults is True:
-            ulBitfieldValue = atBitfield['default']
+            ulBitfieldValue = self.__aulBitfieldDefault[uiBitfield]
         else:
-            # Use the value if something is already assigned.
-            ulBitfieldValue = atBitfield['value']
-            if ulBitfieldValue is None:
-                ulBitfieldValue = atBitfield['default']
-
-        # Get the start and width fields.
-        ulBitfieldWidth = atBitfield['width']
-
-        # The value must fit into the bitfield.
-        if ulBitfieldValue >= pow(2, ulBitfieldWidth):
-            raise Exception('The value 0x%08x exceeds the bitfield %s of register %s.' % (ulBitfieldValue, strBitfield, strPath))
-
+            uiRegister = self.__auiBitfieldRegister[uiBitfield]
+            ulBitfieldValue = (self.__aulRegisterValue[uiRegister] >> self.__aucBitfieldStart[uiBitfield]) & self.__aulBitfieldMask[uiBitfield]
         return ulBitfieldValue
 
-    def __register_get_value(self, atRegister, bOnlyDefaults=False):
-        ulRegisterValue = 0
-
-        # Loop over all bitfields in the register.
-        for strBitfield, atBitfield in atRegister['bitfields'].items():
-            ulBitfieldValue = self.__bitfield_get_value(atBitfield, bOnlyDefaults)
-
-            # Get the start and width fields.
-            ulBitfieldStart = atBitfield['start']
-            ulBitfieldWidth = atBitfield['width']
-
-            # Generate the mask for the bitfield.
-            ulMask = (pow(2, ulBitfieldWidth) - 1) << ulBitfieldStart
-
-            # The register value should be 0 at the position of the bitfield.
-            # Combine the register value with the bitfield.
-            if (ulRegisterValue & ulMask) != 0:
-                raise Exception('Merging bitfield %s to an already used register area!' % strBitfield)
-
-            ulRegisterValue |= ulBitfieldValue << ulBitfieldStart
-
+    def __register_get_value(self, uiRegister, bOnlyDefaults=False):
+        if bOnlyDefaults is True:
+            ulRegisterValue = self.__aulRegisterDefault[uiRegister]
+        else:
+            ulRegisterValue = self.__aulRegisterValue[uiRegister]
         return ulRegisterValue
 
-    def __bitfield_set_value(self, atBitfield, ulValue, strOwner):
+    def __bitfield_set_value(self, uiBitfield, ulValue, strOwner):
         # Be pessimistic.
         fResult = False
 
-        strBitfieldID = '%s/%s' % (atBitfield['path'], atBitfield['id'])
+        # The value must fit into the bitfield.
+        if (ulValue < 0) or (ulValue > self.__aulBitfieldMask[uiBitfield]):
+            logging.error('Trying to set the bitfield "%s" to a too large value of 0x%08x.' % (self.__get_bitfield_path(uiBitfield), ulValue))
 
-        if (atBitfield['value'] is not None) or (atBitfield['owner'] is not None):
-            logging.error('The bitfield "%s" is already set by "%s".' % (strBitfieldID, atBitfield['owner']))
+        elif self.__auiBitfieldOwner[uiBitfield] != 0:
+            # The bitfield keeps the old value. The conflict is reported
+            # later together with all others.
+            self.__add_bitfield_conflict(uiBitfield, ulValue, strOwner)
+            fResult = True
 
         else:
-            # The value must fit into the bitfield.
-            ulBitfieldWidth = atBitfield['width']
-            if ulValue >= pow(2, ulBitfieldWidth):
-                logging.error('Trying to set the bitfield "%s/%s" to a too large value of 0x%08x.' % (strBitfieldID, ulValue))
-            else:
-                logging.debug('Setting bitfield "%s" to 0x%08x from owner "%s".' % (strBitfieldID, ulValue, strOwner))
-                atBitfield['value'] = ulValue
-                atBitfield['owner'] = strOwner
-
-                fResult = True
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('Setting bitfield "%s" to 0x%08x from owner "%s".' % (self.__get_bitfield_path(uiBitfield), ulValue, strOwner))
+            uiRegister = self.__auiBitfieldRegister[uiBitfield]
+            ulStart = self.__aucBitfieldStart[uiBitfield]
+            ulMask = self.__aulBitfieldMask[uiBitfield] << ulStart
+            self.__aulRegisterValue[uiRegister] = (self.__aulRegisterValue[uiRegister] & ~ulMask) | (ulValue << ulStart)
+            self.__aulRegisterOwned[uiRegister] |= ulMask
+            self.__auiBitfieldOwner[uiBitfield] = self.__get_owner_index(strOwner)
+            if self.__atJournal is not None:
+                self.__atJournal['writes'].add(uiBitfield)
+
+            fResult = True
 
         return fResult
 
-    def __register_set_value(self, atRegister, ulValue, strOwner):
+    def __register_set_value(self, uiRegister, ulValue, strOwner):
         fResult = True
+        uiFirst = self.__auiRegisterBitfields[uiRegister]
+        uiLast = self.__auiRegisterBitfields[uiRegister + 1]
 
-        # Collect all masks to check the reserved bits.
-        ulCompleteMask = 0
-
-        # Loop over all bitfields.
-        for strBitfield, atBitfield in atRegister['bitfields'].items():
-            # Get the start and width fields.
-            ulBitfieldStart = atBitfield['start']
-            ulBitfieldWidth = atBitfield['width']
+        # Check if bits outside the bitfields are non 0.
+        ulReservedMask = self.__aulRegisterMask[uiRegister] ^ 0xffffffff
+        if (ulValue & ulReservedMask) != 0:
+            logging.error('The value 0x%08x for register %s has non 0 bits in the reserved fields: 0x%08x' % (ulValue, self.__astrRegisterPaths[uiRegister], ulValue & ulReservedMask))
+            fResult = False
 
-            # Generate the mask for the bitfield.
-            ulMask = pow(2, ulBitfieldWidth) - 1
+        elif self.__aulRegisterOwned[uiRegister] != 0:
+            # Some bitfields are already set. The register keeps the old
+            # value. Report each bitfield with an owner.
+            for uiBitfield in range(uiFirst, uiLast):
+                if self.__auiBitfieldOwner[uiBitfield] != 0:
+                    ulBitfieldValue = (ulValue >> self.__aucBitfieldStart[uiBitfield]) & self.__aulBitfieldMask[uiBitfield]
+                    self.__add_bitfield_conflict(uiBitfield, ulBitfieldValue, strOwner)
 
-            # Extract the bitfield part of the complete register value.
-            ulValueBitfield = (ulValue >> ulBitfieldStart) & ulMask
-            fResult = self.__bitfield_set_value(atBitfield, ulValueBitfield, strOwner)
-            if fResult is not True:
-                break
+        else:
+            # Set all bitfields at once.
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('Setting register "%s" to 0x%08x from owner "%s".' % (self.__astrRegisterPaths[uiRegister], ulValue, strOwner))
+            self.__aulRegisterValue[uiRegister] = ulValue
+            self.__aulRegisterOwned[uiRegister] = self.__aulRegisterMask[uiRegister]
+            uiOwner = self.__get_owner_index(strOwner)
+            for uiBitfield in range(uiFirst, uiLast):
+                self.__auiBitfieldOwner[uiBitfield] = uiOwner
+            if self.__atJournal is not None:
+                self.__atJournal['writes'].update(range(uiFirst, uiLast))
 
-            # Add the mask.
-            ulCompleteMask |= ulMask << ulBitfieldStart
+        return fResult
 
-        # ulCompleteMask contains now all processed bits.
-        # Check if not processed bits are non 0.
-        ulReservedMask = ulCompleteMask ^ 0xffffffff
-        if (ulValue & ulReservedMask) != 0:
-            logging.error('The value 0x%08x for register %s has non 0 bits in the reserved fields: 0x%08x' % (ulValue, atRegister['path'], ulValue & ulReservedMask))
-            fResult = False
+    def __add_bitfield_conflict(self, uiBitfield, ulValue, strOwner):
+        strPath = self.__get_bitfield_path(uiBitfield)
+        strExistingOwner = self.__astrOwners[self.__auiBitfieldOwner[uiBitfield]]
+        logging.debug('The bitfield "%s" is already set by "%s".' % (strPath, strExistingOwner))
+        self.__atConflicts.append({
+            'type': 'bitfield',
+            'id': strPath,
+            'owner': strExistingOwner,
+            'value': self.__bitfield_get_value(uiBitfield),
+            'new_owner': strOwner,
+            'new_value': ulValue
+        })
+
+    def begin_unit(self, tKey):
+        # Record all following reads and writes for the unit tKey.
+        if self.__atJournals is None:
+            self.__atJournals = {}
+        self.__atJournal = {
+            'writes': set(),
+            'reads': set(),
+            'pins': set()
+        }
+        self.__atJournals[tKey] = self.__atJournal
+
+    def end_unit(self):
+        self.__atJournal = None
+
+    def get_unit_journal(self, tKey):
+        # Get the sets of written and read bitfield IDs and the set of pins
+        # for the unit tKey or None if the unit was not recorded.
+        atJournal = None
+        if self.__atJournals is not None:
+            atJournal = self.__atJournals.get(tKey)
+        return atJournal
+
+    def undo_unit(self, tKey):
+        # Free all bitfields and pins of the unit. A free bitfield always has
+        # the default value.
+        atJournal = self.__atJournals.pop(tKey)
+        for uiBitfield in atJournal['writes']:
+            uiRegister = self.__auiBitfieldRegister[uiBitfield]
+            ulStart = self.__aucBitfieldStart[uiBitfield]
+            ulMask = self.__aulBitfieldMask[uiBitfield] << ulStart
+            self.__aulRegisterValue[uiRegister] = (self.__aulRegisterValue[uiRegister] & ~ulMask) | (self.__aulBitfieldDefault[uiBitfield] << ulStart)
+            self.__aulRegisterOwned[uiRegister] &= ~ulMask
+            self.__auiBitfieldOwner[uiBitfield] = 0
+        for strPin in atJournal['pins']:
+            del self.__atAffectedPins[strPin]
+            del self.__atPinOwners[strPin]
+
+    def get_conflicts(self):
+        # Get a list of all conflicting settings. Each entry is a dict with
+        # the type ("bitfield" or "pin"), the id of the bitfield or pin, the
+        # owner and value which were set first and the new owner and value.
+        return list(self.__atConflicts)
+
+    def check_conflicts(self):
+        # Report all conflicting settings at once.
+        if len(self.__atConflicts) != 0:
+            for atConflict in self.__atConflicts:
+                if atConflict['type'] == 'pin':
+                    logging.error('Pin "%s" is already set to "%s" by "%s". "%s" tried to set it to "%s".' % (atConflict['id'], atConflict['value'], atConflict['owner'], atConflict['new_owner'], atConflict['new_value']))
+                else:
+                    logging.error('The bitfield "%s" is already set to 0x%08x by "%s". "%s" tried to set it to 0x%08x.' % (atConflict['id'], atConflict['value'], atConflict['owner'], atConflict['new_owner'], atConflict['new_value']))
+            raise Exception('Found %d conflicting settings in the hardware configuration.' % len(self.__atConflicts))
 
-        return fResult
+    def __get_path_error(self, strPath):
+        # Get the error message for a path which is no register and no
+        # bitfield.
+        strPathRegister, strPathBitfield = os.path.split(strPath)
+        if strPathRegister in self.__atRegisterIndex:
+            strError = 'The register "%s" does not have a bitfield named "%s".' % (strPathRegister, strPathBitfield)
+        else:
+            strError = 'The path "%s" does not point to a register or a bitfield.' % strPath
+        return strError
 
     def get_register(self, strPath):
+        # Get a copy of the register with all bitfields.
         atRegister = None
-        # Does the path point to a register?
-        if strPath in self.__atRegisters:
-            atRegister = self.__atRegisters[strPath]
+        uiRegister = self.__atRegisterIndex.get(strPath)
+        if uiRegister is not None:
+            atBitfields = {}
+            for uiBitfield in range(self.__auiRegisterBitfields[uiRegister], self.__auiRegisterBitfields[uiRegister + 1]):
+                uiOwner = self.__auiBitfieldOwner[uiBitfield]
+                strBitfield = self.__astrBitfieldIDs[uiBitfield]
+                atBitfields[strBitfield] = {
+                    'path': strPath,
+                    'id': strBitfield,
+                    'start': self.__aucBitfieldStart[uiBitfield],
+                    'width': self.__aucBitfieldWidth[uiBitfield],
+                    'default': self.__aulBitfieldDefault[uiBitfield],
+                    'value': self.__bitfield_get_value(uiBitfield) if uiOwner != 0 else None,
+                    'owner': self.__astrOwners[uiOwner]
+                }
+            atRegister = {
+                'path': strPath,
+                'bitfields': atBitfields
+            }
         return atRegister
 
+    def get_register_defaults(self):
+        # Get the default values of all registers with an address. Bits
+        # without a bitfield are 0.
+        atDefaults = {}
+        for uiRegister, lAddress in enumerate(self.__alRegisterAddress):
+            if lAddress != -1:
+                atDefaults[lAddress] = self.__aulRegisterDefault[uiRegister]
+        return atDefaults
+
     def register_path_set_value(self, strPath, ulValue, strOwner):
         # Does the path point to a register?
-        if strPath in self.__atRegisters:
+        uiRegister = self.__atRegisterIndex.get(strPath)
+        if uiRegister is not None:
             # Yes, this is a register. Set all bitfields from the value.
-            atRegister = self.__atRegisters[strPath]
-            fResult = self.__register_set_value(atRegister, ulValue, strOwner)
+            fResult = self.__register_set_value(uiRegister, ulValue, strOwner)
             if fResult is not True:
                 raise Exception('Failed to set the register "%s" to value 0x%08x.' % (strPath, ulValue))
         else:
             # Does the path point to a bitfield?
-            strPathRegister, strPathBitfield = os.path.split(strPath)
-            if strPathRegister in self.__atRegisters:
-                atRegister = self.__atRegisters[strPathRegister]
-                # Does the bitfield exist?
-                atBitfields = atRegister['bitfields']
-                if strPathBitfield in atBitfields:
-                    atBitfield = atBitfields[strPathBitfield]
-                    fResult = self.__bitfield_set_value(atBitfield, ulValue, strOwner)
-                    if fResult is not True:
-                        raise Exception('Failed to set bitfield "%s" of register "%s" to value 0x%08x.' % (strPathBitfield, strPathRegister, ulValue))
-                else:
-                    raise Exception('The register "%s" does not have a bitfield named "%s".' % (strPathRegister, strPathBitfield))
-            else:
-                raise Exception('The path "%s" does not point to a register or a bitfield.' % strPath)
+            uiBitfield = self.__atBitfieldIndex.get(strPath)
+            if uiBitfield is None:
+                raise Exception(self.__get_path_error(strPath))
+            fResult = self.__bitfield_set_value(uiBitfield, ulValue, strOwner)
+            if fResult is not True:
+                strPathRegister, strPathBitfield = os.path.split(strPath)
+                raise Exception('Failed to set bitfield "%s" of register "%s" to value 0x%08x.' % (strPathBitfield, strPathRegister, ulValue))
 
     # Allow setting a register/bit field multiple times if the value is the same.
     # Check if the register/bit field is already set (i.e. it has an owner). 
@@ -1380,26 +1809,21 @@ class Peripherals:
     
     def register_path_get_value(self, strPath):
         # Does the path point to a register?
-        if strPath in self.__atRegisters:
+        uiRegister = self.__atRegisterIndex.get(strPath)
+        if uiRegister is not None:
             # Yes, this is a register. Get the complete DWORD.
-            atRegister = self.__atRegisters[strPath]
-            ulValue = self.__register_get_value(atRegister)
+            ulValue = self.__register_get_value(uiRegister)
+            if self.__atJournal is not None:
+                self.__atJournal['reads'].update(range(self.__auiRegisterBitfields[uiRegister], self.__auiRegisterBitfields[uiRegister + 1]))
 
         else:
             # Does the path point to a bitfield?
-            strPathRegister, strPathBitfield = os.path.split(strPath)
-            if strPathRegister in self.__atRegisters:
-                atRegister = self.__atRegisters[strPathRegister]
-                # Does the bitfield exist?
-                atBitfields = atRegister['bitfields']
-                if strPathBitfield in atBitfields:
-                    atBitfield = atBitfields[strPathBitfield]
-                    ulValue = self.__bitfield_get_value(atBitfield)
-
-                else:
-                    raise Exception('The register "%s" does not have a bitfield named "%s".' % (strPathRegister, strPathBitfield))
-            else:
-                raise Exception('The path "%s" does not point to a register or a bitfield.' % strPath)
+            uiBitfield = self.__atBitfieldIndex.get(strPath)
+            if uiBitfield is None:
+                raise Exception(self.__get_path_error(strPath))
+            ulValue = self.__bitfield_get_value(uiBitfield)
+            if self.__atJournal is not None:
+                self.__atJournal['reads'].add(uiBitfield)
 
         logging.debug('Register "%s" has the value 0x%08x.' % (strPath, ulValue))
         return ulValue
@@ -1408,15 +1832,12 @@ class Peripherals:
         logging.debug('Get the owner of bitfield "%s".' % strPath)
         strOwner = None
 
-        strPathRegister, strPathBitfield = os.path.split(strPath)
-        if strPathRegister in self.__atRegisters:
-            atRegister = self.__atRegisters[strPathRegister]
-            # Does the bitfield exist?
-            atBitfields = atRegister['bitfields']
-            if strPathBitfield in atBitfields:
-                atBitfield = atBitfields[strPathBitfield]
-                strOwner = atBitfield['owner']
-        else:
+        uiBitfield = self.__atBitfieldIndex.get(strPath)
+        if uiBitfield is not None:
+            strOwner = self.__astrOwners[self.__auiBitfieldOwner[uiBitfield]]
+            if self.__atJournal is not None:
+                self.__atJournal['reads'].add(uiBitfield)
+        elif os.path.split(strPath)[0] not in self.__atRegisterIndex:
             raise Exception('The path "%s" does not point to a register or a bitfield.' % strPath)
 
         if strOwner is None:
@@ -1448,11 +1869,12 @@ class Peripherals:
         strOwner = 'pad_ctrl %s' % strPadID
 
         # Get the path to the pad ctrl register.
-        strPath = None
-        for atPadCtrl in self.__atPadCtrlRegisters:
-            if atPadCtrl['id'] == strPadID:
-                strPath = atPadCtrl['path']
-                break
+        if Peripherals.__atPadCtrlIndex is None:
+            atPadCtrlIndex = {}
+            for atPadCtrl in self.__atPadCtrlRegisters:
+                atPadCtrlIndex[atPadCtrl['id']] = atPadCtrl['path']
+            Peripherals.__atPadCtrlIndex = atPadCtrlIndex
+        strPath = Peripherals.__atPadCtrlIndex.get(strPadID)
         if strPath is None:
             raise Exception('Unknown ID in pad ctrl: %s' % strPadID)
         logging.debug('Translate pad ID "%s" to path "%s".' % (strPadID, strPath))
@@ -1519,8 +1941,9 @@ class Peripherals:
 
     def dump_register(self, atRegister):
         strPath = atRegister['path']
-        ulValue = self.__register_get_value(atRegister)
-        ulDefaultValue = self.__register_get_value(atRegister, True)
+        uiRegister = self.__atRegisterIndex[strPath]
+        ulValue = self.__register_get_value(uiRegister)
+        ulDefaultValue = self.__register_get_value(uiRegister, True)
         if ulValue == ulDefaultValue:
             print('    %s: 0x%08x' % (strPath, ulDefaultValue))
         else:
@@ -1537,8 +1960,8 @@ class Peripherals:
 
     def dump_all_registers(self):
         print('Registers:')
-        for strPath, atRegister in self.__atRegisters.items():
-            self.dump_register(atRegister)
+        for strPath in self.__astrRegisterPaths:
+            self.dump_register(self.get_register(strPath))
 
     # Print a peripheral configuration
     def show_parameters(self, atConfig, strConfigID):
@@ -1546,14 +1969,36 @@ class Peripherals:
         for strKey, strValue in atConfig.items():
             print('    [%s] = %s' % (strKey, strValue))
 
-    def set_affected_pin(self, strPin, strFunction):
+    def set_affected_pin(self, strPin, strFunction, strOwner=None):
         logging.debug('Setting pin "%s" to function "%s".' % (strPin, strFunction))
 
+        # Pins from scripts belong to the running peripheral.
+        if strOwner is None:
+            strOwner = self.__strCurrentOwner
+
         # Is the pin already set?
         if strPin in self.__atAffectedPins:
-            logging.error('Failed to set pin "%s" to function "%s". It is aready set to "%s".' % (strPin, strFunction, self.__atAffectedPins[strPin]))
-            raise Exception('Pin %s is already in use!' % strPin)
-        self.__atAffectedPins[strPin] = strFunction
+            logging.debug('Failed to set pin "%s" to function "%s". It is aready set to "%s".' % (strPin, strFunction, self.__atAffectedPins[strPin]))
+            self.__atConflicts.append({
+                'type': 'pin',
+                'id': strPin,
+                'owner': self.__atPinOwners[strPin],
+                'value': self.__atAffectedPins[strPin],
+                'new_owner': strOwner,
+                'new_value': strFunction
+            })
+        else:
+            self.__atAffectedPins[strPin] = strFunction
+            self.__atPinOwners[strPin] = strOwner
+            if self.__atJournal is not None:
+                self.__atJournal['pins'].add(strPin)
+
+    def get_pin(self, strPin):
+        # Get the function and the owner of a pin or None if it is free.
+        tPin = None
+        if strPin in self.__atAffectedPins:
+            tPin = (self.__atAffectedPins[strPin], self.__atPinOwners[strPin])
+        return tPin
 
     def apply_ioconfig(self, strID):
         # Does the IO configuration exist?
@@ -1569,7 +2014,7 @@ class Peripherals:
 
         # Set all affected pins.
         for strPin, strFunction in atIoConfig['affected_pins'].items():
-            self.set_affected_pin(strPin, strFunction)
+            self.set_affected_pin(strPin, strFunction, strOwner)
 
     # if getParam_isEnabled(atConfig, 'dpm0_spi_dirq')
     # Read a required parameter whose value must be 'enabled' or 'disabled'.
@@ -1676,10 +2121,7 @@ class Peripherals:
         for strLine in strCode.split('\n'):
             logging.debug('SANDBOX CODE: %s' % strLine)
 
-    def __run_sandbox_code(self, strCode, strFileID, atLocals={}):
-        logging.debug('Running sandbox code:')
-        self.__dump_sandbox_code(strCode)
-
+    def __get_sandbox_globals(self):
         atGlobals = {
             'apply_ioconfig': self.sandbox_api_apply_ioconfig,
             'get_register': self.sandbox_api_get_register,
@@ -1701,19 +2143,49 @@ class Peripherals:
             'HWCONFIG_TOOL_VERSION':hwconfig_tool_version_short,
             'HWCONFIG_CHIP_TYPE':self.__strHwConfigChipType,
         }
-        tCode = compile(strCode, strFileID, 'exec')
+        return atGlobals
+
+    def __run_sandbox_code(self, strCode, strFileID, atLocals={}):
+        logging.debug('Running sandbox code:')
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.__dump_sandbox_code(strCode)
+
+        # Prepare the globals only once.
+        if self.__atSandboxGlobals is None:
+            self.__atSandboxGlobals = self.__get_sandbox_globals()
+
+        tCode = self.__atScripts.get(strFileID)
+        if tCode is None:
+            tCode = compile(strCode, strFileID, 'exec')
         tResult = None
         strError = None
+        tStart = time.perf_counter()
         try:
-            exec(tCode, atGlobals, atLocals)
+            exec(tCode, self.__atSandboxGlobals, atLocals)
             tResult = True
         except Exception as e:
             strError = str(e)
             logging.debug('Failed to run sandbox code: %s' % strError)
             tResult = False
 
+        atTime = self.__atScriptTimes.setdefault(strFileID, [0, 0.0])
+        atTime[0] += 1
+        atTime[1] += time.perf_counter() - tStart
+
         return tResult, strError
 
+    def get_script_times(self):
+        # Get the number of runs and the execution time in seconds for each
+        # script which was used.
+        return dict(self.__atScriptTimes)
+
+    def log_script_times(self):
+        tTotal = 0.0
+        for strFileID, atTime in sorted(self.__atScriptTimes.items(), key=lambda tItem: tItem[1][1], reverse=True):
+            logging.info('%8.3fms %3d run(s) %s' % (atTime[1] * 1000.0, atTime[0], strFileID))
+            tTotal += atTime[1]
+        logging.info('%8.3fms total script execution time' % (tTotal * 1000.0))
+
     def apply_peripheral(self, strID, strConfigID, atConfig, atVerbatimNodes, strOwner):
         logging.debug('sandbox API: Apply peripheral "%s".' % strID)
 
@@ -1732,9 +2204,14 @@ class Peripherals:
         # Get the code block and execute it.
         strCode = atPeripheral['code'].strip()
         strFileID = 'Peripheral code for %s' % strID
+        self.__strCurrentOwner = strOwner
         tResult, strError = self.__run_sandbox_code(strCode, strFileID, atLocals)
+        self.__strCurrentOwner = None
         if tResult is not True:
             logging.error('Failed to apply peripheral "%s": %s' % (strID, strError))
+            # The script may have failed because of a conflicting setting.
+            # Report the conflicts first.
+            self.check_conflicts()
             raise Exception('Invalid hardware configuration.')
 
     def apply_sdram_settings(self, ulSdramGeneralCtrl, ulSdramTimingCtrl, ulSdramModeRegister):
@@ -1743,24 +2220,37 @@ class Peripherals:
         self.register_path_set_value('register/hif_sdram_ctrl/sdram_timing_ctrl', ulSdramTimingCtrl, strOwner)
         self.register_path_set_value('register/hif_sdram_ctrl/sdram_mr', ulSdramModeRegister, strOwner)
 
+    def get_constraint_ids(self):
+        return list(self.__atConstraints.keys())
+
+    def check_constraint(self, strID):
+        logging.debug('Checking constraint "%s".' % strID)
+        atConstraint = self.__atConstraints[strID]
+
+        # Get the code block and execute it.
+        strCode = atConstraint['code'].strip()
+        strFileID = 'Constraint code for %s' % strID
+        self.__strCurrentOwner = 'constraint %s' % strID
+        tResult, strError = self.__run_sandbox_code(strCode, strFileID)
+        self.__strCurrentOwner = None
+        if tResult is not True:
+            logging.error('Constraint "%s" failed: %s' % (strID, strError))
+            # The constraint may have failed because of a conflicting
+            # setting. Report the conflicts first.
+            self.check_conflicts()
+            raise Exception('Invalid hardware configuration.')
+
     def check_constraints(self, tHwConfig):
         # Loop over all constraints.
-        for strID, atConstraint in self.__atConstraints.items():
-            logging.debug('Checking constraint "%s".' % strID)
-
-            # Get the code block and execute it.
-            strCode = atConstraint['code'].strip()
-            strFileID = 'Constraint code for %s' % strID
-            tResult, strError = self.__run_sandbox_code(strCode, strFileID)
-            if tResult is not True:
-                logging.error('Constraint "%s" failed: %s' % (strID, strError))
-                raise Exception('Invalid hardware configuration.')
+        for strID in self.__atConstraints:
+            self.check_constraint(strID)
 
     def sandbox_api_output(self, strLine):
         self.__astrOutput.append(strLine)
         logging.debug('OUTPUT  %s' % strLine)
 
-    def generate_template(self, strOutputFile):
+    def get_template_text(self):
+        # Run the template code and get the HBoot XML as text.
         self.__astrOutput = []
 
         strFileID = 'Template code'
@@ -1773,9 +2263,14 @@ class Peripherals:
             logging.error('Generating the template failed: %s' % (strError))
             raise Exception('Failed to generate the template.')
 
+        return '\n'.join(self.__astrOutput)
+
+    def generate_template(self, strOutputFile):
+        strText = self.get_template_text()
+
         # Write all generated lines to the output file.
         tFile = open(strOutputFile, 'wt')
-        tFile.write('\n'.join(self.__astrOutput))
+        tFile.write(strText)
         tFile.close()
 
 
@@ -1793,18 +2288,7 @@ def parseVersionString(strVer):
     aiVer = map(int, astrVer)
     return list(aiVer)
     
-def make_hboot_xml(tArgs):
-    logging.info(version_string)
-    
-    # Read the peripheral description.
-    tPeripheral = Peripherals()
-    tPeripheral.read(tArgs.strPeripheralsFile)
-    
-    # Read the hwconfig.
-    tHwConfig = HwConfig()
-    tHwConfig.set_peripherals(tPeripheral)
-    tHwConfig.read_hwconfig(tArgs.strHwConfigFile)
-    
+def check_hwconfig_version(tHwConfig):
     # Check the version of the hardware config.
     strCurVer = __revision__
     aiCurVer = parseVersionString(strCurVer)
@@ -1814,7 +2298,11 @@ def make_hboot_xml(tArgs):
         raise Exception('The tool_version of the hardware config is older than the hwconfig tool (%s < %s). Try updating the hardware config.' % (strHwcVer, strCurVer))
     if aiHwcVer > aiCurVer:
         raise Exception('The tool_version of the hardware config is newer than the hwconfig tool (%s > %s). You need to update the hwconfig tool.' % (strHwcVer, strCurVer))
-        
+
+def apply_hwconfig(tPeripheral, tHwConfig):
+    tHwConfig.set_peripherals(tPeripheral)
+    check_hwconfig_version(tHwConfig)
+
     tPeripheral.set_hwconfig_doc_version(tHwConfig.get_doc_version())
     tPeripheral.set_hwconfig_chip_type(tHwConfig.get_chip_type())
     
@@ -1822,10 +2310,419 @@ def make_hboot_xml(tArgs):
     tHwConfig.apply_mmio_config()
     tHwConfig.apply_peripherals()
     tHwConfig.apply_sdram()
-    
+
+    # Report all conflicts before the constraints are checked.
+    tPeripheral.check_conflicts()
     tPeripheral.check_constraints(tHwConfig)
+    tPeripheral.check_conflicts()
+
+
+# The netX type and the patch table of the HBoot image compiler for each
+# chip type.
+atHbootTargets = {
+    'netx90_rev0': {'netx_type': 'NETX90', 'patch_table': 'hboot_netx90_patch_table.xml'},
+    'netx90_rev1': {'netx_type': 'NETX90B', 'patch_table': 'hboot_netx90b_patch_table.xml'},
+}
+
+# These are the HBoot image compilers of a batch in this process. The key is
+# the chip type and the top level definition.
+atBatchImages = {}
+
+# Get the HBoot image compiler for a chip type and a top level definition.
+# The compiler is created only once in each process. The top level
+# definition and the snippets are read only once.
+def get_hboot_compiler(strChipType, strImageTemplate):
+    strChipType = resolve_chip_type_alias(strChipType)
+    tKey = (strChipType, strImageTemplate)
+    tCompiler = atBatchImages.get(tKey)
+    if tCompiler is None:
+        if strChipType not in atHbootTargets:
+            raise Exception('The HBoot image compiler does not support the chip type "%s".' % strChipType)
+        atTarget = atHbootTargets[strChipType]
+        strPatchTable = os.path.join(
+            os.path.dirname(os.path.realpath(hboot_image.__file__)),
+            atTarget['patch_table']
+        )
+        tEnv = {
+            'OBJCOPY': 'objcopy',
+            'OBJDUMP': 'objdump',
+            'READELF': 'readelf',
+            'HBOOT_INCLUDE': []
+        }
+        tCompiler = hboot_image.HbootImage(
+            tEnv,
+            atTarget['netx_type'],
+            patch_definition=strPatchTable,
+            source_cache=source_cache.SourceCache()
+        )
+        atBatchImages[tKey] = tCompiler
+    return tCompiler
+
+# Write the generated HBoot XML or compile it to an HBoot image.
+# The HBoot XML is passed to the compiler as the known file "@hw_config".
+# With fOptimizeRegisters the compiler removes redundant writes to the
+# registers of the peripheral definition from the Register chunks. With
+# fDropRegisterDefaults it also removes writes of the default values of the
+# peripheral definition. This expects the default values in the hardware.
+def write_hwconfig_output(tPeripheral, tHwConfig, strOutputFile, strImageTemplate, fOptimizeRegisters=False, fDropRegisterDefaults=False):
+    if strImageTemplate is None:
+        tPeripheral.generate_template(strOutputFile)
+    else:
+        tCompiler = get_hboot_compiler(tHwConfig.get_chip_type(), strImageTemplate)
+        tCompiler.set_optimize_registers(fOptimizeRegisters)
+        tCompiler.set_drop_register_defaults(fDropRegisterDefaults)
+        if fOptimizeRegisters is True:
+            tCompiler.set_register_defaults(tPeripheral.get_register_defaults())
+        tCompiler.set_known_text('hw_config', tPeripheral.get_template_text())
+        tCompiler.parse_image(strImageTemplate)
+        tCompiler.write(strOutputFile)
+
+class IncrementalHwConfig:
+    """Generate the output for a hardware config again after small edits.
+
+    The first build applies each pad, MMIO, peripheral and the SDRAM as a
+    unit and records the bitfields and pins which each unit writes and the
+    bitfields it reads. The constraints are recorded in the same way.
+    After an edit only the changed units and the units which read their
+    bitfields are undone and applied again. Only the constraints which
+    read the affected bitfields are checked again. The template always
+    runs again.
+
+    A full build is done if the result could differ from a full build,
+    e.g. if the order of the units changed or settings conflict.
+    """
+    __tPeripheral = None
+    __strImageTemplate = None
+    __fOptimizeRegisters = None
+    __fDropRegisterDefaults = None
+
+    # This is the list of unit keys and signatures from the last build. It
+    # is None if the next update must be a full build.
+    __atUnits = None
+
+    # The document version and the chip type of the last build.
+    __strDocVersion = None
+    __strChipType = None
+
+    __TEMPLATE_UNIT = ('template', None, 0)
+
+    def __init__(self, tPeripheral, strImageTemplate=None, fOptimizeRegisters=False, fDropRegisterDefaults=False):
+        self.__tPeripheral = tPeripheral
+        self.__strImageTemplate = strImageTemplate
+        self.__fOptimizeRegisters = fOptimizeRegisters
+        self.__fDropRegisterDefaults = fDropRegisterDefaults
+
+    def __apply_unit(self, tHwConfig, tKey, tData):
+        self.__tPeripheral.begin_unit(tKey)
+        try:
+            tHwConfig.apply_unit(tKey, tData)
+        finally:
+            self.__tPeripheral.end_unit()
+
+    def __check_constraint(self, strID):
+        self.__tPeripheral.begin_unit(('constraint', strID, 0))
+        try:
+            self.__tPeripheral.check_constraint(strID)
+        finally:
+            self.__tPeripheral.end_unit()
+
+    def __read_hwconfig(self, strHwConfigFile):
+        tHwConfig = HwConfig()
+        tHwConfig.read_hwconfig(strHwConfigFile)
+        tHwConfig.set_peripherals(self.__tPeripheral)
+        check_hwconfig_version(tHwConfig)
+        return tHwConfig
+
+    def __finish(self, tHwConfig, atUnits, strOutputFile):
+        # The template can also set registers. It is undone before each
+        # update.
+        self.__tPeripheral.begin_unit(self.__TEMPLATE_UNIT)
+        try:
+            write_hwconfig_output(self.__tPeripheral, tHwConfig, strOutputFile, self.__strImageTemplate, self.__fOptimizeRegisters, self.__fDropRegisterDefaults)
+        finally:
+            self.__tPeripheral.end_unit()
+        self.__atUnits = [(tKey, tSignature) for tKey, tData, tSignature in atUnits]
+        self.__strDocVersion = tHwConfig.get_doc_version()
+        self.__strChipType = tHwConfig.get_chip_type()
+
+    def build(self, strHwConfigFile, strOutputFile):
+        """Apply the complete hardware config and write the output."""
+        tHwConfig = self.__read_hwconfig(strHwConfigFile)
+        self.__build(tHwConfig, strOutputFile)
+
+    def __build(self, tHwConfig, strOutputFile):
+        self.__atUnits = None
+        tPeripheral = self.__tPeripheral
+        tPeripheral.reset()
+        tPeripheral.set_hwconfig_doc_version(tHwConfig.get_doc_version())
+        tPeripheral.set_hwconfig_chip_type(tHwConfig.get_chip_type())
+
+        atUnits = tHwConfig.get_units()
+        for tKey, tData, tSignature in atUnits:
+            self.__apply_unit(tHwConfig, tKey, tData)
+        tPeripheral.check_conflicts()
+        for strID in tPeripheral.get_constraint_ids():
+            self.__check_constraint(strID)
+        tPeripheral.check_conflicts()
+
+        self.__finish(tHwConfig, atUnits, strOutputFile)
+        logging.info('Applied all %d units.' % len(atUnits))
+
+    def __update(self, tHwConfig, strOutputFile):
+        # Returns a string with the reason if a full build is needed.
+        tPeripheral = self.__tPeripheral
+
+        if (tHwConfig.get_doc_version() != self.__strDocVersion) or (tHwConfig.get_chip_type() != self.__strChipType):
+            return 'the version or chip type changed'
+
+        atOldSignatures = dict(self.__atUnits)
+        atUnits = tHwConfig.get_units()
+        atNewSignatures = {}
+        for tKey, tData, tSignature in atUnits:
+            atNewSignatures[tKey] = tSignature
+
+        # The units which are still there must keep their order.
+        atOldOrder = [tKey for tKey, tSignature in self.__atUnits if tKey in atNewSignatures]
+        atNewOrder = [tKey for tKey, tData, tSignature in atUnits if tKey in atOldSignatures]
+        if atOldOrder != atNewOrder:
+            return 'the order of the units changed'
+
+        # Removed units affect all units.
+        atDirty = set()
+        atAffected = set()
+        for tKey, tSignature in self.__atUnits:
+            if tKey not in atNewSignatures:
+                atAffected.update(tPeripheral.get_unit_journal(tKey)['writes'])
+
+        # Find the changed units and all later units which read their
+        # bitfields.
+        for tKey, tData, tSignature in atUnits:
+            atJournal = tPeripheral.get_unit_journal(tKey)
+            if atJournal is None:
+                # This is a new unit.
+                atDirty.add(tKey)
+            elif (atOldSignatures[tKey] != tSignature) or (len(atJournal['reads'] & atAffected) != 0):
+                atDirty.add(tKey)
+                atAffected.update(atJournal['writes'])
+
+        # Undo the template, the removed and the dirty units.
+        tPeripheral.undo_unit(self.__TEMPLATE_UNIT)
+        for tKey, tSignature in self.__atUnits:
+            if (tKey not in atNewSignatures) or (tKey in atDirty):
+                tPeripheral.undo_unit(tKey)
+        self.__atUnits = None
+
+        # Apply the dirty units again in their order. A unit must not read
+        # the bitfields of a later unit, and later units must not read the
+        # new bitfields of a dirty unit.
+        for uiIndex, (tKey, tData, tSignature) in enumerate(atUnits):
+            if tKey in atDirty:
+                self.__apply_unit(tHwConfig, tKey, tData)
+                atJournal = tPeripheral.get_unit_journal(tKey)
+                atAffected.update(atJournal['writes'])
+                for tLaterKey, tLaterData, tLaterSignature in atUnits[uiIndex + 1:]:
+                    if tLaterKey not in atDirty:
+                        atLaterJournal = tPeripheral.get_unit_journal(tLaterKey)
+                        if (len(atJournal['reads'] & atLaterJournal['writes']) != 0) or (len(atLaterJournal['reads'] & atJournal['writes']) != 0):
+                            return 'the unit %s depends on the unit %s' % (str(tKey), str(tLaterKey))
+
+        # Conflicts are always reported by a full build.
+        if len(tPeripheral.get_conflicts()) != 0:
+            return 'some settings conflict'
+
+        # Check the constraints which read an affected bitfield.
+        uiConstraints = 0
+        for strID in tPeripheral.get_constraint_ids():
+            tKey = ('constraint', strID, 0)
+            atJournal = tPeripheral.get_unit_journal(tKey)
+            if (len(atJournal['reads'] & atAffected) != 0) or (len(atJournal['writes']) != 0):
+                tPeripheral.undo_unit(tKey)
+                self.__check_constraint(strID)
+                uiConstraints += 1
+        if len(tPeripheral.get_conflicts()) != 0:
+            return 'some settings conflict'
+
+        self.__finish(tHwConfig, atUnits, strOutputFile)
+        logging.info('Applied %d of %d units again and checked %d constraints.' % (len(atDirty), len(atUnits), uiConstraints))
+        return None
+
+    def update(self, strHwConfigFile, strOutputFile):
+        """Apply the changes since the last build and write the output.
+
+        This is a full build if there was no successful build before.
+        """
+        tHwConfig = self.__read_hwconfig(strHwConfigFile)
+        if self.__atUnits is None:
+            self.__build(tHwConfig, strOutputFile)
+        else:
+            # The state is undefined after an error. The next update must be
+            # a full build.
+            try:
+                strReason = self.__update(tHwConfig, strOutputFile)
+            except Exception:
+                self.__atUnits = None
+                raise
+            if strReason is not None:
+                logging.info('Running a full build, because %s.' % strReason)
+                self.__build(tHwConfig, strOutputFile)
+
+def make_hboot_xml(tArgs):
+    logging.info(version_string)
     
-    tPeripheral.generate_template(tArgs.strOutputFile)
+    # Read the peripheral description.
+    tPeripheral = Peripherals()
+    tPeripheral.read(tArgs.strPeripheralsFile, tArgs.strModelCacheFolder)
+    
+    # Read the hwconfig.
+    tHwConfig = HwConfig()
+    tHwConfig.read_hwconfig(tArgs.strHwConfigFile)
+
+    apply_hwconfig(tPeripheral, tHwConfig)
+    write_hwconfig_output(tPeripheral, tHwConfig, tArgs.strOutputFile, tArgs.strImageTemplate, tArgs.fOptimizeRegisters, tArgs.fDropRegisterDefaults)
+
+    if tArgs.fScriptTimes is True:
+        tPeripheral.log_script_times()
+
+
+# Watch a hardware config and generate the output again after each change.
+def watch_hboot_xml(tArgs):
+    logging.info(version_string)
+
+    # Read the peripheral description.
+    tPeripheral = Peripherals()
+    tPeripheral.read(tArgs.strPeripheralsFile, tArgs.strModelCacheFolder)
+
+    cBuild = IncrementalHwConfig(tPeripheral, tArgs.strImageTemplate, tArgs.fOptimizeRegisters, tArgs.fDropRegisterDefaults)
+    logging.info('Watching "%s". Press Ctrl-C to stop.' % tArgs.strHwConfigFile)
+    tLastStat = None
+    try:
+        while True:
+            try:
+                tStat = os.stat(tArgs.strHwConfigFile)
+                tStat = (tStat.st_size, tStat.st_mtime_ns)
+            except OSError:
+                tStat = None
+
+            if (tStat is not None) and (tStat != tLastStat):
+                tLastStat = tStat
+                tStart = time.perf_counter()
+                try:
+                    cBuild.update(tArgs.strHwConfigFile, tArgs.strOutputFile)
+                    logging.info('Wrote "%s" in %.1fms.' % (tArgs.strOutputFile, (time.perf_counter() - tStart) * 1000.0))
+                except Exception as e:
+                    logging.error('Failed to generate "%s": %s' % (tArgs.strOutputFile, str(e)))
+
+            time.sleep(tArgs.fInterval)
+    except KeyboardInterrupt:
+        pass
+
+
+# These are the peripheral definitions of a batch in this process. The key is
+# the name of the definition file.
+atBatchPeripherals = {}
+
+# Get the peripheral definition for a chip type.
+def get_peripherals_file(strChipType):
+    strChipType = resolve_chip_type_alias(strChipType)
+    for tCombo in atKnownCombos:
+        if tCombo['chip_id']==strChipType and tCombo['board_id']=='default':
+            return tCombo['hwctool_peripherals']
+    raise Exception('No peripheral definition found for chip type "%s".' % strChipType)
+
+# Read the list of hardware configs for a batch.
+# Each line has the hwconfig file and the output file. Paths with spaces must
+# be enclosed in double quotes. Empty lines and lines starting with "#" are
+# ignored.
+def read_batch_list(strListFile):
+    atJobs = []
+    tFile = open(strListFile, 'rt')
+    for strLine in tFile:
+        strLine = strLine.strip()
+        if len(strLine) == 0 or strLine[0] == '#':
+            continue
+        astrPaths = shlex.split(strLine)
+        if len(astrPaths) != 2:
+            tFile.close()
+            raise Exception('Invalid line in the batch list "%s": %s' % (strListFile, strLine))
+        atJobs.append((astrPaths[0], astrPaths[1]))
+    tFile.close()
+    return atJobs
+
+# Generate one HBoot XML file of a batch.
+# The peripheral definitions are read only once in each process. They are
+# reset before the next hardware config.
+# Returns None on success or the error message.
+def batch_make_hboot_xml(strHwConfigFile, strOutputFile, strPeripheralsFile, strModelCacheFolder, strImageTemplate=None, fOptimizeRegisters=False, fDropRegisterDefaults=False):
+    strError = None
+    try:
+        tHwConfig = HwConfig()
+        tHwConfig.read_hwconfig(strHwConfigFile)
+        if strPeripheralsFile is None:
+            strPeripheralsFile = get_peripherals_file(tHwConfig.get_chip_type())
+
+        tPeripheral = atBatchPeripherals.get(strPeripheralsFile)
+        if tPeripheral is None:
+            tPeripheral = Peripherals()
+            tPeripheral.read(strPeripheralsFile, strModelCacheFolder)
+            atBatchPeripherals[strPeripheralsFile] = tPeripheral
+        else:
+            tPeripheral.reset()
+
+        apply_hwconfig(tPeripheral, tHwConfig)
+        write_hwconfig_output(tPeripheral, tHwConfig, strOutputFile, strImageTemplate, fOptimizeRegisters, fDropRegisterDefaults)
+    except Exception as e:
+        strError = str(e)
+    return strError
+
+def make_hboot_xml_batch(tArgs):
+    logging.info(version_string)
+
+    # Collect the hardware configs from the command line and the list.
+    if (len(tArgs.astrFiles) % 2) != 0:
+        raise Exception('The hwconfig and output files must be given in pairs.')
+    atJobs = []
+    for uiIndex in range(0, len(tArgs.astrFiles), 2):
+        atJobs.append((tArgs.astrFiles[uiIndex], tArgs.astrFiles[uiIndex + 1]))
+    if tArgs.strListFile is not None:
+        atJobs.extend(read_batch_list(tArgs.strListFile))
+
+    uiJobs = tArgs.uiJobs
+    if uiJobs == 0:
+        uiJobs = os.cpu_count() or 1
+
+    if uiJobs > 1 and len(atJobs) > 1:
+        # Each process reads the peripheral definitions only once.
+        tPool = concurrent.futures.ProcessPoolExecutor(min(uiJobs, len(atJobs)))
+        atResults = list(tPool.map(
+            batch_make_hboot_xml,
+            [tJob[0] for tJob in atJobs],
+            [tJob[1] for tJob in atJobs],
+            [tArgs.strPeripheralsFile] * len(atJobs),
+            [tArgs.strModelCacheFolder] * len(atJobs),
+            [tArgs.strImageTemplate] * len(atJobs),
+            [tArgs.fOptimizeRegisters] * len(atJobs),
+            [tArgs.fDropRegisterDefaults] * len(atJobs)
+        ))
+        tPool.shutdown()
+    else:
+        atResults = []
+        for strHwConfigFile, strOutputFile in atJobs:
+            atResults.append(batch_make_hboot_xml(strHwConfigFile, strOutputFile, tArgs.strPeripheralsFile, tArgs.strModelCacheFolder, tArgs.strImageTemplate, tArgs.fOptimizeRegisters, tArgs.fDropRegisterDefaults))
+
+        if tArgs.fScriptTimes is True:
+            for strPeripheralsFile, tPeripheral in atBatchPeripherals.items():
+                logging.info('Script times for %s:' % strPeripheralsFile)
+                tPeripheral.log_script_times()
+
+    uiErrors = 0
+    for tJob, strError in zip(atJobs, atResults):
+        if strError is None:
+            logging.info('Generated %s from %s.' % (tJob[1], tJob[0]))
+        else:
+            logging.error('Failed to generate %s from %s: %s' % (tJob[1], tJob[0], strError))
+            uiErrors += 1
+    if uiErrors != 0:
+        raise Exception('%d of %d hardware configs failed.' % (uiErrors, len(atJobs)))
 
 
 
@@ -1943,6 +2840,17 @@ def list_supported_targets(tArgs):
             f.write(strPrettyXml)
 
 
+# Get the tag and the attributes of the root element of an XML file.
+# Only the start of the file is parsed.
+def read_root_attributes(strInputPath):
+    tFile = open(strInputPath, 'rb')
+    try:
+        for strEvent, tNode in ElementTree.iterparse(tFile, events=('start',)):
+            return tNode.tag, dict(tNode.attrib)
+    finally:
+        tFile.close()
+    raise Exception('No root element found in "%s".' % strInputPath)
+
 # Get chip types, boards and version from an XML file.
 # Get attributes 'chip_type', 'board' and 'version' from the root element
 # and split chip type and board as a comma-separated list.
@@ -2014,10 +2922,181 @@ def get_peripherals(strChipID, strBoardID):
 # - Extract the peripheral IDs from the gui file.
 # - Filter by these peripheral IDs
 
-def list_dynamic_cfg(tArgs):
-    # We assume that this is always set.
-    strLibPath = tArgs.strLibPath 
-    
+class OverlayIndex:
+    """Find the overlays for a chip type and board.
+
+    The index has the chip types and boards of all overlays in a directory
+    tree. Only the start of each file is read to get the attributes of the
+    root element. A directory is listed again only if its modification
+    time changed. The size and modification time of each known file are
+    always checked, and only new or changed files are read.
+    The index is shared by all instances in this process and can be kept
+    in a file.
+    """
+    # These are the indexes in this process. The key is the real path of
+    # the overlay directory.
+    __atProcessCache = {}
+
+    __strOverlayPath = None
+    __strCacheFile = None
+
+    # This is a dictionary with the path of each directory relative to the
+    # overlay directory as the key. Each entry has the modification time,
+    # the list of subdirectories and a dictionary with the files.
+    __atDirs = None
+
+    # This translates a chip type to a list of tuples with the path and the
+    # boards of an overlay.
+    __atChipTypes = None
+
+    __strPattern = '*.xml'
+    __uiCacheFormat = 1
+
+    def __init__(self, strOverlayPath, strCacheFile=None):
+        self.__strOverlayPath = os.path.realpath(strOverlayPath)
+        self.__strCacheFile = strCacheFile
+
+        atDirs = OverlayIndex.__atProcessCache.get(self.__strOverlayPath)
+        if (atDirs is None) and (strCacheFile is not None):
+            atDirs = self.__cache_read()
+        if atDirs is None:
+            atDirs = {}
+        self.__atDirs = atDirs
+
+    def __cache_read(self):
+        atDirs = None
+        if os.path.isfile(self.__strCacheFile):
+            try:
+                tFile = open(self.__strCacheFile, 'rt')
+                atCache = json.load(tFile)
+                tFile.close()
+                if (atCache.get('format') == self.__uiCacheFormat) and (atCache.get('path') == self.__strOverlayPath):
+                    atDirs = atCache['dirs']
+            except ValueError:
+                logging.warning('Ignoring the invalid overlay index "%s".' % self.__strCacheFile)
+        return atDirs
+
+    def __cache_write(self):
+        atCache = {
+            'format': self.__uiCacheFormat,
+            'path': self.__strOverlayPath,
+            'dirs': self.__atDirs
+        }
+        strFolder = os.path.dirname(os.path.abspath(self.__strCacheFile))
+        tFile = tempfile.NamedTemporaryFile(mode='wt', dir=strFolder, delete=False)
+        json.dump(atCache, tFile)
+        tFile.close()
+        os.replace(tFile.name, self.__strCacheFile)
+
+    def __read_file(self, strPath):
+        strTag, atAttributes = read_root_attributes(strPath)
+        if strTag != 'peripherals':
+            raise Exception('The overlay "%s" has the root element "%s" instead of "peripherals".' % (strPath, strTag))
+        if 'chip_type' not in atAttributes:
+            raise Exception('Missing attribute "chip_type" in the overlay "%s".' % strPath)
+        astrBoards = None
+        if 'board' in atAttributes:
+            astrBoards = atAttributes['board'].split(',')
+        return atAttributes['chip_type'].split(','), astrBoards
+
+    def __scan_file(self, strPath, tStat, atOldFile):
+        # Read the file only if its size or modification time changed.
+        # Returns the entry and True if it is new or changed.
+        if (atOldFile is not None) and (atOldFile['mtime'] == tStat.st_mtime_ns) and (atOldFile['size'] == tStat.st_size):
+            return atOldFile, False
+        astrChipTypes, astrBoards = self.__read_file(strPath)
+        atFile = {
+            'mtime': tStat.st_mtime_ns,
+            'size': tStat.st_size,
+            'chip_types': astrChipTypes,
+            'boards': astrBoards
+        }
+        return atFile, True
+
+    def __scan(self, strRelDir, atNewDirs):
+        # List the directory only if it changed. An edit of a file does not
+        # change the directory, so the known files are always checked.
+        strDir = os.path.join(self.__strOverlayPath, strRelDir)
+        ulMTime = os.stat(strDir).st_mtime_ns
+        atOldDir = self.__atDirs.get(strRelDir)
+        fChanged = False
+        atOldFiles = {}
+        if atOldDir is not None:
+            atOldFiles = atOldDir['files']
+        atFiles = {}
+        if (atOldDir is not None) and (atOldDir['mtime'] == ulMTime):
+            astrSubdirs = atOldDir['subdirs']
+            for strName in sorted(atOldFiles.keys()):
+                strPath = os.path.join(strDir, strName)
+                try:
+                    tStat = os.stat(strPath)
+                except FileNotFoundError:
+                    fChanged = True
+                    continue
+                atFile, fFileChanged = self.__scan_file(strPath, tStat, atOldFiles[strName])
+                if fFileChanged is True:
+                    fChanged = True
+                atFiles[strName] = atFile
+        else:
+            fChanged = True
+            astrSubdirs = []
+            for tEntry in sorted(os.scandir(strDir), key=lambda tEntry: tEntry.name):
+                if tEntry.is_dir():
+                    astrSubdirs.append(tEntry.name)
+                elif fnmatch.fnmatch(tEntry.name, self.__strPattern) and tEntry.is_file():
+                    atFile, _ = self.__scan_file(tEntry.path, tEntry.stat(), atOldFiles.get(tEntry.name))
+                    atFiles[tEntry.name] = atFile
+        atDir = {
+            'mtime': ulMTime,
+            'subdirs': astrSubdirs,
+            'files': atFiles
+        }
+        atNewDirs[strRelDir] = atDir
+
+        for strSubdir in atDir['subdirs']:
+            if self.__scan(os.path.join(strRelDir, strSubdir), atNewDirs) is True:
+                fChanged = True
+        return fChanged
+
+    def refresh(self):
+        """Read all changed directories and files again."""
+        atNewDirs = {}
+        fChanged = self.__scan('', atNewDirs)
+        if len(atNewDirs) != len(self.__atDirs):
+            fChanged = True
+        self.__atDirs = atNewDirs
+        OverlayIndex.__atProcessCache[self.__strOverlayPath] = atNewDirs
+        if (fChanged is True) and (self.__strCacheFile is not None):
+            self.__cache_write()
+
+        # Map the chip types to the files.
+        atChipTypes = {}
+        for strRelDir in sorted(atNewDirs.keys()):
+            atDir = atNewDirs[strRelDir]
+            for strName in sorted(atDir['files'].keys()):
+                atFile = atDir['files'][strName]
+                strPath = os.path.join(self.__strOverlayPath, strRelDir, strName)
+                for strChipType in atFile['chip_types']:
+                    atChipTypes.setdefault(strChipType, []).append((strPath, atFile['boards']))
+        self.__atChipTypes = atChipTypes
+
+    def find(self, strChipType, strBoard=None):
+        """Get all overlays for the chip type and the board.
+
+        Overlays without a board attribute are applicable to all boards.
+        """
+        if self.__atChipTypes is None:
+            self.refresh()
+        astrFiles = []
+        for strPath, astrBoards in self.__atChipTypes.get(strChipType, []):
+            if (strBoard is None) or (astrBoards is None) or (strBoard in astrBoards):
+                astrFiles.append(strPath)
+        return astrFiles
+
+
+# Get the folder with the overlays.
+# Without a sniplib path this is the folder "overlay" next to this tool.
+def get_overlay_path(strLibPath=None):
     # If strLibPath is not set, use the location of the HWConfig tool.
     if strLibPath == None:
         # Path to this script
@@ -2045,17 +3124,19 @@ def list_dynamic_cfg(tArgs):
         strErr = 'Path does not exist or is not a directory: %s' % (strOverlayPath)
         logging.error(strErr)
         raise Exception(strErr)
-        
-    strChipType = tArgs.strChipType
-    strBoard = tArgs.strBoard
-    astrDynCfg = []
-    strPattern = "*.xml" # Filtering using fnmatch.filter is case-insensitive
-    for strDir, astrSubdirs, astrFiles in os.walk(strOverlayPath):
-        for strFile in fnmatch.filter(astrFiles, strPattern):
-            strFilePath = os.path.join(strDir, strFile)
-            astrChipTypes, astrBoards, strVersion = xml_get_info(strFilePath, 'peripherals')
-            if strChipType in astrChipTypes and (strBoard is None or astrBoards is None or strBoard in astrBoards):
-                astrDynCfg.append(strFilePath)
+
+    return strOverlayPath
+
+# Get the list of overlay files for a chip type and board.
+# This is the library version of list_dynamic_cfg.
+def get_dynamic_cfg(strChipType, strBoard=None, strLibPath=None, strIndexFile=None):
+    strChipType = resolve_chip_type_alias(strChipType)
+    tIndex = OverlayIndex(get_overlay_path(strLibPath), strIndexFile)
+    tIndex.refresh()
+    return tIndex.find(strChipType, strBoard)
+
+def list_dynamic_cfg(tArgs):
+    astrDynCfg = get_dynamic_cfg(tArgs.strChipType, tArgs.strBoard, tArgs.strLibPath, tArgs.strIndexFile)
             
     # Print to console
     print('>>----------------------------- dynamic cfg')
@@ -2079,14 +3160,11 @@ def list_dynamic_cfg(tArgs):
             f.write(strPrettyXml)
         
     
-def update_hwconfig(tArgs):
+# Apply all updates for the version of the hardware config.
+# Returns True if the hardware config was updated.
+def apply_hwconfig_updates(tHwConfig):
     fUpdated = False
-    logging.info(version_string)
-    
-    # Read the hwconfig.
-    tHwConfig = HwConfig()
-    tHwConfig.read_hwconfig(tArgs.strHwConfigFile)
-    
+
     # Get the tool_version chip_type attributes
     strToolVersion = tHwConfig.get_doc_version() # tool_version attribute of the hwconfig tag
     strChipType = tHwConfig.get_chip_type()
@@ -2126,8 +3204,105 @@ def update_hwconfig(tArgs):
         logging.info("The hardware config has been updated.")
         logging.info("Setting version to %s" % (strCurrentVersion))
         tHwConfig.set_doc_version(strCurrentVersion)
+
+    return fUpdated
+
+def update_hwconfig(tArgs):
+    logging.info(version_string)
+    
+    # Read the hwconfig.
+    tHwConfig = HwConfig()
+    tHwConfig.read_hwconfig(tArgs.strHwConfigFile)
+
+    apply_hwconfig_updates(tHwConfig)
         
     if tArgs.strOutputFile is not None:
         tHwConfig.write_hwconfig(tArgs.strOutputFile)
 
 
+# Update one file of a tree.
+# Returns the result ("current", "updated", "unchanged" or "skipped") and
+# the error message or None.
+def update_hwconfig_file(strInputPath, fDryRun):
+    strResult = None
+    strError = None
+    try:
+        # Skip files which are no hardware configs or which are already up
+        # to date without parsing them completely.
+        strTag, atAttributes = read_root_attributes(strInputPath)
+        if strTag != 'hwconfig':
+            strResult = 'skipped'
+        elif atAttributes.get('tool_version') == __revision__:
+            strResult = 'current'
+        else:
+            tHwConfig = HwConfig()
+            tHwConfig.read_hwconfig(strInputPath)
+            if apply_hwconfig_updates(tHwConfig) is not True:
+                strResult = 'unchanged'
+            else:
+                strResult = 'updated'
+                if fDryRun is not True:
+                    # Replace the file only after the new one is complete.
+                    tFile = tempfile.NamedTemporaryFile(
+                        dir=os.path.dirname(os.path.abspath(strInputPath)),
+                        suffix='.xml',
+                        delete=False
+                    )
+                    tFile.close()
+                    try:
+                        tHwConfig.write_hwconfig(tFile.name)
+                        os.chmod(tFile.name, os.stat(strInputPath).st_mode & 0o7777)
+                        os.replace(tFile.name, strInputPath)
+                    except Exception:
+                        os.remove(tFile.name)
+                        raise
+    except Exception as e:
+        strError = str(e)
+    return strResult, strError
+
+def update_hwconfig_tree(tArgs):
+    logging.info(version_string)
+
+    # Collect all files.
+    astrFiles = []
+    for strRoot, astrDirs, astrNames in os.walk(tArgs.strPath):
+        astrDirs.sort()
+        for strName in sorted(astrNames):
+            if fnmatch.fnmatch(strName, tArgs.strPattern):
+                astrFiles.append(os.path.join(strRoot, strName))
+
+    uiJobs = tArgs.uiJobs
+    if uiJobs == 0:
+        uiJobs = os.cpu_count() or 1
+
+    if uiJobs > 1 and len(astrFiles) > 1:
+        tPool = concurrent.futures.ProcessPoolExecutor(min(uiJobs, len(astrFiles)))
+        atResults = list(tPool.map(
+            update_hwconfig_file,
+            astrFiles,
+            [tArgs.fDryRun] * len(astrFiles),
+            chunksize=16
+        ))
+        tPool.shutdown()
+    else:
+        atResults = [update_hwconfig_file(strFile, tArgs.fDryRun) for strFile in astrFiles]
+
+    atCounts = {'current': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0}
+    uiErrors = 0
+    for strFile, (strResult, strError) in zip(astrFiles, atResults):
+        if strError is not None:
+            logging.error('Failed to update %s: %s' % (strFile, strError))
+            uiErrors += 1
+        else:
+            atCounts[strResult] += 1
+            if strResult == 'updated':
+                if tArgs.fDryRun is True:
+                    logging.info('Would update %s' % strFile)
+                else:
+                    logging.info('Updated %s' % strFile)
+            else:
+                logging.debug('%s: %s' % (strFile, strResult))
+
+    logging.info('%d files: %d updated, %d already current, %d unchanged, %d no hwconfig, %d failed.' % (len(astrFiles), atCounts['updated'], atCounts['current'], atCounts['unchanged'], atCounts['skipped'], uiErrors))
+    if uiErrors != 0:
+        raise Exception('%d hardware configs could not be updated.' % uiErrors)
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+# Create and verify sector based patches between two compiled images.
+#
+# A patch contains only the flash sectors which differ between an old and a
+# new image. A flasher which knows that the old image is in the flash can
+# erase and write only these sectors.
+#
+# Patch format (all values are little endian DWORDs):
+#   magic "HBDP", version, sector size, flash offset,
+#   size of the old image, size of the new image,
+#   SHA256 of the old image (32 bytes), SHA256 of the new image (32 bytes),
+#   number of sectors,
+#   for each sector: the flash address, the number of data bytes, the data,
+#   SHA256 over everything before (32 bytes).
+#
+# The data of the last sector is shorter if the new image ends inside it.
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+from . import image_inspector
+
+
+class ImageDelta:
+    __strMagic = b'HBDP'
+    __ulVersion = 1
+    __strHeaderFormat = '<4sIIIII32s32sI'
+    __strSectorFormat = '<II'
+
+    __sizSector = None
+    __ulFlashOffset = None
+    __sizOld = None
+    __sizNew = None
+    __strOldHash = None
+    __strNewHash = None
+    # This is a list of (address, data) tuples.
+    __atSectors = None
+
+    def __init__(self, sizSector=4096, ulFlashOffset=0):
+        if sizSector <= 0:
+            raise Exception('The sector size must be greater than 0.')
+        if (ulFlashOffset % sizSector) != 0:
+            raise Exception(
+                'The flash offset 0x%08x is not aligned to the sector size '
+                'of %d bytes.' % (ulFlashOffset, sizSector)
+            )
+        self.__sizSector = sizSector
+        self.__ulFlashOffset = ulFlashOffset
+        self.__atSectors = []
+
+    def __map_file(self, tFile):
+        if os.fstat(tFile.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(tFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def create(self, strOldImage, strNewImage):
+        """Compare the old and the new image and collect all changed sectors."""
+        sizSector = self.__sizSector
+        self.__atSectors = []
+
+        tFileOld = open(strOldImage, 'rb')
+        tFileNew = open(strNewImage, 'rb')
+        try:
+            tOld = self.__map_file(tFileOld)
+            tNew = self.__map_file(tFileNew)
+            self.__sizOld = len(tOld)
+            self.__sizNew = len(tNew)
+            self.__strOldHash = hashlib.sha256(tOld).digest()
+            self.__strNewHash = hashlib.sha256(tNew).digest()
+
+            # Compare the images sector by sector. The slices of a mmap are
+            # copies, so compare memoryviews.
+            with memoryview(tOld) as tViewOld, memoryview(tNew) as tViewNew:
+                for ulOffset in range(0, self.__sizNew, sizSector):
+                    ulEnd = ulOffset + sizSector
+                    with tViewNew[ulOffset:ulEnd] as tSectorNew, tViewOld[ulOffset:ulEnd] as tSectorOld:
+                        if tSectorNew != tSectorOld:
+                            self.__atSectors.append((
+                                self.__ulFlashOffset + ulOffset,
+                                bytes(tSectorNew)
+                            ))
+
+            if isinstance(tOld, mmap.mmap):
+                tOld.close()
+            if isinstance(tNew, mmap.mmap):
+                tNew.close()
+        finally:
+            tFileOld.close()
+            tFileNew.close()
+
+    def write(self, strPatchFile):
+        tHash = hashlib.sha256()
+        tFile = open(strPatchFile, 'wb')
+        strData = struct.pack(
+            self.__strHeaderFormat,
+            self.__strMagic,
+            self.__ulVersion,
+            self.__sizSector,
+            self.__ulFlashOffset,
+            self.__sizOld,
+            self.__sizNew,
+            self.__strOldHash,
+            self.__strNewHash,
+            len(self.__atSectors)
+        )
+        tHash.update(strData)
+        tFile.write(strData)
+        for ulAddress, strSector in self.__atSectors:
+            strData = struct.pack(self.__strSectorFormat, ulAddress, len(strSector))
+            tHash.update(strData)
+            tFile.write(strData)
+            tHash.update(strSector)
+            tFile.write(strSector)
+        tFile.write(tHash.digest())
+        tFile.close()
+
+    def read(self, strPatchFile):
+        tFile = open(strPatchFile, 'rb')
+        strPatch = tFile.read()
+        tFile.close()
+
+        sizHeader = struct.calcsize(self.__strHeaderFormat)
+        if len(strPatch) < (sizHeader + 32):
+            raise Exception('The patch "%s" is too small.' % strPatchFile)
+        if hashlib.sha256(strPatch[:-32]).digest() != strPatch[-32:]:
+            raise Exception('The patch "%s" is damaged.' % strPatchFile)
+
+        (
+            strMagic,
+            ulVersion,
+            self.__sizSector,
+            self.__ulFlashOffset,
+            self.__sizOld,
+            self.__sizNew,
+            self.__strOldHash,
+            self.__strNewHash,
+            sizSectors
+        ) = struct.unpack_from(self.__strHeaderFormat, strPatch, 0)
+        if strMagic != self.__strMagic:
+            raise Exception('The file "%s" is no patch.' % strPatchFile)
+        if ulVersion != self.__ulVersion:
+            raise Exception('Unsupported patch version %d.' % ulVersion)
+
+        self.__atSectors = []
+        ulOffset = sizHeader
+        sizSectorHeader = struct.calcsize(self.__strSectorFormat)
+        for _ in range(sizSectors):
+            ulAddress, sizData = struct.unpack_from(
+                self.__strSectorFormat,
+                strPatch,
+                ulOffset
+            )
+            ulOffset += sizSectorHeader
+            self.__atSectors.append(
+                (ulAddress, strPatch[ulOffset:ulOffset + sizData])
+            )
+            ulOffset += sizData
+        if ulOffset != (len(strPatch) - 32):
+            raise Exception('The patch "%s" has a wrong size.' % strPatchFile)
+
+    def get_sectors(self):
+        """Get a list of (flash address, data) tuples for all changed sectors."""
+        return list(self.__atSectors)
+
+    def get_sector_size(self):
+        return self.__sizSector
+
+    def get_new_size(self):
+        return self.__sizNew
+
+    def apply(self, strOldImage):
+        """Apply the patch to the old image and return the new image.
+
+        An exception is raised if the old image or the result do not match
+        the hashes in the patch.
+        """
+        tFile = open(strOldImage, 'rb')
+        aucImage = bytearray(tFile.read())
+        tFile.close()
+        if (len(aucImage) != self.__sizOld) or (hashlib.sha256(aucImage).digest() != self.__strOldHash):
+            raise Exception(
+                'The image "%s" is not the base of the patch.' % strOldImage
+            )
+
+        # The flash keeps the old contents after the end of the new image.
+        # The image itself ends there.
+        if len(aucImage) < self.__sizNew:
+            aucImage.extend(bytes(self.__sizNew - len(aucImage)))
+        for ulAddress, strSector in self.__atSectors:
+            ulOffset = ulAddress - self.__ulFlashOffset
+            if (ulOffset < 0) or ((ulOffset + len(strSector)) > self.__sizNew):
+                raise Exception(
+                    'The sector at 0x%08x is outside the image.' % ulAddress
+                )
+            aucImage[ulOffset:ulOffset + len(strSector)] = strSector
+        del aucImage[self.__sizNew:]
+
+        if hashlib.sha256(aucImage).digest() != self.__strNewHash:
+            raise Exception('The patched image does not match the new image.')
+        return bytes(aucImage)
+
+    def verify(self, strOldImage, strNewImage=None):
+        """Check that the patch turns the old image into the new one.
+
+        Returns a list of error messages. It is empty if the patch is fine.
+        """
+        astrErrors = []
+        try:
+            self.apply(strOldImage)
+        except Exception as tException:
+            astrErrors.append(str(tException))
+
+        if strNewImage is not None:
+            tFile = open(strNewImage, 'rb')
+            strNewHash = hashlib.sha256(tFile.read()).digest()
+            tFile.close()
+            if strNewHash != self.__strNewHash:
+                astrErrors.append(
+                    'The patch was not created for the image "%s".' %
+                    strNewImage
+                )
+        return astrErrors
+
+    def get_changed_chunks(self, strNewImage):
+        """Map the changed sectors to the chunks of the new image.
+
+        Returns a list of (flash address, [chunk tags]) tuples. The header and
+        the pre-padding are reported as "header".
+        """
+        atResult = image_inspector.inspect_file(strNewImage)
+        atRanges = []
+        ulHeaderOffset = atResult.get('header_offset')
+        if ulHeaderOffset is not None:
+            atRanges.append(('header', 0, ulHeaderOffset + 64))
+        for atChunk in atResult['chunks']:
+            atRanges.append((
+                atChunk['tag'],
+                atChunk['offset'],
+                atChunk['offset'] + atChunk['size']
+            ))
+
+        atChanges = []
+        for ulAddress, strSector in self.__atSectors:
+            ulStart = ulAddress - self.__ulFlashOffset
+            ulEnd = ulStart + len(strSector)
+            astrTags = [
+                strTag for strTag, ulChunkStart, ulChunkEnd in atRanges
+                if (ulChunkStart < ulEnd) and (ulChunkEnd > ulStart)
+            ]
+            atChanges.append((ulAddress, astrTags))
+        return atChanges
+
+
+def __print_summary(tDelta, strNewImage):
+    atSectors = tDelta.get_sectors()
+    sizPatch = sum(len(strSector) for _, strSector in atSectors)
+    print('%d changed sectors with %d bytes of %d bytes.' % (
+        len(atSectors),
+        sizPatch,
+        tDelta.get_new_size()
+    ))
+    if strNewImage is not None:
+        for ulAddress, astrTags in tDelta.get_changed_chunks(strNewImage):
+            print('  0x%08x: %s' % (ulAddress, ', '.join(astrTags)))
+
+
+def create_delta(tArgs):
+    tDelta = ImageDelta(tArgs.sizSector, int(tArgs.strFlashOffset, 0))
+    tDelta.create(tArgs.strOldImage, tArgs.strNewImage)
+    tDelta.write(tArgs.strPatchFile)
+    if tArgs.fVerbose is True:
+        __print_summary(tDelta, tArgs.strNewImage)
+
+
+def verify_delta(tArgs):
+    tDelta = ImageDelta()
+    tDelta.read(tArgs.strPatchFile)
+    astrErrors = tDelta.verify(tArgs.strOldImage, tArgs.strNewImage)
+    if tArgs.fVerbose is True:
+        __print_summary(tDelta, tArgs.strNewImage)
+    if len(astrErrors) != 0:
+        for strError in astrErrors:
+            print('FAIL %s' % strError)
+        sys.exit(1)
+    print('OK')
+
+
+def apply_delta(tArgs):
+    tDelta = ImageDelta()
+    tDelta.read(tArgs.strPatchFile)
+    strImage = tDelta.apply(tArgs.strOldImage)
+    tFile = open(tArgs.strOutputFile, 'wb')
+    tFile.write(strImage)
+    tFile.close()
+
+
+if __name__ == '__main__':
+    tParser = argparse.ArgumentParser(usage='image_delta [options]')
+    tParser.add_argument('-v', '--verbose',
+                         dest='fVerbose',
+                         required=False,
+                         default=False,
+                         action='store_const', const=True,
+                         help='List the changed sectors.')
+    tSubparsers = tParser.add_subparsers(
+        dest='strCommand',
+        required=True,
+        metavar='COMMAND',
+        help='sub-command -h')
+
+    tParserCreate = tSubparsers.add_parser(
+        'create',
+        description='Create a patch with all sectors which differ between '
+                    'two images.',
+        help='create -h')
+    tParserCreate.add_argument('-s', '--sector-size',
+                               dest='sizSector',
+                               required=False,
+                               default=4096,
+                               type=int,
+                               metavar='SIZE',
+                               help='Compare sectors of SIZE bytes. The '
+                                    'default is 4096.')
+    tParserCreate.add_argument('-f', '--flash-offset',
+                               dest='strFlashOffset',
+                               required=False,
+                               default='0',
+                               metavar='OFFSET',
+                               help='The image starts at OFFSET in the '
+                                    'flash. It must be sector aligned.')
+    tParserCreate.add_argument('strOldImage',
+                               metavar='OLD',
+                               help='The image which is in the flash.')
+    tParserCreate.add_argument('strNewImage',
+                               metavar='NEW',
+                               help='The image which should be in the flash.')
+    tParserCreate.add_argument('strPatchFile',
+                               metavar='PATCH',
+                               help='Write the patch to PATCH.')
+    tParserCreate.set_defaults(func=create_delta)
+
+    tParserVerify = tSubparsers.add_parser(
+        'verify',
+        description='Check that a patch turns OLD into NEW.',
+        help='verify -h')
+    tParserVerify.add_argument('strOldImage',
+                               metavar='OLD',
+                               help='The image which is in the flash.')
+    tParserVerify.add_argument('strPatchFile',
+                               metavar='PATCH',
+                               help='Read the patch from PATCH.')
+    tParserVerify.add_argument('strNewImage',
+                               nargs='?',
+                               metavar='NEW',
+                               help='Compare the result with the image NEW.')
+    tParserVerify.set_defaults(func=verify_delta)
+
+    tParserApply = tSubparsers.add_parser(
+        'apply',
+        description='Apply a patch to an image.',
+        help='apply -h')
+    tParserApply.add_argument('strOldImage',
+                              metavar='OLD',
+                              help='Read the old image from OLD.')
+    tParserApply.add_argument('strPatchFile',
+                              metavar='PATCH',
+                              help='Read the patch from PATCH.')
+    tParserApply.add_argument('strOutputFile',
+                              metavar='OUTPUT',
+                              help='Write the new image to OUTPUT.')
+    tParserApply.set_defaults(func=apply_delta)
+
+    tArgs = tParser.parse_args()
+    tArgs.func(tArgs)
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+# Inspect and verify existing HBoot images without compiling them again.
+#
+# The image is memory mapped. The chunks are walked by their tag and size
+# and all hashes are computed directly on the mapped file.
+#
+# Limitations:
+# Images without a header (SECMEM and info pages) can not be inspected.
+# Signatures are not verified.
+# The SKIP chunks with the ROM workarounds for the netX90 MPW SQIROM and the
+# netX4000 RELAXED have a different size field and break the chunk walk.
+
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+import sys
+
+
+class ImageInspector:
+    # These are the magic cookies of all known chips.
+    __aulMagicCookies = [
+        0xf8beaf00,
+        0xf3beaf00,
+        0xf3ad9e00
+    ]
+    __MAGIC_COOKIE_NETX56 = 0xf8beaf00
+
+    # Search the header only in the first part of the file. Everything
+    # before the header is the pre-padding.
+    __sizMaximumPrePadding = 1024 * 1024
+
+    # These chunks end with a truncated SHA384 over the tag, the size and
+    # the data.
+    __astrChunksWithHash = [
+        'OPTS',
+        'REGI',
+        'FRWL',
+        'DATA',
+        'TEXT',
+        'EXEC',
+        'EXA9',
+        'SPIM',
+        'MDUP',
+        'NEXT',
+        'DAXZ'
+    ]
+
+    # These chunks are protected by a signature instead of a hash.
+    __astrSignedChunks = [
+        'RCRT',
+        'LCRT',
+        'R7SW',
+        'A9SW',
+        'USIP',
+        'HTBL'
+    ]
+
+    __strImagePath = None
+    __ulHeaderOffset = None
+
+    def __init__(self, strImagePath, ulHeaderOffset=None):
+        self.__strImagePath = strImagePath
+        self.__ulHeaderOffset = ulHeaderOffset
+
+    def __get_dwords(self, tData, ulOffset, sizDwords):
+        return struct.unpack_from('<%dI' % sizDwords, tData, ulOffset)
+
+    def __header_checksum_is_valid(self, aulHeader):
+        # The checksum in the last DWORD makes the sum of all 16 DWORDs 0.
+        return (sum(aulHeader) & 0xffffffff) == 0
+
+    def __find_header(self, tData):
+        sizData = len(tData)
+        if self.__ulHeaderOffset is not None:
+            if (self.__ulHeaderOffset + 64) > sizData:
+                raise Exception(
+                    'The header offset %d is beyond the end of the file.' %
+                    self.__ulHeaderOffset
+                )
+            return self.__ulHeaderOffset
+
+        # Search for a magic cookie at a DWORD aligned offset with a valid
+        # header checksum.
+        ulFirstFound = None
+        sizSearch = min(sizData - 64, self.__sizMaximumPrePadding)
+        for ulMagic in self.__aulMagicCookies:
+            strMagic = struct.pack('<I', ulMagic)
+            ulOffset = tData.find(strMagic, 0, sizSearch + 4)
+            while ulOffset != -1:
+                if (ulOffset & 3) == 0:
+                    aulHeader = self.__get_dwords(tData, ulOffset, 16)
+                    if self.__header_checksum_is_valid(aulHeader):
+                        if (ulFirstFound is None) or (ulOffset < ulFirstFound):
+                            ulFirstFound = ulOffset
+                        break
+                ulOffset = tData.find(strMagic, ulOffset + 1, sizSearch + 4)
+
+        if ulFirstFound is None:
+            # Report the checksum error of the plain header.
+            ulFirstFound = 0
+        return ulFirstFound
+
+    def __inspect_chunks(self, tData, ulStart, sizChunks, sizHashDw, fIsNetx56, atResult):
+        atChunks = atResult['chunks']
+        astrErrors = atResult['errors']
+        sizHash = sizHashDw * 4
+        ulEnd = ulStart + sizChunks
+        ulOffset = ulStart
+        fTruncated = False
+
+        while ulOffset < ulEnd:
+            if (ulOffset + 4) > ulEnd:
+                astrErrors.append(
+                    'The chunk at offset 0x%08x is truncated.' % ulOffset
+                )
+                fTruncated = True
+                break
+
+            # A tag of 0 is the end marker.
+            ulTag, = self.__get_dwords(tData, ulOffset, 1)
+            if ulTag == 0:
+                ulOffset += 4
+                break
+
+            if (ulOffset + 8) > ulEnd:
+                astrErrors.append(
+                    'The chunk at offset 0x%08x is truncated.' % ulOffset
+                )
+                fTruncated = True
+                break
+            _, sizChunkDw = self.__get_dwords(tData, ulOffset, 2)
+            sizChunk = 8 + 4 * sizChunkDw
+            strTag = bytes(tData[ulOffset:ulOffset + 4]).decode(
+                'ascii',
+                'replace'
+            )
+            atChunk = {
+                'tag': strTag,
+                'offset': ulOffset,
+                'size': sizChunk,
+                'hash': None
+            }
+            atChunks.append(atChunk)
+
+            if (ulOffset + sizChunk) > ulEnd:
+                atChunk['hash'] = 'truncated'
+                astrErrors.append(
+                    'The %s chunk at offset 0x%08x with %d bytes exceeds the '
+                    'image.' % (strTag, ulOffset, sizChunk)
+                )
+                fTruncated = True
+                break
+
+            # Get the part covered by the hash and the hash itself.
+            ulHash = None
+            if strTag == 'SKIP':
+                # The hash covers only the tag and the size. The skipped
+                # area follows the hash.
+                ulHash = ulOffset + 8
+            elif strTag == 'OPTS' and fIsNetx56 is True:
+                # The netX56 options have a CRC instead of a hash.
+                atChunk['hash'] = 'crc'
+            elif strTag in self.__astrChunksWithHash:
+                ulHash = ulOffset + sizChunk - sizHash
+            elif strTag in self.__astrSignedChunks:
+                atChunk['hash'] = 'signed'
+            else:
+                atChunk['hash'] = 'unknown'
+
+            if ulHash is not None:
+                tHash = hashlib.sha384()
+                tHash.update(tData[ulOffset:ulHash])
+                strHash = tHash.digest()[:sizHash]
+                if strHash == tData[ulHash:ulHash + sizHash]:
+                    atChunk['hash'] = 'ok'
+                else:
+                    atChunk['hash'] = 'bad'
+                    astrErrors.append(
+                        'The hash of the %s chunk at offset 0x%08x does not '
+                        'match.' % (strTag, ulOffset)
+                    )
+
+            ulOffset += sizChunk
+
+        if (fTruncated is False) and (ulOffset != ulEnd):
+            astrErrors.append(
+                'The chunks end at offset 0x%08x, but the header size ends '
+                'at 0x%08x.' % (ulOffset, ulEnd)
+            )
+
+    def inspect(self):
+        """Inspect the image and return a dict with the results.
+
+        The "errors" list is empty for a valid image.
+        """
+        atResult = {
+            'file': self.__strImagePath,
+            'header_offset': None,
+            'magic': None,
+            'chunks_size': None,
+            'hash_dwords': None,
+            'checksum': None,
+            'sha224': None,
+            'chunks': [],
+            'errors': []
+        }
+        astrErrors = atResult['errors']
+
+        tFile = open(self.__strImagePath, 'rb')
+        try:
+            if os.fstat(tFile.fileno()).st_size < 64:
+                astrErrors.append('The file is too small for a header.')
+                return atResult
+
+            tMap = mmap.mmap(tFile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with memoryview(tMap) as tData:
+                    self.__inspect_image(tMap, tData, atResult)
+            finally:
+                tMap.close()
+        finally:
+            tFile.close()
+
+        return atResult
+
+    def __inspect_image(self, tMap, tData, atResult):
+        astrErrors = atResult['errors']
+
+        ulHeaderOffset = self.__find_header(tMap)
+        atResult['header_offset'] = ulHeaderOffset
+        aulHeader = self.__get_dwords(tData, ulHeaderOffset, 16)
+        ulMagic = aulHeader[0]
+        atResult['magic'] = ulMagic
+        if ulMagic not in self.__aulMagicCookies:
+            # This is no HBoot image. The rest of the header is meaningless.
+            astrErrors.append('Unknown magic cookie 0x%08x.' % ulMagic)
+            return
+
+        # Validate the header checksum.
+        if self.__header_checksum_is_valid(aulHeader):
+            atResult['checksum'] = 'ok'
+        else:
+            atResult['checksum'] = 'bad'
+            astrErrors.append('The header checksum does not match.')
+
+        # The size in the header includes the end marker.
+        sizChunks = aulHeader[4] * 4
+        atResult['chunks_size'] = sizChunks
+        sizHashDw = (aulHeader[7] & 0x0f) + 1
+        atResult['hash_dwords'] = sizHashDw
+        ulStart = ulHeaderOffset + 64
+        if (ulStart + sizChunks) > len(tData):
+            astrErrors.append(
+                'The header size of %d bytes exceeds the file.' % sizChunks
+            )
+            sizChunks = len(tData) - ulStart
+
+        else:
+            # Validate the SHA224 over all chunks.
+            tHash = hashlib.sha224()
+            tHash.update(tData[ulStart:ulStart + sizChunks])
+            if tHash.digest() == tData[ulHeaderOffset + 32:ulHeaderOffset + 60]:
+                atResult['sha224'] = 'ok'
+            else:
+                atResult['sha224'] = 'bad'
+                astrErrors.append('The SHA224 in the header does not match.')
+
+        self.__inspect_chunks(
+            tData,
+            ulStart,
+            sizChunks,
+            sizHashDw,
+            ulMagic == self.__MAGIC_COOKIE_NETX56,
+            atResult
+        )
+
+
+def inspect_file(strImagePath, ulHeaderOffset=None):
+    """Inspect one image. Errors reading the file are reported in the result."""
+    try:
+        atResult = ImageInspector(strImagePath, ulHeaderOffset).inspect()
+    except Exception as tException:
+        atResult = {
+            'file': strImagePath,
+            'chunks': [],
+            'errors': [str(tException)]
+        }
+    return atResult
+
+
+def find_images(strPath, strPattern='*.bin'):
+    """List all files below strPath which match the pattern."""
+    astrImages = []
+    if os.path.isdir(strPath) is True:
+        for strRoot, astrDirs, astrFiles in os.walk(strPath):
+            astrDirs.sort()
+            for strFile in sorted(astrFiles):
+                if fnmatch.fnmatch(strFile, strPattern) is True:
+                    astrImages.append(os.path.join(strRoot, strFile))
+    else:
+        astrImages.append(strPath)
+    return astrImages
+
+
+def inspect_files(astrImagePaths, uiWorkers=None, ulHeaderOffset=None):
+    """Inspect a list of images in parallel.
+
+    The results are yielded in the order of the list.
+    """
+    if (uiWorkers is not None) and (uiWorkers <= 1):
+        for strImagePath in astrImagePaths:
+            yield inspect_file(strImagePath, ulHeaderOffset)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(uiWorkers) as tPool:
+            for atResult in tPool.map(
+                inspect_file,
+                astrImagePaths,
+                [ulHeaderOffset] * len(astrImagePaths),
+                chunksize=16
+            ):
+                yield atResult
+
+
+def print_result(atResult, fVerbose):
+    if len(atResult['errors']) == 0:
+        print('OK   %s' % atResult['file'])
+    else:
+        print('FAIL %s' % atResult['file'])
+        for strError in atResult['errors']:
+            print('       %s' % strError)
+
+    if fVerbose is True and atResult.get('header_offset') is not None:
+        print('       header at 0x%08x, magic 0x%08x, %d bytes of chunks, '
+              '%d hash DWORDs, checksum %s, SHA224 %s' % (
+                  atResult['header_offset'],
+                  atResult['magic'],
+                  atResult['chunks_size'],
+                  atResult['hash_dwords'],
+                  atResult['checksum'],
+                  atResult['sha224']
+              ))
+        for atChunk in atResult['chunks']:
+            print('       %s at 0x%08x, %d bytes, hash %s' % (
+                atChunk['tag'],
+                atChunk['offset'],
+                atChunk['size'],
+                atChunk['hash']
+            ))
+
+
+if __name__ == '__main__':
+    tParser = argparse.ArgumentParser(
+        usage='usage: image_inspector [options] PATH [PATH ...]'
+    )
+    tParser.add_argument('-j', '--jobs',
+                         dest='uiJobs',
+                         required=False,
+                         default=None,
+                         type=int,
+                         metavar='N',
+                         help='Verify N images in parallel. The default is '
+                              'the number of CPUs.')
+    tParser.add_argument('-o', '--offset',
+                         dest='strHeaderOffset',
+                         required=False,
+                         default=None,
+                         metavar='OFFSET',
+                         help='The header starts at OFFSET. The default is '
+                              'to search for it.')
+    tParser.add_argument('-p', '--pattern',
+                         dest='strPattern',
+                         required=False,
+                         default='*.bin',
+                         metavar='PATTERN',
+                         help='Verify all files matching PATTERN in a '
+                              'directory.')
+    tParser.add_argument('-v', '--verbose',
+                         dest='fVerbose',
+                         required=False,
+                         default=False,
+                         action='store_const', const=True,
+                         help='List all chunks.')
+    tParser.add_argument('astrPaths',
+                         nargs='+',
+                         metavar='PATH',
+                         help='Verify the image or all images in the '
+                              'directory PATH.')
+    tArgs = tParser.parse_args()
+
+    ulHeaderOffset = None
+    if tArgs.strHeaderOffset is not None:
+        ulHeaderOffset = int(tArgs.strHeaderOffset, 0)
+
+    astrImages = []
+    for strPath in tArgs.astrPaths:
+        astrImages.extend(find_images(strPath, tArgs.strPattern))
+
+    uiFailed = 0
+    for atResult in inspect_files(astrImages, tArgs.uiJobs, ulHeaderOffset):
+        print_result(atResult, tArgs.fVerbose)
+        if len(atResult['errors']) != 0:
+            uiFailed += 1
+
+    print('%d images checked, %d failed.' % (len(astrImages), uiFailed))
+    if uiFailed != 0:
+        sys.exit(1)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+# Generate many images from one compiled template.
+#
+# A template is a compiled image with named patch slots. These are the data
+# nodes with a "slot" attribute. The template knows all values which depend
+# on the slots: the hashes of the chunks, the entries of hash tables,
+# signatures, the image hash in the header and the header checksum. For each
+# device only the slots are patched and only the affected values are
+# computed again.
+
+import array
+import binascii
+import csv
+import hashlib
+import json
+
+from . import signer
+
+
+class ImageTemplate:
+    __strImage = None
+    __cSigner = None
+
+    # This is a dictionary with the slot name as the key and a list of all
+    # positions of the slot.
+    __atSlots = None
+
+    # This is the list of values which depend on other parts of the image.
+    # They are sorted so that each value only depends on the slots and
+    # values before it.
+    __atFields = None
+
+    def __init__(self, strImage, atSlots, atFields, cSigner):
+        """Create a template.
+
+        strImage is the complete compiled image. atSlots is a list of slots
+        with the keys "strName", "ulOffset", "sizData" and "strType".
+        atFields is a list of dependent values with the keys
+        "strKind" ("hash", "signature" or "checksum"), "ulStart" and "ulEnd"
+        for the source, "ulDst" and "sizDst" for the destination and kind
+        specific values.
+        """
+        self.__strImage = bytes(strImage)
+        self.__cSigner = cSigner
+
+        self.__atSlots = {}
+        atMutable = []
+        for atSlot in atSlots:
+            self.__atSlots.setdefault(atSlot['strName'], []).append(atSlot)
+            atMutable.append(
+                (atSlot['ulOffset'], atSlot['ulOffset'] + atSlot['sizData'])
+            )
+        for atField in atFields:
+            atMutable.append(
+                (atField['ulDst'], atField['ulDst'] + atField['sizDst'])
+            )
+
+        # The source of a hash or signature only changes after the first
+        # mutable byte. Keep the hash state of everything before it.
+        self.__atFields = []
+        for atField in atFields:
+            atField = dict(atField)
+            if atField['strKind'] in ['hash', 'signature']:
+                ulPrefixEnd = atField['ulEnd']
+                for ulStart, ulEnd in atMutable:
+                    if (ulStart < atField['ulEnd']) and (ulEnd > atField['ulStart']):
+                        ulPrefixEnd = min(ulPrefixEnd, max(ulStart, atField['ulStart']))
+                tHash = hashlib.new(atField.get('strAlgorithm', 'sha384'))
+                tHash.update(self.__strImage[atField['ulStart']:ulPrefixEnd])
+                atField['tPrefix'] = tHash
+                atField['ulPrefixEnd'] = ulPrefixEnd
+            self.__atFields.append(atField)
+
+    def get_slot_names(self):
+        return sorted(self.__atSlots.keys())
+
+    def get_image(self):
+        return self.__strImage
+
+    def __encode_slot(self, atSlot, tValue):
+        strType = atSlot['strType']
+        if isinstance(tValue, (list, tuple)):
+            astrValues = [str(tElement) for tElement in tValue]
+        else:
+            astrValues = str(tValue).split(',')
+
+        if strType == 'Hex':
+            strHex = ''.join(astrValues)
+            for strSeparator in [' ', '\t', '\r', '\n', ':', '-']:
+                strHex = strHex.replace(strSeparator, '')
+            strData = binascii.unhexlify(strHex)
+        else:
+            atTypecodes = {'UInt32': 'I', 'UInt16': 'H', 'UInt8': 'B'}
+            atNumbers = array.array(atTypecodes[strType])
+            for strNumber in astrValues:
+                atNumbers.append(int(strNumber.strip(), 0))
+            strData = atNumbers.tobytes()
+
+        if len(strData) != atSlot['sizData']:
+            raise Exception(
+                'The value for the slot "%s" has %d bytes, but the slot has '
+                '%d bytes.' % (atSlot['strName'], len(strData), atSlot['sizData'])
+            )
+        return strData
+
+    def __overlaps(self, atField, atDirty):
+        for ulStart, ulEnd in atDirty:
+            if (ulStart < atField['ulEnd']) and (ulEnd > atField['ulStart']):
+                return True
+        return False
+
+    def __get_digest(self, atField, aucImage):
+        tHash = atField['tPrefix'].copy()
+        tHash.update(aucImage[atField['ulPrefixEnd']:atField['ulEnd']])
+        tHash.update(atField.get('strSuffix', b''))
+        return tHash.digest()
+
+    def __set_field(self, atField, aucImage, atDirty, strData):
+        ulDst = atField['ulDst']
+        # A different size would move all following bytes of the image.
+        if len(strData) != atField['sizDst']:
+            raise Exception(
+                'The %s at offset 0x%08x has %d bytes, but the template has '
+                '%d bytes.' % (
+                    atField['strKind'],
+                    ulDst,
+                    len(strData),
+                    atField['sizDst']
+                )
+            )
+        afWriteDword = atField.get('afWriteDword')
+        if afWriteDword is None:
+            aucImage[ulDst:ulDst + atField['sizDst']] = strData
+        else:
+            # Some DWORDs of the header can be overridden.
+            for uiIndex, fWrite in enumerate(afWriteDword):
+                if fWrite is True:
+                    ulOffset = 4 * uiIndex
+                    aucImage[ulDst + ulOffset:ulDst + ulOffset + 4] = strData[ulOffset:ulOffset + 4]
+        atDirty.append((ulDst, ulDst + atField['sizDst']))
+
+    def __update_fields(self, aucImage, atDirty, atPending):
+        # Compute all fields which depend on a changed area. Stop after the
+        # signatures if some of them were sent to the signer.
+        while atPending['uiNextField'] < len(self.__atFields):
+            atField = self.__atFields[atPending['uiNextField']]
+            strKind = atField['strKind']
+            if (atPending['fWaitForSigner'] is True) and (strKind != 'signature'):
+                return False
+
+            if self.__overlaps(atField, atDirty):
+                if strKind == 'hash':
+                    # The chunk hashes are truncated.
+                    self.__set_field(
+                        atField,
+                        aucImage,
+                        atDirty,
+                        self.__get_digest(atField, aucImage)[:atField['sizDst']]
+                    )
+
+                elif strKind == 'signature':
+                    tRequest = atPending['atRequests'].get(atPending['uiNextField'])
+                    if tRequest is None:
+                        # Only submit the signature. It is collected with
+                        # the signatures of all other images in the batch.
+                        atPending['atRequests'][atPending['uiNextField']] = self.__cSigner.submit(
+                            atField['strKeyDER'],
+                            atField['iKeyTyp_1ECC_2RSA'],
+                            self.__get_digest(atField, aucImage)
+                        )
+                        atPending['fWaitForSigner'] = True
+                    else:
+                        strSignature = tRequest.result()
+                        if atField['fConvert'] is True:
+                            strSignature = signer.convert_signature(
+                                strSignature,
+                                atField['iKeyTyp_1ECC_2RSA'],
+                                atField['sizKeyInBytes']
+                            ).tobytes()
+                        elif atField['iKeyTyp_1ECC_2RSA'] == 1:
+                            # The image reserves the largest size of a DER
+                            # signature.
+                            strSignature = signer.pad_der_signature(
+                                strSignature,
+                                atField['sizDst']
+                            )
+                        self.__set_field(atField, aucImage, atDirty, strSignature)
+
+                elif strKind == 'checksum':
+                    aulHeader = array.array('I')
+                    aulHeader.frombytes(aucImage[atField['ulStart']:atField['ulEnd']])
+                    ulChecksum = ((sum(aulHeader) - 1) & 0xffffffff) ^ 0xffffffff
+                    self.__set_field(
+                        atField,
+                        aucImage,
+                        atDirty,
+                        array.array('I', [ulChecksum]).tobytes()
+                    )
+
+            atPending['uiNextField'] += 1
+
+        return atPending['fWaitForSigner'] is not True
+
+    def patch(self, atValues):
+        """Start a new image with the slot values from the dict atValues.
+
+        Slots which are not in atValues keep the value of the template.
+        Returns a job for finish. All signatures of a job are sent to the
+        signer, but the signer is not flushed.
+        """
+        aucImage = bytearray(self.__strImage)
+        atDirty = []
+        for strName, atSlotPositions in self.__atSlots.items():
+            if strName in atValues:
+                for atSlot in atSlotPositions:
+                    strData = self.__encode_slot(atSlot, atValues[strName])
+                    ulOffset = atSlot['ulOffset']
+                    aucImage[ulOffset:ulOffset + atSlot['sizData']] = strData
+                    atDirty.append((ulOffset, ulOffset + atSlot['sizData']))
+
+        atJob = {
+            'aucImage': aucImage,
+            'atDirty': atDirty,
+            'atPending': {
+                'uiNextField': 0,
+                'atRequests': {},
+                'fWaitForSigner': False
+            }
+        }
+        self.__update_fields(aucImage, atDirty, atJob['atPending'])
+        return atJob
+
+    def finish(self, atJob):
+        """Get the image for a job. The signer must be flushed before."""
+        atPending = atJob['atPending']
+        # Insert the signatures and compute everything after them.
+        atPending['uiNextField'] = min(
+            [atPending['uiNextField']] + list(atPending['atRequests'].keys())
+        )
+        atPending['fWaitForSigner'] = False
+        if self.__update_fields(atJob['aucImage'], atJob['atDirty'], atPending) is not True:
+            raise Exception('A signature depends on another signature.')
+        return atJob['aucImage']
+
+    def generate(self, tDevices, strOutputPattern, uiBatchSize=64):
+        """Write one image for each device.
+
+        tDevices is an iterable of dicts with the slot values. The file name
+        is strOutputPattern formatted with the device values and "index".
+        The devices are processed in batches of uiBatchSize. All signatures
+        of a batch are sent to the signer at once.
+        Returns the number of images.
+        """
+        uiIndex = 0
+        atBatch = []
+        for atDevice in tDevices:
+            strOutputFile = strOutputPattern.format(index=uiIndex, **atDevice)
+            atBatch.append((strOutputFile, self.patch(atDevice)))
+            uiIndex += 1
+            if len(atBatch) >= uiBatchSize:
+                self.__write_batch(atBatch)
+                atBatch = []
+        if len(atBatch) != 0:
+            self.__write_batch(atBatch)
+        return uiIndex
+
+    def __write_batch(self, atBatch):
+        self.__cSigner.flush()
+        for strOutputFile, atJob in atBatch:
+            aucImage = self.finish(atJob)
+            tFile = open(strOutputFile, 'wb')
+            tFile.write(aucImage)
+            tFile.close()
+
+
+def read_device_list(strDeviceList):
+    """Read the devices from a CSV, JSON or JSON lines file.
+
+    CSV files need a header line with the slot names. JSON files contain a
+    list of objects. JSON lines files (".jsonl") have one object per line.
+    The devices are yielded one by one.
+    """
+    strLower = strDeviceList.lower()
+    if strLower.endswith('.csv'):
+        tFile = open(strDeviceList, 'rt', newline='')
+        for atDevice in csv.DictReader(tFile):
+            yield atDevice
+        tFile.close()
+
+    elif strLower.endswith('.jsonl'):
+        tFile = open(strDeviceList, 'rt')
+        for strLine in tFile:
+            if len(strLine.strip()) != 0:
+                yield json.loads(strLine)
+        tFile.close()
+
+    else:
+        tFile = open(strDeviceList, 'rt')
+        atDevices = json.load(tFile)
+        tFile.close()
+        if not isinstance(atDevices, list):
+            raise Exception(
+                'The device list "%s" must contain a list.' % strDeviceList
+            )
+        for atDevice in atDevices:
+            yield atDevice
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+import array
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+
+class KeyCache:
+    # The decoded keys are shared by all instances in this process. The key
+    # is the SHA384 of the DER data.
+    __atProcessCache = {}
+
+    # This is the optional folder for the on-disk cache.
+    __strCacheFolder = None
+
+    # Only the public parts of a key are cached.
+    __astrRsaFields = ['mod', 'exp']
+    __astrEccFields = ['Qx', 'Qy', 'p', 'a', 'b', 'Gx', 'Gy', 'n']
+
+    __atKnownRsaSizes = {
+        0: {'mod': 256, 'exp': 3, 'rsa': 2048},
+        1: {'mod': 384, 'exp': 3, 'rsa': 3072},
+        2: {'mod': 512, 'exp': 3, 'rsa': 4096}
+    }
+
+    __atKnownEccSizes = {
+        0: 32,
+        1: 48,
+        2: 64
+    }
+
+    # These are the DER encoded OIDs for the supported key types.
+    __OID_RSA_ENCRYPTION = bytes([
+        0x2a, 0x86, 0x48, 0x86, 0xf7, 0x0d, 0x01, 0x01, 0x01
+    ])
+    __OID_EC_PUBLIC_KEY = bytes([
+        0x2a, 0x86, 0x48, 0xce, 0x3d, 0x02, 0x01
+    ])
+    __OID_PRIME_FIELD = bytes([
+        0x2a, 0x86, 0x48, 0xce, 0x3d, 0x01, 0x01
+    ])
+
+    __DER_TAG_INTEGER = 0x02
+    __DER_TAG_BIT_STRING = 0x03
+    __DER_TAG_OCTET_STRING = 0x04
+    __DER_TAG_OID = 0x06
+    __DER_TAG_SEQUENCE = 0x30
+    __DER_TAG_CONTEXT_0 = 0xa0
+    __DER_TAG_CONTEXT_1 = 0xa1
+
+    def __init__(self, strCacheFolder=None):
+        if strCacheFolder is not None:
+            strCacheFolder = os.path.abspath(strCacheFolder)
+            if os.path.isdir(strCacheFolder) is not True:
+                os.makedirs(strCacheFolder)
+        self.__strCacheFolder = strCacheFolder
+
+    def __der_read_element(self, strData, uiOffset):
+        sizData = len(strData)
+        if (uiOffset + 2) > sizData:
+            raise Exception('DER data is truncated.')
+
+        ucTag = strData[uiOffset]
+        sizLength = strData[uiOffset + 1]
+        uiOffset += 2
+        if (sizLength & 0x80) != 0:
+            sizLengthBytes = sizLength & 0x7f
+            if (sizLengthBytes == 0) or (sizLengthBytes > 4):
+                raise Exception('Invalid DER length.')
+            if (uiOffset + sizLengthBytes) > sizData:
+                raise Exception('DER data is truncated.')
+            sizLength = int.from_bytes(
+                strData[uiOffset:uiOffset + sizLengthBytes],
+                'big'
+            )
+            uiOffset += sizLengthBytes
+        if (uiOffset + sizLength) > sizData:
+            raise Exception('DER data is truncated.')
+
+        return ucTag, strData[uiOffset:uiOffset + sizLength], uiOffset + sizLength
+
+    def __der_get_children(self, strData):
+        atChildren = []
+        uiOffset = 0
+        while uiOffset < len(strData):
+            ucTag, strValue, uiOffset = self.__der_read_element(
+                strData,
+                uiOffset
+            )
+            atChildren.append((ucTag, strValue))
+        return atChildren
+
+    def __der_get_sequence(self, strData):
+        ucTag, strValue, uiOffset = self.__der_read_element(strData, 0)
+        if ucTag != self.__DER_TAG_SEQUENCE:
+            raise Exception('Expected a DER sequence, found tag 0x%02x.' % ucTag)
+        return self.__der_get_children(strValue)
+
+    def __der_expect(self, tElement, ucTag):
+        if tElement[0] != ucTag:
+            raise Exception(
+                'Unexpected DER tag 0x%02x, expected 0x%02x.' % (
+                    tElement[0],
+                    ucTag
+                )
+            )
+        return tElement[1]
+
+    def __der_get_unsigned(self, strValue):
+        # Cut off the sign byte of positive numbers.
+        if (len(strValue) > 1) and (strValue[0] == 0x00):
+            strValue = strValue[1:]
+        return strValue
+
+    def __to_little_endian(self, strValue, sizField=None):
+        aucData = array.array('B', strValue)
+        if sizField is not None:
+            if len(aucData) > sizField:
+                raise Exception('The number exceeds the field size.')
+            # Extend the big endian number with leading zeros.
+            aucData = array.array('B', [0] * (sizField - len(aucData))) + aucData
+        aucData.reverse()
+        return aucData
+
+    def __uncompressed_point(self, strValue, sizField):
+        # The point must not be compressed.
+        if (len(strValue) == 0) or (strValue[0] != 0x04):
+            raise Exception('The data is compressed. This is not supported yet.')
+        strValue = strValue[1:]
+        if len(strValue) != (2 * sizField):
+            raise Exception('The point does not match the field size.')
+        aucX = self.__to_little_endian(strValue[:sizField])
+        aucY = self.__to_little_endian(strValue[sizField:])
+        return aucX, aucY
+
+    def __decode_rsa(self, strModulus, strExponent):
+        aucMod = self.__to_little_endian(self.__der_get_unsigned(strModulus))
+
+        ulExp = int.from_bytes(strExponent, 'big')
+        if (ulExp < 0) or (ulExp > 0xffffff):
+            raise Exception('The exponent exceeds the allowed range of a '
+                            '24bit unsigned integer!')
+        aucExp = array.array('B', ulExp.to_bytes(3, 'little'))
+
+        sizMod = len(aucMod)
+        sizExp = len(aucExp)
+        uiId = None
+        for uiElementId, atSize in self.__atKnownRsaSizes.items():
+            if (sizMod == atSize['mod']) and (sizExp == atSize['exp']):
+                uiId = uiElementId
+                break
+
+        if uiId is None:
+            strErr = (
+                'The modulo has a size of %d bytes. '
+                'The public exponent has a size of %d bytes.\n'
+                'These values can not be mapped to a RSA bit size. '
+                'Known sizes are:\n' % (
+                    sizMod,
+                    sizExp
+                )
+            )
+            for uiElementId, atSize in self.__atKnownRsaSizes.items():
+                strErr += (
+                    '  RSA%d: %d bytes modulo, %d bytes public exponent\n' %
+                    (atSize['rsa'], atSize['mod'], atSize['exp'])
+                )
+            raise Exception(strErr)
+
+        return {
+            'id': uiId,
+            'mod': aucMod,
+            'exp': aucExp
+        }
+
+    def __decode_ecc(self, strParameters, strPublicPoint):
+        # The curve must be specified with explicit parameters. Named curves
+        # do not provide the numbers for the key structure.
+        ucTag, strValue, _ = self.__der_read_element(strParameters, 0)
+        if ucTag == self.__DER_TAG_OID:
+            raise Exception('The ECC key uses a named curve. Please use '
+                            'explicit curve parameters.')
+        atParameters = self.__der_get_sequence(strParameters)
+        if len(atParameters) < 5:
+            raise Exception('Invalid ECC parameters.')
+
+        # Get the prime from the field ID.
+        atFieldId = self.__der_get_children(
+            self.__der_expect(atParameters[1], self.__DER_TAG_SEQUENCE)
+        )
+        if self.__der_expect(atFieldId[0], self.__DER_TAG_OID) != self.__OID_PRIME_FIELD:
+            raise Exception('Only prime field curves are supported.')
+        strPrime = self.__der_get_unsigned(
+            self.__der_expect(atFieldId[1], self.__DER_TAG_INTEGER)
+        )
+        sizField = len(strPrime)
+
+        # Get the curve coefficients "a" and "b".
+        atCurve = self.__der_get_children(
+            self.__der_expect(atParameters[2], self.__DER_TAG_SEQUENCE)
+        )
+        strA = self.__der_expect(atCurve[0], self.__DER_TAG_OCTET_STRING)
+        strB = self.__der_expect(atCurve[1], self.__DER_TAG_OCTET_STRING)
+
+        strGenerator = self.__der_expect(atParameters[3], self.__DER_TAG_OCTET_STRING)
+        strOrder = self.__der_get_unsigned(
+            self.__der_expect(atParameters[4], self.__DER_TAG_INTEGER)
+        )
+        ulCofactor = 1
+        if len(atParameters) > 5:
+            ulCofactor = int.from_bytes(
+                self.__der_expect(atParameters[5], self.__DER_TAG_INTEGER),
+                'big'
+            )
+
+        aucPubX, aucPubY = self.__uncompressed_point(strPublicPoint, sizField)
+        aucGenX, aucGenY = self.__uncompressed_point(strGenerator, sizField)
+
+        uiId = None
+        for uiElementId, sizNumbers in self.__atKnownEccSizes.items():
+            if sizNumbers == sizField:
+                uiId = uiElementId
+                break
+        if uiId is None:
+            raise Exception('Invalid ECC key.')
+
+        return {
+            'id': uiId,
+            'Qx': aucPubX,
+            'Qy': aucPubY,
+            'p': self.__to_little_endian(strPrime),
+            'a': self.__to_little_endian(strA, sizField),
+            'b': self.__to_little_endian(strB, sizField),
+            'Gx': aucGenX,
+            'Gy': aucGenY,
+            'n': self.__to_little_endian(strOrder, sizField),
+            'cof': ulCofactor
+        }
+
+    def __get_bit_string(self, strValue):
+        # The first byte of a bit string is the number of unused bits.
+        if (len(strValue) == 0) or (strValue[0] != 0):
+            raise Exception('Unexpected bit string format.')
+        return strValue[1:]
+
+    def __decode_algorithm(self, strAlgorithm, strKey, fIsPrivate):
+        atAlgorithm = self.__der_get_children(strAlgorithm)
+        strOid = self.__der_expect(atAlgorithm[0], self.__DER_TAG_OID)
+        if strOid == self.__OID_RSA_ENCRYPTION:
+            atKey = self.__der_get_sequence(strKey)
+            if fIsPrivate is True:
+                # RSAPrivateKey: version, modulus, publicExponent, ...
+                atAttr = self.__decode_rsa(
+                    self.__der_expect(atKey[1], self.__DER_TAG_INTEGER),
+                    self.__der_expect(atKey[2], self.__DER_TAG_INTEGER)
+                )
+            else:
+                # RSAPublicKey: modulus, publicExponent
+                atAttr = self.__decode_rsa(
+                    self.__der_expect(atKey[0], self.__DER_TAG_INTEGER),
+                    self.__der_expect(atKey[1], self.__DER_TAG_INTEGER)
+                )
+            iKeyTyp_1ECC_2RSA = 2
+
+        elif strOid == self.__OID_EC_PUBLIC_KEY:
+            if len(atAlgorithm) < 2:
+                raise Exception('The ECC key has no curve parameters.')
+            strParameters = self.__der_encode(atAlgorithm[1])
+            if fIsPrivate is True:
+                strPublicPoint = self.__ec_private_key_get_point(strKey)
+            else:
+                strPublicPoint = strKey
+            atAttr = self.__decode_ecc(strParameters, strPublicPoint)
+            iKeyTyp_1ECC_2RSA = 1
+
+        else:
+            raise Exception('Unknown key format.')
+
+        return iKeyTyp_1ECC_2RSA, atAttr
+
+    def __der_encode(self, tElement):
+        ucTag, strValue = tElement
+        sizValue = len(strValue)
+        if sizValue < 0x80:
+            strLength = bytes([sizValue])
+        else:
+            strLengthBytes = sizValue.to_bytes((sizValue.bit_length() + 7) // 8, 'big')
+            strLength = bytes([0x80 | len(strLengthBytes)]) + strLengthBytes
+        return bytes([ucTag]) + strLength + strValue
+
+    def __ec_private_key_get_point(self, strKey):
+        # ECPrivateKey: version, privateKey, [0] parameters, [1] publicKey
+        strPublicPoint = None
+        for tElement in self.__der_get_sequence(strKey)[2:]:
+            if tElement[0] == self.__DER_TAG_CONTEXT_1:
+                ucTag, strValue, _ = self.__der_read_element(tElement[1], 0)
+                if ucTag != self.__DER_TAG_BIT_STRING:
+                    raise Exception('Invalid ECC public key.')
+                strPublicPoint = self.__get_bit_string(strValue)
+        if strPublicPoint is None:
+            raise Exception('The ECC private key has no public key.')
+        return strPublicPoint
+
+    def __decode_key(self, strKeyDER):
+        atKey = self.__der_get_sequence(strKeyDER)
+        if len(atKey) < 2:
+            raise Exception('Unknown key format.')
+
+        if(
+            (atKey[0][0] == self.__DER_TAG_SEQUENCE) and
+            (atKey[1][0] == self.__DER_TAG_BIT_STRING)
+        ):
+            # This is a SubjectPublicKeyInfo structure.
+            iKeyTyp_1ECC_2RSA, atAttr = self.__decode_algorithm(
+                atKey[0][1],
+                self.__get_bit_string(atKey[1][1]),
+                False
+            )
+
+        elif(
+            (len(atKey) >= 3) and
+            (atKey[0][0] == self.__DER_TAG_INTEGER) and
+            (atKey[1][0] == self.__DER_TAG_SEQUENCE) and
+            (atKey[2][0] == self.__DER_TAG_OCTET_STRING)
+        ):
+            # This is a PKCS#8 PrivateKeyInfo structure.
+            iKeyTyp_1ECC_2RSA, atAttr = self.__decode_algorithm(
+                atKey[1][1],
+                atKey[2][1],
+                True
+            )
+
+        elif(
+            (len(atKey) >= 3) and
+            (atKey[0][0] == self.__DER_TAG_INTEGER) and
+            (atKey[1][0] == self.__DER_TAG_INTEGER) and
+            (atKey[2][0] == self.__DER_TAG_INTEGER)
+        ):
+            # This is a PKCS#1 RSAPrivateKey structure.
+            atAttr = self.__decode_rsa(atKey[1][1], atKey[2][1])
+            iKeyTyp_1ECC_2RSA = 2
+
+        elif(
+            (atKey[0][0] == self.__DER_TAG_INTEGER) and
+            (atKey[1][0] == self.__DER_TAG_OCTET_STRING)
+        ):
+            # This is a SEC1 ECPrivateKey structure with the parameters in
+            # the context tag 0.
+            strParameters = None
+            for tElement in atKey[2:]:
+                if tElement[0] == self.__DER_TAG_CONTEXT_0:
+                    strParameters = tElement[1]
+            if strParameters is None:
+                raise Exception('The ECC key has no curve parameters.')
+            atAttr = self.__decode_ecc(
+                strParameters,
+                self.__ec_private_key_get_point(strKeyDER)
+            )
+            iKeyTyp_1ECC_2RSA = 1
+
+        else:
+            raise Exception('Unknown key format.')
+
+        return iKeyTyp_1ECC_2RSA, atAttr
+
+    def __get_cache_file(self, strDigest):
+        return os.path.join(self.__strCacheFolder, '%s.json' % strDigest)
+
+    def __disk_cache_read(self, strDigest):
+        tEntry = None
+        strPath = self.__get_cache_file(strDigest)
+        if os.path.isfile(strPath) is True:
+            try:
+                tFile = open(strPath, 'rt')
+                atJson = json.load(tFile)
+                tFile.close()
+                iKeyTyp_1ECC_2RSA = atJson['type']
+                if iKeyTyp_1ECC_2RSA == 2:
+                    astrFields = self.__astrRsaFields
+                else:
+                    astrFields = self.__astrEccFields
+                atAttr = {
+                    'id': atJson['id']
+                }
+                for strField in astrFields:
+                    atAttr[strField] = array.array(
+                        'B',
+                        bytes.fromhex(atJson[strField])
+                    )
+                if 'cof' in atJson:
+                    atAttr['cof'] = atJson['cof']
+                tEntry = (iKeyTyp_1ECC_2RSA, atAttr)
+            except (ValueError, KeyError):
+                # Ignore broken cache entries. They are replaced below.
+                tEntry = None
+        return tEntry
+
+    def __disk_cache_write(self, strDigest, iKeyTyp_1ECC_2RSA, atAttr):
+        atJson = {
+            'type': iKeyTyp_1ECC_2RSA,
+            'id': atAttr['id']
+        }
+        if iKeyTyp_1ECC_2RSA == 2:
+            astrFields = self.__astrRsaFields
+        else:
+            astrFields = self.__astrEccFields
+            atJson['cof'] = atAttr['cof']
+        for strField in astrFields:
+            atJson[strField] = atAttr[strField].tobytes().hex()
+
+        # Write to a temp file first, so parallel builds never see a
+        # half-written entry.
+        tFile = tempfile.NamedTemporaryFile(
+            mode='wt',
+            dir=self.__strCacheFolder,
+            delete=False
+        )
+        json.dump(atJson, tFile)
+        tFile.close()
+        os.replace(tFile.name, self.__get_cache_file(strDigest))
+
+    def __copy_entry(self, tEntry):
+        # The callers may modify the arrays. Never hand out the cached ones.
+        iKeyTyp_1ECC_2RSA, atAttr = tEntry
+        atCopy = {}
+        for strKey, tValue in atAttr.items():
+            if isinstance(tValue, array.array):
+                tValue = array.array(tValue.typecode, tValue)
+            atCopy[strKey] = tValue
+        return iKeyTyp_1ECC_2RSA, atCopy
+
+    def get_key_attributes(self, strKeyDER):
+        """Get the public fields of a DER encoded RSA or ECC key.
+
+        Returns a tuple with the key type (1 = ECC, 2 = RSA) and a dict with
+        the little endian fields. The "id" is the size index without any
+        chip specific offset.
+        """
+        strKeyDER = bytes(strKeyDER)
+        strDigest = hashlib.sha384(strKeyDER).hexdigest()
+
+        tEntry = KeyCache.__atProcessCache.get(strDigest)
+        if (tEntry is None) and (self.__strCacheFolder is not None):
+            tEntry = self.__disk_cache_read(strDigest)
+            if tEntry is not None:
+                KeyCache.__atProcessCache[strDigest] = tEntry
+
+        if tEntry is None:
+            tEntry = self.__decode_key(strKeyDER)
+            KeyCache.__atProcessCache[strDigest] = tEntry
+            if self.__strCacheFolder is not None:
+                self.__disk_cache_write(strDigest, tEntry[0], tEntry[1])
+
+        return self.__copy_entry(tEntry)
+
+    def get_key_id(self, strKeyDER):
+        """Get an ID for the key which does not depend on the private parts.
+
+        A key pair and its public key get the same ID.
+        """
+        iKeyTyp_1ECC_2RSA, atAttr = self.get_key_attributes(strKeyDER)
+        if iKeyTyp_1ECC_2RSA == 2:
+            astrFields = self.__astrRsaFields
+        else:
+            astrFields = self.__astrEccFields
+        tHash = hashlib.sha384()
+        for strField in astrFields:
+            tHash.update(atAttr[strField].tobytes())
+        return tHash.hexdigest()
+
+    def is_private_key(self, strKeyDER):
+        """Check if a DER encoded key contains the private key.
+
+        A public key is a SubjectPublicKeyInfo structure. All other formats
+        of get_key_attributes are key pairs.
+        """
+        atKey = self.__der_get_sequence(bytes(strKeyDER))
+        fIsPublicKey = (
+            (len(atKey) >= 2) and
+            (atKey[0][0] == self.__DER_TAG_SEQUENCE) and
+            (atKey[1][0] == self.__DER_TAG_BIT_STRING)
+        )
+        return fIsPublicKey is not True
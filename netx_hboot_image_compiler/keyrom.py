@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import array
+import base64
+import os
+import os.path
+import threading
+import xml.etree.ElementTree
+
+from . import key_cache
+
+
+# This is the process wide list of loaded keyroms. The key is the real path
+# of the file together with its size and modification time.
+__tLoadLock = threading.Lock()
+__atLoadedKeyroms = {}
+
+
+class Keyrom:
+    """An index over all entries of a keyrom file.
+
+    The XML is parsed only once. All keys are decoded from BASE64 and their
+    public fields are looked up in the key cache when the file is loaded.
+    Invalid entries are only reported when their key is requested.
+    """
+    __strKeyromFile = None
+    __cKeyCache = None
+    __atEntries = None
+
+    # This maps the DER data of each key to its entry. The images look up
+    # the public fields of a key from the keyrom here.
+    __atDerEntries = None
+
+    def __init__(self, strKeyromFile, cKeyCache=None):
+        if cKeyCache is None:
+            cKeyCache = key_cache.KeyCache()
+        self.__cKeyCache = cKeyCache
+        self.__strKeyromFile = strKeyromFile
+
+        # Parse the XML file.
+        tFile = open(strKeyromFile, 'rt')
+        strXml = tFile.read()
+        tFile.close()
+        tXml = xml.etree.ElementTree.fromstring(strXml)
+
+        self.__atEntries = {}
+        self.__atDerEntries = {}
+        for tNode in tXml.findall('Entry'):
+            # Entries without a decimal index can not be requested.
+            strIndex = tNode.get('index')
+            if strIndex is None:
+                continue
+            try:
+                uiIndex = int(strIndex, 10)
+            except ValueError:
+                continue
+            atEntry = self.__atEntries.get(uiIndex)
+            if atEntry is not None:
+                atEntry['error'] = 'Key %d is defined more than once!' % uiIndex
+                continue
+
+            # Missing children are reported when the key is requested.
+            tNode_key = tNode.find('Key')
+            tNode_hash = tNode.find('Hash')
+            atEntry = {
+                'der': None,
+                'hash': None,
+                'attributes': None,
+                'error': None
+            }
+            if tNode_key is None:
+                atEntry['error'] = 'Key %d has no "Key" child!' % uiIndex
+            elif tNode_hash is None:
+                atEntry['error'] = 'Key %d has no "Hash" child!' % uiIndex
+            else:
+                # Decode the BASE64 data. Now we have the key pair in DER
+                # format.
+                atEntry['der'] = base64.b64decode(tNode_key.text)
+                atEntry['hash'] = tNode_hash.text
+                try:
+                    atEntry['attributes'] = self.__cKeyCache.get_key_attributes(
+                        atEntry['der']
+                    )
+                except Exception as tException:
+                    # The key is only needed if an image refers to it.
+                    atEntry['attributes'] = tException
+                self.__atDerEntries.setdefault(atEntry['der'], atEntry)
+            self.__atEntries[uiIndex] = atEntry
+
+    def __get_entry(self, uiIndex):
+        atEntry = self.__atEntries.get(uiIndex)
+        if atEntry is None:
+            raise Exception('Key %d was not found!' % uiIndex)
+        if atEntry['error'] is not None:
+            raise Exception(atEntry['error'])
+        return atEntry
+
+    def get_file_name(self):
+        return self.__strKeyromFile
+
+    def get_indices(self):
+        return sorted(self.__atEntries.keys())
+
+    def get_key(self, uiIndex):
+        """Get the key with the index uiIndex in DER format."""
+        return self.__get_entry(uiIndex)['der']
+
+    def get_hash(self, uiIndex):
+        """Get the contents of the "Hash" node for the key uiIndex."""
+        return self.__get_entry(uiIndex)['hash']
+
+    def get_key_attributes(self, uiIndex):
+        """Get the public fields of the key uiIndex.
+
+        This is the same as KeyCache.get_key_attributes for the key.
+        """
+        return self.__copy_attributes(self.__get_entry(uiIndex)['attributes'])
+
+    def find_key_attributes(self, strKeyDER):
+        """Get the public fields of a key from this keyrom.
+
+        Returns None if the key is not in the keyrom.
+        """
+        atEntry = self.__atDerEntries.get(bytes(strKeyDER))
+        if atEntry is None:
+            return None
+        return self.__copy_attributes(atEntry['attributes'])
+
+    def __copy_attributes(self, tAttributes):
+        if isinstance(tAttributes, Exception):
+            raise tAttributes
+        iKeyTyp_1ECC_2RSA, atAttr = tAttributes
+
+        # The callers may modify the arrays. Never hand out the indexed ones.
+        atCopy = {}
+        for strKey, tValue in atAttr.items():
+            if isinstance(tValue, array.array):
+                tValue = array.array(tValue.typecode, tValue)
+            atCopy[strKey] = tValue
+        return iKeyTyp_1ECC_2RSA, atCopy
+
+
+def load_keyrom(tKeyrom, cKeyCache=None):
+    """Get a Keyrom object for a file name.
+
+    A file is loaded only once per process as long as it does not change.
+    If tKeyrom is already a Keyrom object, it is returned unchanged.
+    """
+    if tKeyrom is None or isinstance(tKeyrom, Keyrom):
+        return tKeyrom
+
+    strPath = os.path.realpath(tKeyrom)
+    tStat = os.stat(strPath)
+    tCacheKey = (strPath, tStat.st_size, tStat.st_mtime_ns)
+    with __tLoadLock:
+        cKeyrom = __atLoadedKeyroms.get(tCacheKey)
+        if cKeyrom is None:
+            cKeyrom = Keyrom(tKeyrom, cKeyCache)
+            __atLoadedKeyroms[tCacheKey] = cKeyrom
+    return cKeyrom
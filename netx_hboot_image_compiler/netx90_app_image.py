@@ -8,9 +8,11 @@
 
 import argparse
 import array
-import base64
 import binascii
 from . import elf_support
+from . import key_cache
+from . import keyrom
+from . import signer
 import hashlib
 import logging
 import os
@@ -19,7 +21,6 @@ import string
 import subprocess
 import tempfile
 import xml.dom.minidom
-import xml.etree.ElementTree
 
 
 # Is this a standalone script?
@@ -51,11 +52,13 @@ class AppImage:
 
     __strNetxType = None
 
-    __XmlKeyromContents = None
+    __cKeyrom = None
+    __cKeyCache = None
+    __cSigner = None
     __cfg_openssl = 'openssl'
     __cfg_openssloptions = None
 
-    def __init__(self, tEnv, strNetxType, astrIncludePaths, atKnownFiles, ulSDRamSplitOffset):
+    def __init__(self, tEnv, strNetxType, astrIncludePaths, atKnownFiles, ulSDRamSplitOffset, strKeyCacheFolder=None, cSigner=None):
         self.__tEnv = tEnv
         self.__astrIncludePaths = astrIncludePaths
         self.__atKnownFiles = atKnownFiles
@@ -66,6 +69,17 @@ class AppImage:
         # No SSL options yet.
         self.__cfg_openssloptions = []
 
+        # The decoded keys are shared with all other images in this process.
+        self.__cKeyCache = key_cache.KeyCache(strKeyCacheFolder)
+
+        # Sign with OpenSSL if no other backend was specified.
+        if cSigner is None:
+            cSigner = signer.OpenSslSigner(
+                self.__cfg_openssl,
+                self.__cfg_openssloptions
+            )
+        self.__cSigner = cSigner
+
     def segments_init(self):
         self.__tElfSegments = {}
 
@@ -124,14 +138,11 @@ class AppImage:
             print("No unused segments found")
         return fUnusedSegments
 
-    def read_keyrom(self, strKeyromFile):
-        # Read the keyrom file if specified.
-        if strKeyromFile is not None:
-            # Parse the XML file.
-            tFile = open(strKeyromFile, 'rt')
-            strXml = tFile.read()
-            tFile.close()
-            self.__XmlKeyromContents = xml.etree.ElementTree.fromstring(strXml)
+    def read_keyrom(self, tKeyrom):
+        # Read the keyrom file if specified. This can also be an already
+        # loaded keyrom, which is shared with other images.
+        if tKeyrom is not None:
+            self.__cKeyrom = keyrom.load_keyrom(tKeyrom, self.__cKeyCache)
 
     # If strVal begins with the @ character:
     # If the remainder of the string can be resolved as an alias, return the resolved value.
@@ -611,274 +622,26 @@ class AppImage:
 
         return aucBinding
 
-    # This function gets a data block from the OpenSSL output.
-    def __openssl_get_data_block(self, strStdout, strID):
-        aucData = array.array('B')
-        tReData = re.compile('^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2})*:?$')
-        iState = 0
-        for strLine in iter(strStdout.splitlines()):
-            strLine = string.strip(strLine)
-            if iState == 0:
-                if strLine == strID:
-                    iState = 1
-            elif iState == 1:
-                tMatch = tReData.search(strLine)
-                if tMatch is None:
-                    break
-                else:
-                    for strDataHex in string.split(strLine, ':'):
-                        strDataHexStrip = string.strip(strDataHex)
-                        if len(strDataHexStrip)!=0:
-                            strDataBin = binascii.unhexlify(strDataHexStrip)
-                            aucData.append(ord(strDataBin))
-
-        return aucData
-
-    def __openssl_cut_leading_zero(self, aucData):
-        # Does the number start with "00" and is the third digit >= 8?
-        if aucData[0]==0x00 and aucData[1]>=0x80:
-            # Remove the leading "00".
-            aucData.pop(0)
-
-    def __openssl_convert_to_little_endian(self, aucData):
-        aucData.reverse()
-
-    def __openssl_uncompress_field(self, aucData):
-        # The data must not be compressed.
-        if aucData[0]!=0x04:
-            raise Exception('The data is compressed. This is not supported yet.')
-        # Cut off the first byte.
-        aucData.pop(0)
-
-    def __openssl_cut_in_half(self, aucData):
-        # Cut the public key in equal parts.
-        sizDataHalf = len(aucData) / 2
-        aucData0 = array.array('B', aucData[:sizDataHalf])
-        aucData1 = array.array('B', aucData[sizDataHalf:])
-        return aucData0, aucData1
-
     def __keyrom_get_key(self, uiIndex):
         # This needs the keyrom data.
-        if self.__XmlKeyromContents is None:
+        if self.__cKeyrom is None:
             raise Exception('No Keyrom contents specified!')
 
-        # Find the requested key and hash.
-        tNode = self.__XmlKeyromContents.find('Entry/[@index="%d"]' % uiIndex)
-        if tNode is None:
-            raise Exception('Key %d was not found!' % uiIndex)
-        tNode_key = tNode.find('Key')
-        if tNode_key is None:
-            raise Exception('Key %d has no "Key" child!' % uiIndex)
-        tNode_hash = tNode.find('Hash')
-        if tNode_hash is None:
-            raise Exception('Key %d has no "Hash" child!' % uiIndex)
-
-        strKeyBase64 = tNode_key.text
-
-        # Decode the BASE64 data. Now we have the key pair in DER format.
-        strKeyDER = base64.b64decode(strKeyBase64)
-
-        return strKeyDER
+        # Get the decoded key from the index.
+        return self.__cKeyrom.get_key(uiIndex)
 
     def __get_cert_mod_exp(self, tNodeParent, strKeyDER, fIsPublicKey):
-        # Extract all information from the key.
-        astrCmd = [
-            self.__cfg_openssl,
-            'pkey',
-            '-inform',
-            'DER',
-            '-text',
-            '-noout'
-        ]
-        if fIsPublicKey is True:
-            astrCmd.append('-pubin')
-        tProcess = subprocess.Popen(
-            astrCmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE
-        )
-        (strStdout, strStdErr) = tProcess.communicate(strKeyDER)
-        if tProcess.returncode != 0:
-            raise Exception('OpenSSL failed with return code %d.' %
-                            tProcess.returncode)
-
-        # Try to guess if this is an RSA or ECC key.
-        # The text dump of an RSA key has " modulus:", while an ECC key has
-        # "priv:".
-        iKeyTyp_1ECC_2RSA = None
-        atAttr = None
-        if string.find(strStdout, 'modulus:') != -1:
-            # Looks like this is an RSA key.
-            iKeyTyp_1ECC_2RSA = 2
-
-            strMatchExponent = 'publicExponent:'
-            strMatchModulus = 'modulus:'
-            if fIsPublicKey is True:
-                strMatchExponent = 'Exponent:'
-                strMatchModulus = 'Modulus:'
-
-            # Extract the public exponent.
-            tReExp = re.compile(
-                '^%s\s+(\d+)\s+\(0x([0-9a-fA-F]+)\)$' % strMatchExponent,
-                re.MULTILINE
-            )
-            tMatch = tReExp.search(strStdout)
-            if tMatch is None:
-                raise Exception('Can not find public exponent!')
-            ulExp = int(tMatch.group(1))
-            ulExpHex = int(tMatch.group(2), 16)
-            if ulExp != ulExpHex:
-                raise Exception('Decimal version differs from hex version!')
-            if (ulExp < 0) or (ulExp > 0xffffff):
-                raise Exception('The exponent exceeds the allowed range of a '
-                                '24bit unsigned integer!')
-            strData = (
-                chr(ulExp & 0xff) +
-                chr((ulExp >> 8) & 0xff) +
-                chr((ulExp >> 16) & 0xff)
-            )
-            aucExp = array.array('B', strData)
-
-            # Extract the modulus "N".
-            aucMod = self.__openssl_get_data_block(strStdout, strMatchModulus)
-            self.__openssl_cut_leading_zero(aucMod)
-            self.__openssl_convert_to_little_endian(aucMod)
-
-            __atKnownRsaSizes = {
-                0: {'mod': 256, 'exp': 3, 'rsa': 2048},
-                1: {'mod': 384, 'exp': 3, 'rsa': 3072},
-                2: {'mod': 512, 'exp': 3, 'rsa': 4096}
-            }
-
-            sizMod = len(aucMod)
-            sizExp = len(aucExp)
-            uiId = None
-            for uiElementId, atAttr in __atKnownRsaSizes.iteritems():
-                if (sizMod == atAttr['mod']) and (sizExp == atAttr['exp']):
-                    uiId = uiElementId + 1
-                    break
-
-            if uiId is None:
-                strErr = (
-                    'The modulo has a size of %d bytes. '
-                    'The public exponent has a size of %d bytes.\n'
-                    'These values can not be mapped to a RSA bit size. '
-                    'Known sizes are:\n' % (
-                        sizMod,
-                        sizExp
-                    )
-                )
-                for uiElementId, atAttr in __atKnownRsaSizes.iteritems():
-                    strErr += (
-                        '  RSA%d: %d bytes modulo, %d bytes public exponent\n' %
-                        (atAttr['rsa'], atAttr['mod'], atAttr['exp'])
-                    )
-                raise Exception(strErr)
-
-            atAttr = {
-                'id': uiId,
-                'mod': aucMod,
-                'exp': aucExp
-            }
-
-        elif string.find(strStdout, 'priv:') != -1:
-            # Looks like this is an ECC key.
-            iKeyTyp_1ECC_2RSA = 1
-
-            aucPriv = self.__openssl_get_data_block(strStdout, 'priv:')
-            self.__openssl_cut_leading_zero(aucPriv)
-            self.__openssl_convert_to_little_endian(aucPriv)
-
-            aucPub = self.__openssl_get_data_block(strStdout, 'pub:')
-            self.__openssl_uncompress_field(aucPub)
-            aucPubX, aucPubY = self.__openssl_cut_in_half(aucPub)
-            self.__openssl_convert_to_little_endian(aucPubX)
-            self.__openssl_convert_to_little_endian(aucPubY)
-
-            aucPrime = self.__openssl_get_data_block(strStdout, 'Prime:')
-            self.__openssl_cut_leading_zero(aucPrime)
-            self.__openssl_convert_to_little_endian(aucPrime)
-
-            aucA = self.__openssl_get_data_block(strStdout, 'A:')
-            self.__openssl_cut_leading_zero(aucA)
-            self.__openssl_convert_to_little_endian(aucA)
-
-            aucB = self.__openssl_get_data_block(strStdout, 'B:')
-            self.__openssl_cut_leading_zero(aucB)
-            self.__openssl_convert_to_little_endian(aucB)
-
-            strData = self.__openssl_get_data_block(strStdout, 'Generator (uncompressed):')
-            aucGen = array.array('B', strData)
-            self.__openssl_uncompress_field(aucGen)
-            aucGenX, aucGenY = self.__openssl_cut_in_half(aucGen)
-            self.__openssl_convert_to_little_endian(aucGenX)
-            self.__openssl_convert_to_little_endian(aucGenY)
-
-            aucOrder = self.__openssl_get_data_block(strStdout, 'Order:')
-            self.__openssl_cut_leading_zero(aucOrder)
-            self.__openssl_convert_to_little_endian(aucOrder)
-
-            # Extract the cofactor.
-            tReExp = re.compile('^Cofactor:\s+(\d+)\s+\(0x([0-9a-fA-F]+)\)$', re.MULTILINE)
-            tMatch = tReExp.search(strStdout)
-            if tMatch is None:
-                raise Exception('Can not find cofactor!')
-            ulCofactor = long(tMatch.group(1))
-            ulCofactorHex = long(tMatch.group(2), 16)
-            if ulCofactor!=ulCofactorHex:
-                raise Exception('Decimal version differs from hex version!')
-
-            __atKnownEccSizes = {
-                0: 32,
-                1: 48,
-                2: 64
-            }
-
-            sizD = len(aucPriv)
-            sizQx = len(aucPubX)
-            sizQy = len(aucPubY)
-            sizP = len(aucPrime)
-            sizA = len(aucA)
-            sizB = len(aucB)
-            sizGx = len(aucGenX)
-            sizGy = len(aucGenY)
-            sizN = len(aucOrder)
-            uiId = None
-            for uiElementId, sizNumbers in __atKnownEccSizes.iteritems():
-                if(
-                    (sizNumbers == sizD) and
-                    (sizNumbers == sizQx) and
-                    (sizNumbers == sizQy) and
-                    (sizNumbers == sizP) and
-                    (sizNumbers == sizA) and
-                    (sizNumbers == sizB) and
-                    (sizNumbers == sizGx) and
-                    (sizNumbers == sizGy) and
-                    (sizNumbers == sizN)
-                ):
-                    # Found the ECC type.
-                    uiId = uiElementId + 1
-                    break
-
-            if uiId is None:
-                raise Exception('Invalid ECC key.')
-
-            atAttr = {
-                'id': uiId,
-                'd': aucPriv,
-                'Qx': aucPubX,
-                'Qy': aucPubY,
-                'p': aucPrime,
-                'a': aucA,
-                'b': aucB,
-                'Gx': aucGenX,
-                'Gy': aucGenY,
-                'n': aucOrder,
-                'cof': ulCofactor
-            }
-
-        else:
-            raise Exception('Unknown key format.')
+        # Keys from the keyrom are already decoded. Decode all other keys or
+        # get them from the cache.
+        tAttributes = None
+        if self.__cKeyrom is not None:
+            tAttributes = self.__cKeyrom.find_key_attributes(strKeyDER)
+        if tAttributes is None:
+            tAttributes = self.__cKeyCache.get_key_attributes(strKeyDER)
+        iKeyTyp_1ECC_2RSA, atAttr = tAttributes
+
+        # The netX90 starts counting the key sizes with 1.
+        atAttr['id'] += 1
 
         return iKeyTyp_1ECC_2RSA, atAttr
 
@@ -986,11 +749,11 @@ class AppImage:
         iKeyTyp_1ECC_2RSA = __atCert['Key']['iKeyTyp_1ECC_2RSA']
         atAttr = __atCert['Key']['atAttr']
         if iKeyTyp_1ECC_2RSA == 1:
-            sizKeyInDwords = len(atAttr['Qx']) / 4
-            sizSignatureInDwords = 2 * sizKeyInDwords
+            sizKeyInBytes = len(atAttr['Qx'])
+            sizSignatureInDwords = 2 * sizKeyInBytes // 4
         elif iKeyTyp_1ECC_2RSA == 2:
-            sizKeyInDwords = len(atAttr['mod']) / 4
-            sizSignatureInDwords = sizKeyInDwords
+            sizKeyInBytes = len(atAttr['mod'])
+            sizSignatureInDwords = sizKeyInBytes // 4
 
         # The size of the ASIG thing without the signature is...
         #   4 bytes ID
@@ -1020,79 +783,28 @@ class AppImage:
         # Get the key in DER encoded format.
         strKeyDER = __atCert['Key']['der']
 
-        # Create a temporary file for the keypair.
-        iFile, strPathKeypair = tempfile.mkstemp(
-            suffix='der',
-            prefix='tmp_hboot_image',
-            dir=None,
-            text=False
-        )
-        os.close(iFile)
-
-        # Create a temporary file for the data to sign.
-        iFile, strPathSignatureInputData = tempfile.mkstemp(
-            suffix='bin',
-            prefix='tmp_hboot_image',
-            dir=None,
-            text=False
-        )
-        os.close(iFile)
-
-        # Write the DER key to the temporary file.
-        tFile = open(strPathKeypair, 'wt')
-        tFile.write(strKeyDER)
-        tFile.close()
-
-        # Write the data to sign to the temporary file.
-        tFile = open(strPathSignatureInputData, 'wb')
+        # Hash the data blocks directly. Only the digest is sent to the signer.
+        tHash = hashlib.sha384()
         aulChunk0Data = self.__atDataBlocks[0]['data']
-        tFile.write(aulChunk0Data[0:112])
-        tFile.write(aulChunk0Data[128:])
+        tHash.update(aulChunk0Data[0:112])
+        tHash.update(aulChunk0Data[128:])
         sizDataBlocks = len(self.__atDataBlocks)
         for sizCnt in range(1, sizDataBlocks):
-            tFile.write(self.__atDataBlocks[sizCnt]['header'])
-            tFile.write(self.__atDataBlocks[sizCnt]['data'])
-        tFile.close()
-
-        if iKeyTyp_1ECC_2RSA == 1:
-            astrCmd = [
-                self.__cfg_openssl,
-                'dgst',
-                '-sign', strPathKeypair,
-                '-keyform', 'DER',
-                '-sha384'
-            ]
-            astrCmd.extend(self.__cfg_openssloptions)
-            astrCmd.append(strPathSignatureInputData)
-            strEccSignature = subprocess.check_output(astrCmd)
-            aucEccSignature = array.array('B', strEccSignature)
-
-            # Parse the signature.
-            aucSignature = self.__openssl_ecc_get_signature(aucEccSignature, sizKeyInDwords * 4)
-
-        elif iKeyTyp_1ECC_2RSA == 2:
-            astrCmd = [
-                self.__cfg_openssl,
-                'dgst',
-                '-sign', strPathKeypair,
-                '-keyform', 'DER',
-                '-sigopt', 'rsa_padding_mode:pss',
-                '-sigopt', 'rsa_pss_saltlen:-1',
-                '-sha384'
-            ]
-            astrCmd.extend(self.__cfg_openssloptions)
-            astrCmd.append(strPathSignatureInputData)
-            strSignatureMirror = subprocess.check_output(astrCmd)
-            aucSignature = array.array('B', strSignatureMirror)
-            # Mirror the signature.
-            aucSignature.reverse()
-
-        # Remove the temp files.
-        os.remove(strPathKeypair)
-        os.remove(strPathSignatureInputData)
+            tHash.update(self.__atDataBlocks[sizCnt]['header'])
+            tHash.update(self.__atDataBlocks[sizCnt]['data'])
+        strSignature = self.__cSigner.sign(
+            strKeyDER,
+            iKeyTyp_1ECC_2RSA,
+            tHash.digest()
+        )
+        aucSignature = signer.convert_signature(
+            strSignature,
+            iKeyTyp_1ECC_2RSA,
+            sizKeyInBytes
+        )
 
         # Append the signature to the chunk.
-        aulChunk.fromstring(aucSignature.tostring())
+        aulChunk.frombytes(aucSignature.tobytes())
 
         return aulChunk
 
@@ -1680,6 +1392,14 @@ if __name__ == '__main__':
         metavar='FILE',
         help='Read the keyrom data from FILE.'
     )
+    tParser.add_argument(
+        '--signer',
+        dest='strSignerAddress',
+        required=False,
+        default=None,
+        metavar='ADDRESS',
+        help='Send all signing requests to the signing daemon at ADDRESS.'
+    )
     tParser.add_argument(
         '-s',
         '--sdram_split_offset',
@@ -1742,7 +1462,10 @@ if __name__ == '__main__':
     }
 
     ulSDRamSplitOffset = int(tArgs.strSDRamSplitOffset, 0)
-    tAppImg = AppImage(tEnv, tArgs.strNetxType, tArgs.astrIncludePaths, atKnownFiles, ulSDRamSplitOffset)
+    cSigner = None
+    if tArgs.strSignerAddress is not None:
+        cSigner = signer.SocketSigner(tArgs.strSignerAddress)
+    tAppImg = AppImage(tEnv, tArgs.strNetxType, tArgs.astrIncludePaths, atKnownFiles, ulSDRamSplitOffset, cSigner=cSigner)
     if tArgs.strKeyRomPath is not None:
         tAppImg.read_keyrom(tArgs.strKeyRomPath)
 
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+import array
+import concurrent.futures
+import json
+import os
+import queue
+import socket
+import subprocess
+import tempfile
+import threading
+
+from . import key_cache
+
+
+def convert_signature(strSignature, iKeyTyp_1ECC_2RSA, sizKeyInBytes):
+    """Convert a signature to the little endian format of the HBoot ROM.
+
+    An RSA signature is mirrored. An ECC signature is expected in DER format
+    and split into the "r" and "s" values.
+    """
+    if iKeyTyp_1ECC_2RSA == 2:
+        if len(strSignature) != sizKeyInBytes:
+            raise Exception(
+                'The RSA signature has %d bytes, expected %d.' % (
+                    len(strSignature),
+                    sizKeyInBytes
+                )
+            )
+        aucSignature = array.array('B', strSignature)
+        aucSignature.reverse()
+
+    elif iKeyTyp_1ECC_2RSA == 1:
+        # The signature is a DER sequence with the integers "r" and "s".
+        aucSignature = array.array('B')
+        uiOffset = 2
+        if (strSignature[1] & 0x80) != 0:
+            uiOffset += strSignature[1] & 0x7f
+        for _ in range(0, 2):
+            if strSignature[uiOffset] != 0x02:
+                raise Exception('Invalid ECC signature.')
+            sizElement = strSignature[uiOffset + 1]
+            uiOffset += 2
+            ulValue = int.from_bytes(
+                strSignature[uiOffset:uiOffset + sizElement],
+                'big'
+            )
+            uiOffset += sizElement
+            if ulValue >= (1 << (8 * sizKeyInBytes)):
+                raise Exception('The ECC signature exceeds the key size.')
+            aucSignature.frombytes(ulValue.to_bytes(sizKeyInBytes, 'little'))
+
+    else:
+        raise Exception('Unknown key type: %s' % str(iKeyTyp_1ECC_2RSA))
+
+    return aucSignature
+
+
+def get_der_signature_size(sizKeyInBytes):
+    """Get the largest size of a DER encoded ECC signature.
+
+    The integers "r" and "s" can have a leading 0x00, so the size of a
+    signature changes with its values. Images reserve this size for every
+    DER signature.
+    """
+    sizSequence = 2 * (sizKeyInBytes + 3)
+    sizSignature = sizSequence + 2
+    if sizSequence >= 0x80:
+        sizSignature += 1
+    return sizSignature
+
+
+def pad_der_signature(strSignature, sizSignature):
+    """Fill a DER encoded ECC signature with 0x00 up to sizSignature bytes.
+
+    The length of the DER sequence is not changed. The ROM ignores the
+    bytes after the sequence, like the padding to a DWORD.
+    """
+    if len(strSignature) > sizSignature:
+        raise Exception(
+            'The ECC signature has %d bytes, but only %d bytes are '
+            'reserved.' % (
+                len(strSignature),
+                sizSignature
+            )
+        )
+    return bytes(strSignature) + bytes(sizSignature - len(strSignature))
+
+
+class SignatureRequest:
+    """A pending signature. The result is available after the signer flushed
+    its batch.
+    """
+    def __init__(self, cSigner, strKeyDER, iKeyTyp_1ECC_2RSA, strDigest):
+        self.__cSigner = cSigner
+        self.strKeyDER = strKeyDER
+        self.iKeyTyp_1ECC_2RSA = iKeyTyp_1ECC_2RSA
+        self.strDigest = strDigest
+
+        self.__tEvent = threading.Event()
+        self.__strSignature = None
+        self.__strError = None
+
+    def set_result(self, strSignature):
+        self.__strSignature = strSignature
+        self.__tEvent.set()
+
+    def set_error(self, strError):
+        self.__strError = strError
+        self.__tEvent.set()
+
+    def done(self):
+        return self.__tEvent.is_set()
+
+    def result(self):
+        # Send the batch if this request is still waiting for it.
+        if self.__tEvent.is_set() is not True:
+            self.__cSigner.flush()
+        self.__tEvent.wait()
+
+        if self.__strError is not None:
+            raise Exception('Failed to sign: %s' % self.__strError)
+        return self.__strSignature
+
+
+class Signer:
+    """The base class for all signing backends.
+
+    All digests are SHA384. RSA keys are used with PSS padding and a salt
+    length of the digest size. ECC signatures are returned in DER format.
+    This is the same output as "openssl dgst -sign".
+    """
+    def __init__(self):
+        self.__tLock = threading.Lock()
+        self.__atPending = []
+
+    def submit(self, strKeyDER, iKeyTyp_1ECC_2RSA, strDigest):
+        """Queue a digest for signing and return a SignatureRequest."""
+        tRequest = SignatureRequest(
+            self,
+            strKeyDER,
+            iKeyTyp_1ECC_2RSA,
+            strDigest
+        )
+        with self.__tLock:
+            self.__atPending.append(tRequest)
+        return tRequest
+
+    def flush(self):
+        """Send all queued requests to the backend in one batch."""
+        with self.__tLock:
+            atRequests = self.__atPending
+            self.__atPending = []
+        if len(atRequests) != 0:
+            self._sign_batch(atRequests)
+
+    def sign(self, strKeyDER, iKeyTyp_1ECC_2RSA, strDigest):
+        return self.submit(strKeyDER, iKeyTyp_1ECC_2RSA, strDigest).result()
+
+    def close(self):
+        pass
+
+    def _sign_batch(self, atRequests):
+        raise Exception('The signer does not implement "_sign_batch".')
+
+
+class OpenSslSigner(Signer):
+    """Sign with the OpenSSL command line tool.
+
+    The requests of a batch run in parallel. Each key of a batch is written
+    only once to a temporary file, which is removed with the batch.
+    """
+    def __init__(self, strOpenssl='openssl', astrOptions=None, uiWorkers=None):
+        Signer.__init__(self)
+        self.__strOpenssl = strOpenssl
+        if astrOptions is None:
+            astrOptions = []
+        self.__astrOptions = list(astrOptions)
+        self.__tPool = concurrent.futures.ThreadPoolExecutor(uiWorkers)
+
+    def __write_temp_file(self, strSuffix, strData):
+        iFile, strPath = tempfile.mkstemp(
+            suffix=strSuffix,
+            prefix='tmp_hboot_image',
+            dir=None,
+            text=False
+        )
+        os.write(iFile, strData)
+        os.close(iFile)
+        return strPath
+
+    def __sign_one(self, tRequest, strPathKeypair):
+        try:
+            strPathDigest = self.__write_temp_file('bin', tRequest.strDigest)
+
+            astrCmd = [
+                self.__strOpenssl,
+                'pkeyutl',
+                '-sign',
+                '-inkey', strPathKeypair,
+                '-keyform', 'DER',
+                '-pkeyopt', 'digest:sha384'
+            ]
+            if tRequest.iKeyTyp_1ECC_2RSA == 2:
+                astrCmd.extend([
+                    '-pkeyopt', 'rsa_padding_mode:pss',
+                    '-pkeyopt', 'rsa_pss_saltlen:-1'
+                ])
+            astrCmd.extend(self.__astrOptions)
+            astrCmd.extend(['-in', strPathDigest])
+            try:
+                strSignature = subprocess.check_output(astrCmd)
+            finally:
+                os.remove(strPathDigest)
+
+            tRequest.set_result(strSignature)
+        except Exception as tException:
+            tRequest.set_error(str(tException))
+
+    def _sign_batch(self, atRequests):
+        atKeyFiles = {}
+        atFutures = []
+        try:
+            for tRequest in atRequests:
+                strPathKeypair = atKeyFiles.get(tRequest.strKeyDER)
+                if strPathKeypair is None:
+                    strPathKeypair = self.__write_temp_file(
+                        'der',
+                        tRequest.strKeyDER
+                    )
+                    atKeyFiles[tRequest.strKeyDER] = strPathKeypair
+                atFutures.append(
+                    self.__tPool.submit(self.__sign_one, tRequest, strPathKeypair)
+                )
+        except Exception as tException:
+            for tRequest in atRequests[len(atFutures):]:
+                tRequest.set_error(str(tException))
+
+        concurrent.futures.wait(atFutures)
+
+        # Do not keep the private keys on the disk.
+        for strPathKeypair in atKeyFiles.values():
+            os.remove(strPathKeypair)
+
+    def close(self):
+        self.__tPool.shutdown(wait=True)
+
+
+def open_socket(strAddress):
+    """Connect to a signing daemon.
+
+    The address is the path to the Unix domain socket of the daemon.
+    """
+    tSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    tSocket.connect(strAddress)
+    return tSocket
+
+
+class SocketSigner(Signer):
+    """Send the signing requests to a signing daemon.
+
+    The keys are identified by the digest of their public fields, so the
+    private keys never leave the daemon. The connections are pooled per
+    address and reused by all signers in this process.
+    """
+    __tPoolLock = threading.Lock()
+    __atConnectionPools = {}
+
+    def __init__(self, strAddress, uiConnections=4, strKeyCacheFolder=None):
+        Signer.__init__(self)
+        self.__strAddress = strAddress
+        self.__uiConnections = max(1, uiConnections)
+        self.__cKeyCache = key_cache.KeyCache(strKeyCacheFolder)
+        self.__tPool = concurrent.futures.ThreadPoolExecutor(
+            self.__uiConnections
+        )
+
+    def __get_connection(self):
+        with SocketSigner.__tPoolLock:
+            tQueue = SocketSigner.__atConnectionPools.setdefault(
+                self.__strAddress,
+                queue.LifoQueue()
+            )
+        try:
+            tConnection = tQueue.get_nowait()
+        except queue.Empty:
+            tSocket = open_socket(self.__strAddress)
+            tConnection = (tSocket, tSocket.makefile('rwb'))
+        return tConnection
+
+    def __put_connection(self, tConnection):
+        with SocketSigner.__tPoolLock:
+            tQueue = SocketSigner.__atConnectionPools[self.__strAddress]
+        tQueue.put(tConnection)
+
+    def __send_batch(self, atRequests):
+        try:
+            atJobs = []
+            for tRequest in atRequests:
+                atJobs.append({
+                    'key': self.__cKeyCache.get_key_id(tRequest.strKeyDER),
+                    'digest': tRequest.strDigest.hex()
+                })
+            strRequest = json.dumps({'sign': atJobs}) + '\n'
+
+            tConnection = self.__get_connection()
+            try:
+                tConnection[1].write(strRequest.encode('utf-8'))
+                tConnection[1].flush()
+                strResponse = tConnection[1].readline()
+            except Exception:
+                tConnection[1].close()
+                tConnection[0].close()
+                raise
+            if len(strResponse) == 0:
+                tConnection[1].close()
+                tConnection[0].close()
+                raise Exception('The signing daemon closed the connection.')
+            self.__put_connection(tConnection)
+
+            atResponse = json.loads(strResponse.decode('utf-8'))
+            if 'error' in atResponse:
+                raise Exception(atResponse['error'])
+            astrSignatures = atResponse['signatures']
+            if len(astrSignatures) != len(atRequests):
+                raise Exception('The signing daemon returned %d signatures '
+                                'for %d requests.' % (
+                                    len(astrSignatures),
+                                    len(atRequests)
+                                ))
+            for tRequest, strSignature in zip(atRequests, astrSignatures):
+                tRequest.set_result(bytes.fromhex(strSignature))
+
+        except Exception as tException:
+            for tRequest in atRequests:
+                if tRequest.done() is not True:
+                    tRequest.set_error(str(tException))
+
+    def _sign_batch(self, atRequests):
+        # Spread the batch over the pooled connections.
+        sizSlice = -(-len(atRequests) // self.__uiConnections)
+        for uiStart in range(0, len(atRequests), sizSlice):
+            self.__tPool.submit(
+                self.__send_batch,
+                atRequests[uiStart:uiStart + sizSlice]
+            )
+
+    def close(self):
+        self.__tPool.shutdown(wait=True)
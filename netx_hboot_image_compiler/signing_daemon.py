@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# This is a reference implementation of a signing daemon for the SocketSigner.
+# It holds all keys in memory and answers batches of signing requests on a
+# Unix domain socket. Only the owner of the daemon can connect to the socket.
+# The daemon does not authenticate its clients, so it does not listen on TCP
+# ports.
+#
+# The signatures are created by OpenSSL. The keys of a batch are written to
+# temporary files which only the owner can read. They are removed after the
+# batch.
+#
+# Protocol: each request is one line of JSON
+#   {"sign": [{"key": KEY_ID, "digest": HEX}, ...]}
+# and each response is one line of JSON
+#   {"signatures": [HEX, ...]}  or  {"error": MESSAGE}
+#
+# KEY_ID is the value of KeyCache.get_key_id for the key. The digests are
+# SHA384. RSA keys sign with PSS padding and a salt of 48 bytes, ECC keys
+# return a DER encoded signature.
+
+import argparse
+import base64
+import json
+import logging
+import os
+import socketserver
+import xml.etree.ElementTree
+
+from . import key_cache
+from . import signer
+
+
+class SigningDaemon:
+    __cKeyCache = None
+    __cSigner = None
+
+    # This translates the key ID to the key type and the DER encoded key
+    # pair.
+    __atKeys = None
+
+    def __init__(self, strOpenssl='openssl', astrOpensslOptions=None):
+        self.__cKeyCache = key_cache.KeyCache()
+        self.__cSigner = signer.OpenSslSigner(strOpenssl, astrOpensslOptions)
+        self.__atKeys = {}
+
+    def add_key(self, strKeyDER):
+        # Decode the public fields. This also checks the format of the key.
+        iKeyTyp_1ECC_2RSA, _ = self.__cKeyCache.get_key_attributes(strKeyDER)
+        if self.__cKeyCache.is_private_key(strKeyDER) is not True:
+            raise Exception('This is not a private key.')
+        strKeyId = self.__cKeyCache.get_key_id(strKeyDER)
+        self.__atKeys[strKeyId] = (iKeyTyp_1ECC_2RSA, strKeyDER)
+        logging.info('Added key %s.' % strKeyId)
+        return strKeyId
+
+    def add_keyrom(self, strKeyromFile):
+        tFile = open(strKeyromFile, 'rt')
+        strXml = tFile.read()
+        tFile.close()
+        tXml = xml.etree.ElementTree.fromstring(strXml)
+        for tNodeKey in tXml.findall('Entry/Key'):
+            strKeyDER = base64.b64decode(tNodeKey.text)
+            try:
+                self.add_key(strKeyDER)
+            except Exception as tException:
+                # The keyrom may also contain public keys.
+                logging.warning('Skipping key: %s' % str(tException))
+
+    def __submit(self, strKeyId, strDigest):
+        if strKeyId not in self.__atKeys:
+            raise Exception('Unknown key: %s' % strKeyId)
+        iKeyTyp_1ECC_2RSA, strKeyDER = self.__atKeys[strKeyId]
+        return self.__cSigner.submit(strKeyDER, iKeyTyp_1ECC_2RSA, strDigest)
+
+    def sign(self, strKeyId, strDigest):
+        return self.__submit(strKeyId, strDigest).result()
+
+    def process_request(self, atRequest):
+        # Sign all digests of the request in one batch.
+        atPending = []
+        for atJob in atRequest['sign']:
+            atPending.append(self.__submit(
+                atJob['key'],
+                bytes.fromhex(atJob['digest'])
+            ))
+        self.__cSigner.flush()
+        astrSignatures = []
+        for tRequest in atPending:
+            astrSignatures.append(tRequest.result().hex())
+        return {'signatures': astrSignatures}
+
+    def close(self):
+        self.__cSigner.close()
+
+
+class SigningRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # Serve requests until the client closes the connection.
+        for strLine in self.rfile:
+            try:
+                atRequest = json.loads(strLine.decode('utf-8'))
+                atResponse = self.server.cDaemon.process_request(atRequest)
+            except Exception as tException:
+                atResponse = {'error': str(tException)}
+            self.wfile.write((json.dumps(atResponse) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class SigningUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(cDaemon, strAddress):
+    if os.path.exists(strAddress):
+        os.remove(strAddress)
+    # Only the owner may connect to the socket. Create it with these
+    # permissions, so nobody else can connect before the chmod.
+    iOldMask = os.umask(0o177)
+    try:
+        tServer = SigningUnixServer(strAddress, SigningRequestHandler)
+    finally:
+        os.umask(iOldMask)
+    os.chmod(strAddress, 0o600)
+    tServer.cDaemon = cDaemon
+    return tServer
+
+
+if __name__ == '__main__':
+    tParser = argparse.ArgumentParser(
+        usage='usage: signing_daemon [options] ADDRESS'
+    )
+    tParser.add_argument('-k', '--key',
+                         dest='astrKeys',
+                         required=False,
+                         action='append',
+                         metavar='FILE',
+                         help='Load the DER encoded key pair from FILE.')
+    tParser.add_argument('-K', '--keyrom',
+                         dest='astrKeyroms',
+                         required=False,
+                         action='append',
+                         metavar='FILE',
+                         help='Load all key pairs from the keyrom FILE.')
+    tParser.add_argument('--openssl-options',
+                         dest='astrOpensslOptions',
+                         required=False,
+                         action='append',
+                         metavar='SSLOPT',
+                         help='Add SSLOPT to the arguments for OpenSSL.')
+    tParser.add_argument('-v', '--verbose',
+                         dest='fVerbose',
+                         required=False,
+                         default=False,
+                         action='store_const', const=True,
+                         help='Be more verbose.')
+    tParser.add_argument('strAddress',
+                         metavar='ADDRESS',
+                         help='Listen on the Unix domain socket ADDRESS.')
+    tArgs = tParser.parse_args()
+
+    if tArgs.fVerbose is True:
+        logging.basicConfig(level=logging.INFO)
+
+    cDaemon = SigningDaemon(astrOpensslOptions=tArgs.astrOpensslOptions)
+    if tArgs.astrKeys is not None:
+        for strKeyFile in tArgs.astrKeys:
+            tFile = open(strKeyFile, 'rb')
+            strKeyDER = tFile.read()
+            tFile.close()
+            cDaemon.add_key(strKeyDER)
+    if tArgs.astrKeyroms is not None:
+        for strKeyromFile in tArgs.astrKeyroms:
+            cDaemon.add_keyrom(strKeyromFile)
+
+    tServer = create_server(cDaemon, tArgs.strAddress)
+    try:
+        tServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    tServer.server_close()
+    cDaemon.close()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import ast
+import os
+import os.path
+import re
+
+from . import elf_support
+
+
+class SourceCache:
+    """Share the target independent work between several images.
+
+    Pass one SourceCache to all HbootImage objects which compile the same
+    definition, e.g. for different netX types or define sets. The
+    preprocessed definition, data files and the extracted ELF segments are
+    read only once. All other steps like the patch table, the magic cookie
+    and the checks for the chunks are still done for each image.
+
+    The text of the definition, the includes and the snippets is parsed
+    once for each combination of the defines it really uses. Images with
+    different defines share all fragments which do not depend on them.
+
+    The data files and ELF binaries in the cache use at most
+    sizMemoryBudget bytes. Files which do not fit are read again for each
+    image.
+    """
+    # This is the maximum size of all cached data files and ELF binaries.
+    __sizMemoryBudget = 0x20000000
+    __sizCached = 0
+
+    # These are the preprocessed definitions. The key is built by the image
+    # from the input file and all settings which change the preprocessing.
+    __atDocuments = None
+
+    # These are the contents of data files. The key is the real path of the
+    # file together with its size and modification time.
+    __atFiles = None
+    __atTextFiles = None
+
+    # These are the names used in the expressions of a text and the parsed
+    # fragments. The key of a fragment is the text together with the
+    # values of the used names.
+    __atTextNames = None
+    __atFragments = None
+
+    # These are the segment tables and the extracted binaries of ELF files.
+    # The key is the file key and the list of segments.
+    __atElfSegments = None
+    __atElfBinaries = None
+
+    def __init__(self, sizMemoryBudget=None):
+        if sizMemoryBudget is not None:
+            self.__sizMemoryBudget = sizMemoryBudget
+        self.__sizCached = 0
+        self.__atDocuments = {}
+        self.__atFiles = {}
+        self.__atTextFiles = {}
+        self.__atTextNames = {}
+        self.__atFragments = {}
+        self.__atElfSegments = {}
+        self.__atElfBinaries = {}
+
+    def __get_file_key(self, strPath):
+        strPath = os.path.realpath(strPath)
+        tStat = os.stat(strPath)
+        return (strPath, tStat.st_size, tStat.st_mtime_ns)
+
+    def __get_elf_key(self, tEnv, strPath, astrSegments):
+        if astrSegments is not None:
+            astrSegments = tuple(astrSegments)
+        return (
+            self.__get_file_key(strPath),
+            tEnv['OBJCOPY'],
+            astrSegments
+        )
+
+    def __add_data(self, atCache, tKey, strData):
+        # Keep the data only if it fits into the budget.
+        if (self.__sizCached + len(strData)) <= self.__sizMemoryBudget:
+            atCache[tKey] = strData
+            self.__sizCached += len(strData)
+
+    def get_document(self, tKey):
+        """Get a copy of a preprocessed definition.
+
+        Returns a tuple with the XML document and the list of dependencies
+        or None if the definition is not in the cache.
+        """
+        tEntry = self.__atDocuments.get(tKey)
+        if tEntry is not None:
+            tXml, astrDependencies = tEntry
+            # The images may modify the document. Never hand out the cached
+            # one.
+            tEntry = (tXml.cloneNode(True), list(astrDependencies))
+        return tEntry
+
+    def add_document(self, tKey, tXml, astrDependencies):
+        self.__atDocuments[tKey] = (
+            tXml.cloneNode(True),
+            list(astrDependencies)
+        )
+
+    def get_file_contents(self, strPath):
+        """Get the complete contents of a file."""
+        tKey = self.__get_file_key(strPath)
+        strData = self.__atFiles.get(tKey)
+        if strData is None:
+            tFile = open(strPath, 'rb')
+            strData = tFile.read()
+            tFile.close()
+            self.__add_data(self.__atFiles, tKey, strData)
+        return strData
+
+    def get_text_contents(self, strPath):
+        """Get the complete contents of a text file."""
+        tKey = self.__get_file_key(strPath)
+        strText = self.__atTextFiles.get(tKey)
+        if strText is None:
+            tFile = open(strPath, 'rt')
+            strText = tFile.read()
+            tFile.close()
+            self.__atTextFiles[tKey] = strText
+        return strText
+
+    def __get_text_names(self, strText):
+        # Collect the names in all "%%expression%%" parts of the text.
+        astrNames = self.__atTextNames.get(strText)
+        if astrNames is None:
+            atNames = set()
+            for tMatch in re.finditer(r'%%(.+?)%%', strText):
+                try:
+                    tAstNode = ast.parse(tMatch.group(1), mode='eval')
+                except SyntaxError:
+                    # The image reports the error.
+                    atNames = None
+                    break
+                for tNode in ast.walk(tAstNode):
+                    if isinstance(tNode, ast.Name):
+                        atNames.add(tNode.id)
+            if atNames is None:
+                astrNames = False
+            else:
+                astrNames = tuple(sorted(atNames))
+            self.__atTextNames[strText] = astrNames
+        return astrNames
+
+    def get_fragment_key(self, strText, atReplace, fIsStandalone):
+        """Get the key for the parsed fragment of a text.
+
+        The key contains only the values of the defines which are used in
+        the text. Returns None if the text can not be cached.
+        """
+        tKey = None
+        astrNames = self.__get_text_names(strText)
+        if astrNames is not False:
+            atValues = []
+            for strName in astrNames:
+                tValue = atReplace.get(strName)
+                atValues.append((strName, type(tValue).__name__, tValue))
+            tKey = (strText, fIsStandalone, tuple(atValues))
+        return tKey
+
+    def get_fragment(self, tKey):
+        """Get a copy of a parsed fragment or None."""
+        tFragment = self.__atFragments.get(tKey)
+        if tFragment is not None:
+            tFragment = tFragment.cloneNode(True)
+        return tFragment
+
+    def add_fragment(self, tKey, tFragment):
+        self.__atFragments[tKey] = tFragment.cloneNode(True)
+
+    def get_elf_segment_table(self, tEnv, strPath, astrSegments):
+        """Get the segment table of an ELF file.
+
+        This is the same as elf_support.read_section_table.
+        """
+        tKey = self.__get_elf_key(tEnv, strPath, astrSegments)
+        atSegments = self.__atElfSegments.get(tKey)
+        if atSegments is None:
+            atSegments = elf_support.read_section_table(
+                strPath,
+                astrSegments
+            )
+            self.__atElfSegments[tKey] = atSegments
+        # The segments are dicts. Never hand out the cached ones.
+        return [dict(tSegment) for tSegment in atSegments]
+
+    def get_elf_binary(self, tEnv, strPath, astrSegments):
+        """Get the binary of an ELF file.
+
+        This is the same as elf_support.get_binary.
+        """
+        tKey = self.__get_elf_key(tEnv, strPath, astrSegments)
+        strData = self.__atElfBinaries.get(tKey)
+        if strData is None:
+            strData = elf_support.get_binary(tEnv, strPath, astrSegments)
+            self.__add_data(self.__atElfBinaries, tKey, strData)
+        return strData
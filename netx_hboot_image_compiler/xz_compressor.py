@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import concurrent.futures
+import hashlib
+import lzma
+import os
+import os.path
+import struct
+import tempfile
+import threading
+
+
+class XzCompressor:
+    """Compress the payload of DaXZ chunks.
+
+    The output is a single XZ stream with only the LZMA2 filter and a CRC32
+    check. This is what the ROM decompressor supports. Large payloads are
+    split in blocks of a fixed size. The blocks are independent, so they are
+    compressed in parallel. The result does not depend on the number of
+    threads.
+    """
+    # The compressed data is shared by all instances in this process. The
+    # key is the SHA384 of the payload together with the settings.
+    __atProcessCache = {}
+
+    # This is the optional folder for the on-disk cache.
+    __strCacheFolder = None
+
+    # The thread pools are shared by all instances in this process. The key
+    # is the number of threads.
+    __tPoolLock = threading.Lock()
+    __atPools = {}
+
+    __tPool = None
+
+    __XZ_MAGIC_HEADER = bytes([0xfd, 0x37, 0x7a, 0x58, 0x5a, 0x00])
+    __XZ_MAGIC_FOOTER = bytes([0x59, 0x5a])
+    __XZ_CHECK_CRC32 = 0x01
+    __XZ_FILTER_LZMA2 = 0x21
+
+    def __init__(self, strCacheFolder=None, uiThreads=None):
+        if strCacheFolder is not None:
+            strCacheFolder = os.path.abspath(strCacheFolder)
+            if os.path.isdir(strCacheFolder) is not True:
+                os.makedirs(strCacheFolder)
+        self.__strCacheFolder = strCacheFolder
+
+        if uiThreads is None:
+            uiThreads = os.cpu_count() or 1
+        if uiThreads > 1:
+            with XzCompressor.__tPoolLock:
+                tPool = XzCompressor.__atPools.get(uiThreads)
+                if tPool is None:
+                    tPool = concurrent.futures.ThreadPoolExecutor(uiThreads)
+                    XzCompressor.__atPools[uiThreads] = tPool
+            self.__tPool = tPool
+
+    def __encode_varint(self, ulValue):
+        # Multibyte integers of the XZ format have 7 bits per byte.
+        aucData = bytearray()
+        while ulValue >= 0x80:
+            aucData.append((ulValue & 0x7f) | 0x80)
+            ulValue >>= 7
+        aucData.append(ulValue)
+        return bytes(aucData)
+
+    def __get_padding(self, sizData):
+        return bytes((4 - (sizData % 4)) & 3)
+
+    def __crc32(self, strData):
+        return struct.pack('<I', binascii.crc32(strData) & 0xffffffff)
+
+    def __get_dict_size_property(self, sizDictionary):
+        # The LZMA2 dictionary size is encoded as 2 or 3 times a power of 2.
+        for ucProperty in range(0, 40):
+            sizEncoded = (2 | (ucProperty & 1)) << (ucProperty // 2 + 11)
+            if sizEncoded >= sizDictionary:
+                return ucProperty
+        return 40
+
+    def __compress_block(self, strData, uiLevel, sizDictionary):
+        # This runs in the thread pool. The LZMA module releases the GIL.
+        atFilters = [{
+            'id': lzma.FILTER_LZMA2,
+            'preset': uiLevel,
+            'dict_size': sizDictionary
+        }]
+        return lzma.compress(strData, format=lzma.FORMAT_RAW, filters=atFilters)
+
+    def __build_block(self, strData, strCompressed, ucDictProperty):
+        # The block header has the LZMA2 filter and no size fields.
+        aucHeader = bytearray([0x00, 0x00])
+        aucHeader += self.__encode_varint(self.__XZ_FILTER_LZMA2)
+        aucHeader += self.__encode_varint(1)
+        aucHeader.append(ucDictProperty)
+        aucHeader += self.__get_padding(len(aucHeader))
+        aucHeader[0] = (len(aucHeader) + 4) // 4 - 1
+        aucHeader += self.__crc32(aucHeader)
+
+        strBlock = b''.join([
+            bytes(aucHeader),
+            strCompressed,
+            self.__get_padding(len(strCompressed)),
+            self.__crc32(strData)
+        ])
+        sizUnpadded = len(aucHeader) + len(strCompressed) + 4
+        return strBlock, sizUnpadded
+
+    def __build_stream(self, atBlocks):
+        strStreamFlags = bytes([0x00, self.__XZ_CHECK_CRC32])
+        astrStream = [
+            self.__XZ_MAGIC_HEADER,
+            strStreamFlags,
+            self.__crc32(strStreamFlags)
+        ]
+
+        # Add the blocks and collect the index records.
+        aucIndex = bytearray([0x00])
+        aucIndex += self.__encode_varint(len(atBlocks))
+        for strBlock, sizUnpadded, sizUncompressed in atBlocks:
+            astrStream.append(strBlock)
+            aucIndex += self.__encode_varint(sizUnpadded)
+            aucIndex += self.__encode_varint(sizUncompressed)
+        aucIndex += self.__get_padding(len(aucIndex))
+        aucIndex += self.__crc32(aucIndex)
+        astrStream.append(bytes(aucIndex))
+
+        # The footer has the size of the index.
+        strFooter = struct.pack('<I', len(aucIndex) // 4 - 1) + strStreamFlags
+        astrStream.append(self.__crc32(strFooter))
+        astrStream.append(strFooter)
+        astrStream.append(self.__XZ_MAGIC_FOOTER)
+
+        return b''.join(astrStream)
+
+    def __compress(self, strData, uiLevel, sizDictionary, sizBlock):
+        ucDictProperty = self.__get_dict_size_property(sizDictionary)
+
+        # Split the data in blocks. An empty payload still gets one block.
+        atParts = []
+        ulOffset = 0
+        while True:
+            atParts.append(strData[ulOffset:ulOffset + sizBlock])
+            ulOffset += sizBlock
+            if ulOffset >= len(strData):
+                break
+
+        if (self.__tPool is None) or (len(atParts) == 1):
+            astrCompressed = [
+                self.__compress_block(strPart, uiLevel, sizDictionary)
+                for strPart in atParts
+            ]
+        else:
+            astrCompressed = list(self.__tPool.map(
+                self.__compress_block,
+                atParts,
+                [uiLevel] * len(atParts),
+                [sizDictionary] * len(atParts)
+            ))
+
+        atBlocks = []
+        for strPart, strCompressed in zip(atParts, astrCompressed):
+            strBlock, sizUnpadded = self.__build_block(
+                strPart,
+                strCompressed,
+                ucDictProperty
+            )
+            atBlocks.append((strBlock, sizUnpadded, len(strPart)))
+
+        return self.__build_stream(atBlocks)
+
+    def __get_cache_file(self, strDigest):
+        return os.path.join(self.__strCacheFolder, '%s.xz' % strDigest)
+
+    def __disk_cache_read(self, strDigest):
+        strCompressed = None
+        strPath = self.__get_cache_file(strDigest)
+        if os.path.isfile(strPath) is True:
+            tFile = open(strPath, 'rb')
+            strCompressed = tFile.read()
+            tFile.close()
+        return strCompressed
+
+    def __disk_cache_write(self, strDigest, strCompressed):
+        # Write to a temp file first, so parallel builds never see a
+        # half-written entry.
+        tFile = tempfile.NamedTemporaryFile(
+            mode='wb',
+            dir=self.__strCacheFolder,
+            delete=False
+        )
+        tFile.write(strCompressed)
+        tFile.close()
+        os.replace(tFile.name, self.__get_cache_file(strDigest))
+
+    def compress(self, strData, uiLevel=6, sizDictionary=0x100000, sizBlock=0x100000):
+        """Compress strData to an XZ stream.
+
+        uiLevel is the LZMA preset from 0 to 9. sizDictionary is the size of
+        the dictionary in bytes. The data is split in blocks of sizBlock
+        bytes. The result is cached with the SHA384 of the data and the
+        settings.
+        """
+        if (uiLevel < 0) or (uiLevel > 9):
+            raise Exception('Invalid compression level: %d' % uiLevel)
+        if sizDictionary < 4096:
+            raise Exception('The dictionary must have at least 4096 bytes.')
+        if sizBlock < 1:
+            raise Exception('Invalid block size: %d' % sizBlock)
+
+        tHash = hashlib.sha384()
+        tHash.update(strData)
+        tHash.update(struct.pack('<III', uiLevel, sizDictionary, sizBlock))
+        strDigest = tHash.hexdigest()
+
+        strCompressed = XzCompressor.__atProcessCache.get(strDigest)
+        if (strCompressed is None) and (self.__strCacheFolder is not None):
+            strCompressed = self.__disk_cache_read(strDigest)
+            if strCompressed is not None:
+                XzCompressor.__atProcessCache[strDigest] = strCompressed
+
+        if strCompressed is None:
+            strCompressed = self.__compress(
+                strData,
+                uiLevel,
+                sizDictionary,
+                sizBlock
+            )
+            XzCompressor.__atProcessCache[strDigest] = strCompressed
+            if self.__strCacheFolder is not None:
+                self.__disk_cache_write(strDigest, strCompressed)
+
+        return strCompressed